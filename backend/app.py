@@ -1,8 +1,18 @@
 import os
+import json
+import shutil
+import tempfile
+import time
 from env_var import EnvVariable
 from database import Database
-from flask import Flask, request, jsonify, session
-from helper import get_pdf_text, get_text_chunks, get_vectorstore, query, get_pdf_text_from_path, evaluate_with_llm
+from flask import Flask, Response, g, request, jsonify, session, stream_with_context
+from instrumentation import configure_sinks, inc, observe, registry, stage
+from jobs import IngestionQueue
+from pdf_extract import start_executor
+from helper import query, stream_query, evaluate_with_llm, evaluate_batch, get_embeddings, get_semantic_cache, indexes
+from namespaces import validate_namespace, validate_namespaces
+import request_params
+from request_params import NamespaceNotFound
 
 
 app = Flask(__name__)
@@ -10,102 +20,322 @@ app = Flask(__name__)
 # Set your secret key here. It can be any random string.
 DB_NAME = EnvVariable.DB_NAME.value
 
-# Initialize the database interaction
-db = Database(DB_NAME)
+# Initialize the database interaction, the schema is created once at startup
+db = Database(DB_NAME, pool_size=EnvVariable.DB_POOL_SIZE.value, acquire_timeout=EnvVariable.DB_ACQUIRE_TIMEOUT.value)
+db.init_db()
 
-@app.before_request
-def initialize_database():
-    """Initialize the database when the application starts."""
-    db.init_db()
+# Where the stage timings, token counts and request metrics go
+configure_sinks(EnvVariable.METRICS_SINKS.value, log_threshold_ms=EnvVariable.METRICS_LOG_THRESHOLD_MS.value)
+
+# PDF parsing processes, started before the ingestion threads so they inherit none of their locks
+start_executor()
+
+# Background workers ingesting the uploaded documents
+ingestion_queue = IngestionQueue(db, max_workers=EnvVariable.INGEST_WORKERS.value)
 
 @app.teardown_appcontext
 def close_database(exception):
-    """Close the database connection after each request."""
+    """Return the database connection to the pool after each request."""
     db.close_db()
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    g.timings = None
+
+@app.after_request
+def record_request(response):
+    """
+    Count the request and its duration by route, and with TIMING_HEADER set send the
+    stage timings of the request in a Server-Timing header. For streams the duration
+    is the time to the first byte.
+    """
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    inc("requests_total", help_text="HTTP requests by route and status",
+        endpoint=endpoint, method=request.method, status=str(response.status_code))
+    observe("request_seconds", time.perf_counter() - g.request_start, help_text="HTTP request duration by route",
+            endpoint=endpoint)
+    if EnvVariable.TIMING_HEADER.value and g.timings:
+        response.headers["Server-Timing"] = ", ".join(f"{name};dur={ms}" for name, ms in g.timings.items())
+    return response
+
 # Endpoint to upload the research document
 @app.route('/upload/', methods=['POST'])
 def upload_document():
 
-    # Check if files are provided in the request
-    if 'pdf_doc_0' in request.files:
-        # Get the PDF files from the request
-        pdf_docs = request.files.to_dict()
-        # Extract text from the PDF files
-        raw_text = get_pdf_text(pdf_docs)
-    elif 'file_paths' in request.json:
-        file_paths = request.json.get('file_paths', [])
-              
-        # Ensure file paths are valid
-        for file_path in file_paths:
-            if not os.path.exists(file_path):
-                return {'error': f"File {file_path} does not exist"}, 400
-        # Extract text from the provided file paths
-        raw_text = get_pdf_text_from_path(file_paths)
-    else:
-        return {'error': 'No files or file paths provided'}, 400
-
-    # get the text chunks
-    text_chunks = get_text_chunks(raw_text)
-
-    # create vector store
-    vectorstore = get_vectorstore(text_chunks)
-
-    # Specify a path to save the FAISS index
-    index_path = EnvVariable.FAISS_PATH.value
-    vectorstore.save_local(index_path)
-
-    # return jsonify({'message': 'Document uploaded successfully', 'vectorstore': vectorstore}), 201
-    return jsonify({'message': 'Document uploaded successfully'}), 201
+    # Uploaded files are kept in their own folder until the ingestion job has parsed them
+    upload_dir = tempfile.mkdtemp(prefix='upload-', dir=EnvVariable.UPLOAD_DIR.value)
+    try:
+        # Check if files are provided in the request
+        if 'pdf_doc_0' in request.files:
+            documents = []
+            for i, pdf in enumerate(request.files.values()):
+                file_path = os.path.join(upload_dir, f'{i}.pdf')
+                with stage("upload_save"):
+                    pdf.save(file_path)
+                documents.append((pdf.filename, file_path))
+            mode = request.form.get('mode', 'append')
+            namespace = request.form.get('namespace')
+            replace_source = request_params.replace_source(request.form.get('replace_source'))
+        elif 'file_paths' in request.json:
+            file_paths = request.json.get('file_paths', [])
+            mode = request.json.get('mode', 'append')
+            namespace = request.json.get('namespace')
+            replace_source = request_params.replace_source(request.json.get('replace_source'))
+
+            # Ensure file paths are valid
+            for file_path in file_paths:
+                if not os.path.exists(file_path):
+                    return {'error': f"File {file_path} does not exist"}, 400
+            documents = [(file_path, file_path) for file_path in file_paths]
+        else:
+            return {'error': 'No files or file paths provided'}, 400
+
+        if mode not in ('append', 'replace'):
+            return {'error': "mode must be 'append' or 'replace'"}, 400
+        try:
+            namespace = validate_namespace(namespace)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        # Parse, chunk and embed in the background, the client polls /upload/<job_id>
+        job_id = ingestion_queue.submit(
+            documents, mode=mode, upload_dir=upload_dir, namespace=namespace, replace_source=replace_source
+        )
+        # From here on the job deletes the folder
+        upload_dir = None
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    return jsonify({
+        'message': 'Document upload accepted',
+        'job_id': job_id,
+        'namespace': namespace,
+        'status_url': f'/upload/{job_id}'
+    }), 202
+
+# Endpoint for clients to skip uploading documents already ingested, looked up by the SHA-256 of their content
+@app.route('/documents/lookup', methods=['POST'])
+def lookup_documents():
+    content_hashes = request.json.get("content_hashes")
+    if not isinstance(content_hashes, list) or not all(isinstance(h, str) for h in content_hashes):
+        return jsonify({"error": "content_hashes must be a list of SHA-256 hex digests"}), 400
+    try:
+        namespace = validate_namespace(request.json.get("namespace"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "known": db.get_known_documents(content_hashes, namespace),
+        "namespace": namespace,
+        "index_version": indexes.get(namespace).version
+    })
+
+# Endpoint to follow the progress of an upload
+@app.route('/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    job = db.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Upload job not found"}), 404
+    return jsonify(job)
+
+def get_query_namespaces():
+    """
+    Namespaces a /query/ request searches, see `request_params.query_namespaces`.
+
+    Returns:
+        tuple[list[str] | None, tuple | None]: The namespaces, or an error response.
+    """
+    try:
+        return request_params.query_namespaces(request.json), None
+    except ValueError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+    except NamespaceNotFound as e:
+        return None, (jsonify({"error": str(e)}), 404)
+
+def get_retrieval_mode():
+    """Retrieval mode a /query/ request asks for, None for the RETRIEVAL_MODE default."""
+    return request_params.retrieval_mode(request.json)
+
+def get_retrieval_knobs():
+    """Search knobs of a /query/ request, see `request_params.retrieval_knobs`."""
+    return request_params.retrieval_knobs(request.json)
 
 # Endpoint to query the system and get an answer with test question
 @app.route('/query/', methods=['POST'])
 def query_document():
     user_input = request.json.get("question")
+    parallel = request.json.get("parallel", True)
+    namespaces, error = get_query_namespaces()
+    if error:
+        return error
+    try:
+        retrieval_mode = get_retrieval_mode()
+        retrieval = get_retrieval_knobs()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     # Call function to get answer, test question, and bullet points
-    response = query(user_input)
-
-    # Save test question and answer to the database
-    db.save_test_question(
-        response['test_question_id'],
-        response['test_question'],
-        response['test_answer']
+    response = query(
+        user_input, parallel=parallel, namespaces=namespaces, retrieval_mode=retrieval_mode, retrieval=retrieval,
+        db=db,
     )
 
+    # Save test question and answer to the database, question bank ones already are
+    if not response['question_bank']:
+        with stage("test_question_write", response['timings']):
+            db.save_test_question(
+                response['test_question_id'],
+                response['test_question'],
+                response['test_answer']
+            )
+    g.timings = response['timings']
+
     # Return the required JSON response
     return jsonify({
         "answer": response['answer'],
         "bullet_points": response['bullet_points'],
         "test_question": response['test_question'],
         "test_answer": response['test_answer'],
-        "test_question_id": response['test_question_id']
+        "test_question_id": response['test_question_id'],
+        "question_bank": response['question_bank'],
+        "index_version": response['index_version'],
+        "cached": response['cached'],
+        "retrieval_mode": response['retrieval_mode'],
+        "context_tokens": response['context_tokens'],
+        "timings": response['timings']
     })
 
+# Streaming variant of /query/, sent as Server-Sent Events
+@app.route('/query/stream', methods=['POST'])
+def query_document_stream():
+    user_input = request.json.get("question")
+    namespaces, error = get_query_namespaces()
+    if error:
+        return error
+    try:
+        retrieval_mode = get_retrieval_mode()
+        retrieval = get_retrieval_knobs()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        for event, data in stream_query(
+            user_input, namespaces=namespaces, retrieval_mode=retrieval_mode, retrieval=retrieval, db=db
+        ):
+            # Save the test question before the client can try to answer it
+            if event == "test_question" and not data['question_bank']:
+                with stage("test_question_write"):
+                    db.save_test_question(data['test_question_id'], data['test_question'], data['test_answer'])
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/evaluate/', methods=['POST'])
 def evaluate():
     try:
         # Extract data from the incoming request
         user_answer = request.json.get("answer")
         test_question_id = request.json.get("test_question_id")
+        structured = request.json.get("structured", True)
 
         # Validate input
         if not user_answer or not test_question_id:
             return jsonify({"error": "Missing required fields: 'answer' and 'test_question_id'"}), 400
 
-        # Fetch the correct answer from the database
-        test_answer = db.get_test_answer(test_question_id)
-        if not test_answer:
+        # Fetch the test question and correct answer from the database
+        test_item = db.get_test_item(test_question_id)
+        if not test_item:
             return jsonify({"error": "Test question not found"}), 404
-        test_question = db.get_test_question(test_question_id)
+
+        # Give the connection back to the pool before the LLM call, other requests can use it meanwhile
+        db.close_db()
 
         # Call the evaluation function
-        evaluation_result = evaluate_with_llm(test_question, user_answer, test_answer)
+        evaluation_result = evaluate_with_llm(
+            test_item["test_question"], user_answer, test_item["test_answer"], structured=structured
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     return jsonify(evaluation_result)
 
+# Endpoint to inspect the embedding cache hit/miss counters
+@app.route('/embedding-cache/', methods=['GET'])
+def embedding_cache_stats():
+    return jsonify(get_embeddings().stats())
+
+# Endpoint to inspect the semantic cache of /query/ responses with the default retrieval settings, for a comma-separated list of namespaces
+@app.route('/semantic-cache/', methods=['GET'])
+def semantic_cache_stats():
+    try:
+        namespaces = validate_namespaces([n for n in request.args.get("namespace", "").split(",") if n] or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(get_semantic_cache(namespaces).stats())
+
+# Prometheus scrape endpoint: stage durations, LLM calls and tokens, embedding batch sizes, requests
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Endpoint to inspect the namespace indexes and which ones are loaded in memory
+@app.route('/namespaces/', methods=['GET'])
+def namespace_stats():
+    return jsonify(indexes.stats())
+
+# Endpoint to grade many answers in one call, e.g. a whole class
+@app.route('/evaluate/batch', methods=['POST'])
+def evaluate_batch_answers():
+    try:
+        items = request.json.get("items")
+        structured = request.json.get("structured", True)
+
+        # Validate input
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Missing required field: 'items'"}), 400
+        for item in items:
+            if not isinstance(item, dict) or not item.get("answer") or not item.get("test_question_id"):
+                return jsonify({"error": "Each item needs 'answer' and 'test_question_id'"}), 400
+
+        # Fetch every test question and correct answer in one query
+        test_items = db.get_test_items([item["test_question_id"] for item in items])
+        found = [item for item in items if item["test_question_id"] in test_items]
+
+        # Give the connection back to the pool before the LLM calls, other requests can use it meanwhile
+        db.close_db()
+
+        # Call the evaluation function on all of them, LLM calls run concurrently
+        evaluations = evaluate_batch(
+            [
+                {
+                    "question": test_items[item["test_question_id"]]["test_question"],
+                    "user_answer": item["answer"],
+                    "correct_answer": test_items[item["test_question_id"]]["test_answer"],
+                }
+                for item in found
+            ],
+            structured=structured,
+            max_concurrency=EnvVariable.EVALUATE_BATCH_CONCURRENCY.value
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    # Results in request order, with an error for unknown test questions and failed evaluations
+    evaluations = iter(evaluations)
+    results = []
+    for item in items:
+        if item["test_question_id"] in test_items:
+            results.append({"test_question_id": item["test_question_id"], **next(evaluations)})
+        else:
+            results.append({"test_question_id": item["test_question_id"], "error": "Test question not found"})
+    return jsonify({"results": results})
+
 @app.route('/')
 def health_check():
     return "Hello, Flask!"
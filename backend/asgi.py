@@ -0,0 +1,382 @@
+# asgi.py
+#
+# ASGI version of app.py, with the same routes and JSON responses. While a request waits
+# for the LLM it only holds a coroutine, not a thread, so a process serves hundreds of
+# them at once. Run it with:
+#
+#     cd backend && uvicorn asgi:app --port 5000
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+import request_params
+from async_database import AsyncDatabase
+from database import Database
+from env_var import EnvVariable
+from helper import aevaluate_with_llm, aquery, astream_query, evaluate_batch, get_embeddings, get_semantic_cache, indexes
+from instrumentation import configure_sinks, inc, observe, registry, stage
+from jobs import IngestionQueue
+from namespaces import validate_namespace, validate_namespaces
+from pdf_extract import start_executor
+from request_params import NamespaceNotFound
+
+DB_NAME = EnvVariable.DB_NAME.value
+
+# The schema, the ingestion jobs and the question bank lookups (in the query chains'
+# worker threads) go through the thread-based database layer, the requests through the aiosqlite one
+database = Database(DB_NAME, pool_size=EnvVariable.DB_POOL_SIZE.value, acquire_timeout=EnvVariable.DB_ACQUIRE_TIMEOUT.value)
+database.init_db()
+db = AsyncDatabase(DB_NAME, pool_size=EnvVariable.DB_POOL_SIZE.value, acquire_timeout=EnvVariable.DB_ACQUIRE_TIMEOUT.value)
+
+# Where the stage timings, token counts and request metrics go
+configure_sinks(EnvVariable.METRICS_SINKS.value, log_threshold_ms=EnvVariable.METRICS_LOG_THRESHOLD_MS.value)
+
+# PDF parsing processes, started before the ingestion threads so they inherit none of their locks
+start_executor()
+
+# Parsing, chunking and embedding run in these worker threads (and the PDF process pool), off the event loop
+ingestion_queue = IngestionQueue(database, max_workers=EnvVariable.INGEST_WORKERS.value)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await db.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def error(message, status_code):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+async def json_body(request):
+    """The JSON object sent with a request, None if there isn't one."""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    """Same request metrics and Server-Timing header as app.py, see `record_request` there."""
+    start = time.perf_counter()
+    request.state.timings = None
+    response = await call_next(request)
+
+    route = request.scope.get("route")
+    endpoint = route.path if route else "unmatched"
+    inc("requests_total", help_text="HTTP requests by route and status",
+        endpoint=endpoint, method=request.method, status=str(response.status_code))
+    observe("request_seconds", time.perf_counter() - start, help_text="HTTP request duration by route",
+            endpoint=endpoint)
+    if EnvVariable.TIMING_HEADER.value and request.state.timings:
+        response.headers["Server-Timing"] = ", ".join(f"{name};dur={ms}" for name, ms in request.state.timings.items())
+    return response
+
+
+def save_upload(upload, file_path):
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(upload.file, f)
+
+
+# Endpoint to upload the research document
+@app.post('/upload/')
+async def upload_document(request: Request):
+
+    # Uploaded files are kept in their own folder until the ingestion job has parsed them
+    upload_dir = tempfile.mkdtemp(prefix='upload-', dir=EnvVariable.UPLOAD_DIR.value)
+    try:
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            form = await request.form()
+            if 'pdf_doc_0' not in form:
+                return error('No files or file paths provided', 400)
+            documents = []
+            for i, pdf in enumerate(value for value in form.values() if hasattr(value, 'filename')):
+                file_path = os.path.join(upload_dir, f'{i}.pdf')
+                with stage("upload_save"):
+                    await run_in_threadpool(save_upload, pdf, file_path)
+                documents.append((pdf.filename, file_path))
+            mode = form.get('mode', 'append')
+            namespace = form.get('namespace')
+            replace_source = request_params.replace_source(form.get('replace_source'))
+        else:
+            body = await json_body(request)
+            if not body or 'file_paths' not in body:
+                return error('No files or file paths provided', 400)
+            file_paths = body.get('file_paths', [])
+            mode = body.get('mode', 'append')
+            namespace = body.get('namespace')
+            replace_source = request_params.replace_source(body.get('replace_source'))
+
+            # Ensure file paths are valid
+            for file_path in file_paths:
+                if not os.path.exists(file_path):
+                    return error(f"File {file_path} does not exist", 400)
+            documents = [(file_path, file_path) for file_path in file_paths]
+
+        if mode not in ('append', 'replace'):
+            return error("mode must be 'append' or 'replace'", 400)
+        try:
+            namespace = validate_namespace(namespace)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        # Parse, chunk and embed in the background, the client polls /upload/<job_id>
+        job_id = await run_in_threadpool(
+            ingestion_queue.submit, documents, mode=mode, upload_dir=upload_dir, namespace=namespace,
+            replace_source=replace_source,
+        )
+        # From here on the job deletes the folder
+        upload_dir = None
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    return JSONResponse({
+        'message': 'Document upload accepted',
+        'job_id': job_id,
+        'namespace': namespace,
+        'status_url': f'/upload/{job_id}'
+    }, status_code=202)
+
+
+# Endpoint for clients to skip uploading documents already ingested, looked up by the SHA-256 of their content
+@app.post('/documents/lookup')
+async def lookup_documents(request: Request):
+    body = await json_body(request) or {}
+    content_hashes = body.get("content_hashes")
+    if not isinstance(content_hashes, list) or not all(isinstance(h, str) for h in content_hashes):
+        return error("content_hashes must be a list of SHA-256 hex digests", 400)
+    try:
+        namespace = validate_namespace(body.get("namespace"))
+    except ValueError as e:
+        return error(str(e), 400)
+
+    return JSONResponse({
+        "known": await db.get_known_documents(content_hashes, namespace),
+        "namespace": namespace,
+        "index_version": indexes.get(namespace).version
+    })
+
+
+# Endpoint to follow the progress of an upload
+@app.get('/upload/{job_id}')
+async def upload_status(job_id: str):
+    job = await db.get_job(job_id)
+    if job is None:
+        return error("Upload job not found", 404)
+    return JSONResponse(job)
+
+
+def query_params(body):
+    """
+    Namespaces, retrieval mode and retrieval knobs of a /query/ request, see request_params.py.
+
+    Returns:
+        tuple[tuple | None, JSONResponse | None]: The parameters, or an error response.
+    """
+    try:
+        namespaces = request_params.query_namespaces(body)
+        return (namespaces, request_params.retrieval_mode(body), request_params.retrieval_knobs(body)), None
+    except ValueError as e:
+        return None, error(str(e), 400)
+    except NamespaceNotFound as e:
+        return None, error(str(e), 404)
+
+
+# Endpoint to query the system and get an answer with test question
+@app.post('/query/')
+async def query_document(request: Request):
+    body = await json_body(request)
+    if body is None:
+        return error("Request body must be a JSON object", 400)
+    params, response = query_params(body)
+    if response:
+        return response
+    namespaces, retrieval_mode, retrieval = params
+
+    # Call function to get answer, test question, and bullet points
+    response = await aquery(
+        body.get("question"), parallel=body.get("parallel", True), namespaces=namespaces,
+        retrieval_mode=retrieval_mode, retrieval=retrieval, db=database,
+    )
+
+    # Save test question and answer to the database, question bank ones already are
+    if not response['question_bank']:
+        with stage("test_question_write", response['timings']):
+            await db.save_test_question(
+                response['test_question_id'],
+                response['test_question'],
+                response['test_answer']
+            )
+    request.state.timings = response['timings']
+
+    # Return the required JSON response
+    return JSONResponse({
+        "answer": response['answer'],
+        "bullet_points": response['bullet_points'],
+        "test_question": response['test_question'],
+        "test_answer": response['test_answer'],
+        "test_question_id": response['test_question_id'],
+        "question_bank": response['question_bank'],
+        "index_version": response['index_version'],
+        "cached": response['cached'],
+        "retrieval_mode": response['retrieval_mode'],
+        "context_tokens": response['context_tokens'],
+        "timings": response['timings']
+    })
+
+
+# Streaming variant of /query/, sent as Server-Sent Events
+@app.post('/query/stream')
+async def query_document_stream(request: Request):
+    body = await json_body(request)
+    if body is None:
+        return error("Request body must be a JSON object", 400)
+    params, response = query_params(body)
+    if response:
+        return response
+    namespaces, retrieval_mode, retrieval = params
+
+    async def generate():
+        async for event, data in astream_query(
+            body.get("question"), namespaces=namespaces, retrieval_mode=retrieval_mode, retrieval=retrieval,
+            db=database,
+        ):
+            # Save the test question before the client can try to answer it
+            if event == "test_question" and not data['question_bank']:
+                with stage("test_question_write"):
+                    await db.save_test_question(data['test_question_id'], data['test_question'], data['test_answer'])
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.post('/evaluate/')
+async def evaluate(request: Request):
+    try:
+        # Extract data from the incoming request
+        body = await json_body(request) or {}
+        user_answer = body.get("answer")
+        test_question_id = body.get("test_question_id")
+        structured = body.get("structured", True)
+
+        # Validate input
+        if not user_answer or not test_question_id:
+            return error("Missing required fields: 'answer' and 'test_question_id'", 400)
+
+        # Fetch the test question and correct answer from the database
+        test_item = await db.get_test_item(test_question_id)
+        if not test_item:
+            return error("Test question not found", 404)
+
+        # Call the evaluation function
+        evaluation_result = await aevaluate_with_llm(
+            test_item["test_question"], user_answer, test_item["test_answer"], structured=structured
+        )
+    except Exception as e:
+        return error(str(e), 500)
+
+    return JSONResponse(evaluation_result)
+
+
+# Endpoint to grade many answers in one call, e.g. a whole class
+@app.post('/evaluate/batch')
+async def evaluate_batch_answers(request: Request):
+    try:
+        body = await json_body(request) or {}
+        items = body.get("items")
+        structured = body.get("structured", True)
+
+        # Validate input
+        if not isinstance(items, list) or not items:
+            return error("Missing required field: 'items'", 400)
+        for item in items:
+            if not isinstance(item, dict) or not item.get("answer") or not item.get("test_question_id"):
+                return error("Each item needs 'answer' and 'test_question_id'", 400)
+
+        # Fetch every test question and correct answer in one query
+        test_items = await db.get_test_items([item["test_question_id"] for item in items])
+        found = [item for item in items if item["test_question_id"] in test_items]
+
+        # The batch runs its LLM calls concurrently in its own threads
+        evaluations = await run_in_threadpool(
+            evaluate_batch,
+            [
+                {
+                    "question": test_items[item["test_question_id"]]["test_question"],
+                    "user_answer": item["answer"],
+                    "correct_answer": test_items[item["test_question_id"]]["test_answer"],
+                }
+                for item in found
+            ],
+            structured=structured,
+            max_concurrency=EnvVariable.EVALUATE_BATCH_CONCURRENCY.value
+        )
+    except Exception as e:
+        return error(str(e), 500)
+
+    # Results in request order, with an error for unknown test questions and failed evaluations
+    evaluations = iter(evaluations)
+    results = []
+    for item in items:
+        if item["test_question_id"] in test_items:
+            results.append({"test_question_id": item["test_question_id"], **next(evaluations)})
+        else:
+            results.append({"test_question_id": item["test_question_id"], "error": "Test question not found"})
+    return JSONResponse({"results": results})
+
+
+# Endpoint to inspect the embedding cache hit/miss counters
+@app.get('/embedding-cache/')
+async def embedding_cache_stats():
+    return JSONResponse(get_embeddings().stats())
+
+
+# Endpoint to inspect the semantic cache of /query/ responses with the default retrieval settings, for a comma-separated list of namespaces
+@app.get('/semantic-cache/')
+async def semantic_cache_stats(namespace: str = ""):
+    try:
+        namespaces = validate_namespaces([n for n in namespace.split(",") if n] or None)
+    except ValueError as e:
+        return error(str(e), 400)
+    return JSONResponse(get_semantic_cache(namespaces).stats())
+
+
+# Prometheus scrape endpoint: stage durations, LLM calls and tokens, embedding batch sizes, requests
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
+# Endpoint to inspect the namespace indexes and which ones are loaded in memory
+@app.get('/namespaces/')
+async def namespace_stats():
+    return JSONResponse(indexes.stats())
+
+
+@app.get('/')
+async def health_check():
+    return PlainTextResponse("Hello, ASGI!")
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, port=5000)
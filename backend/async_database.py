@@ -0,0 +1,190 @@
+# async_database.py
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from database import CONNECTION_PRAGMAS, GROUP_COMMIT_INTERVAL, GROUP_COMMIT_MAX_BATCH, job_from_row, test_item_from_row
+
+
+class AsyncGroupCommitWriter:
+    """
+    asyncio version of `database.GroupCommitWriter`: the inserts of concurrent requests
+    are committed together, each caller awaiting the commit of its row.
+    """
+
+    def __init__(self, database, sql, interval=GROUP_COMMIT_INTERVAL, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.database = database
+        self.sql = sql
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def write(self, params):
+        """Queue one row and wait until the transaction holding it is committed."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((params, future))
+        await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a first row, then give concurrent requests a moment to add theirs
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                async with self.database.connection() as db:
+                    await db.executemany(self.sql, [params for params, _ in batch])
+                    await db.commit()
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class AsyncDatabase:
+    """
+    The queries of `database.Database` served by the ASGI app, on a pool of aiosqlite
+    connections: each runs in its own thread, so requests await SQLite without holding one.
+
+    The schema is created by `Database.init_db`, and the ingestion jobs keep writing
+    through `Database` in their worker threads.
+    """
+
+    def __init__(self, database_name='test_questions.db', pool_size=16, acquire_timeout=30):
+        self.database_name = database_name
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._slots = None
+        self._test_question_writer = None
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.database_name, timeout=30, cached_statements=256)
+        db.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    @asynccontextmanager
+    async def connection(self):
+        """Use a pooled connection, the pool is opened on first use."""
+        db = await self.acquire()
+        try:
+            yield db
+        finally:
+            await self.release(db)
+
+    async def acquire(self):
+        """
+        Take a connection from the pool, waiting up to `acquire_timeout` seconds if
+        `pool_size` connections are in use. Raises TimeoutError if none was returned by then.
+        """
+        if self._slots is None:
+            self._slots = asyncio.BoundedSemaphore(self.pool_size)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"No database connection free after {self.acquire_timeout}s, all {self.pool_size} are in use"
+            ) from None
+        if self._idle:
+            return self._idle.pop()
+        try:
+            return await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    async def release(self, db):
+        """Give a connection back to the pool."""
+        if db.in_transaction:
+            await db.rollback()
+        self._idle.append(db)
+        self._slots.release()
+
+    async def close(self):
+        """Close the idle connections, called when the app shuts down."""
+        if self._test_question_writer is not None:
+            await self._test_question_writer.close()
+        while self._idle:
+            await self._idle.pop().close()
+
+    async def save_test_question(self, id, question, answer):
+        """Save a test question and answer, committed together with concurrent saves."""
+        if self._test_question_writer is None:
+            self._test_question_writer = AsyncGroupCommitWriter(self, '''
+                INSERT INTO TestQuestions (id, test_question, test_answer)
+                VALUES (?, ?, ?)
+            ''')
+        await self._test_question_writer.write((id, question, answer))
+        return id
+
+    async def get_test_item(self, test_question_id):
+        """Retrieve the test question and its answer by test_question_id."""
+        async with self.connection() as db:
+            async with db.execute(
+                'SELECT test_question, test_answer FROM TestQuestions WHERE id = ?', (test_question_id,)
+            ) as cursor:
+                return test_item_from_row(await cursor.fetchone())
+
+    async def get_test_items(self, test_question_ids):
+        """Retrieve many test questions and answers at once, as a dict keyed by test_question_id."""
+        items = {}
+        unique_ids = list(dict.fromkeys(test_question_ids))
+        async with self.connection() as db:
+            # SQLite limits the number of host parameters in one statement
+            for start in range(0, len(unique_ids), 500):
+                batch = unique_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                async with db.execute(
+                    f'SELECT id, test_question, test_answer FROM TestQuestions WHERE id IN ({placeholders})', batch
+                ) as cursor:
+                    for row in await cursor.fetchall():
+                        items[row["id"]] = test_item_from_row(row)
+        return items
+
+    async def get_job(self, job_id):
+        """Retrieve an ingestion job by id, or None if it doesn't exist."""
+        async with self.connection() as db:
+            async with db.execute('SELECT * FROM IngestionJobs WHERE id = ?', (job_id,)) as cursor:
+                return job_from_row(await cursor.fetchone())
+
+
+    async def get_known_documents(self, content_hashes, namespace='default'):
+        """The hashes, out of `content_hashes`, of the documents already ingested in a namespace."""
+        known = []
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        async with self.connection() as db:
+            # SQLite limits the number of host parameters in one statement
+            for start in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                async with db.execute(
+                    f'SELECT content_hash FROM Documents WHERE namespace = ? AND content_hash IN ({placeholders})',
+                    (namespace, *batch)
+                ) as cursor:
+                    known.extend(row["content_hash"] for row in await cursor.fetchall())
+        return known
@@ -0,0 +1,191 @@
+# chunk_store.py
+
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping
+from urllib.parse import quote
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+# SQLite limits the number of host parameters in one statement
+LOOKUP_BATCH_SIZE = 500
+
+# BM25 full-text index of the chunk texts. It reads the text from the Chunks table
+# (external content) and is kept up to date by triggers, so every insert and delete
+# of a chunk updates it incrementally. '_' is part of words, to keep identifiers whole.
+TEXT_INDEX_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS ChunksText USING fts5("
+    "content, content='Chunks', content_rowid='rowid', tokenize=\"unicode61 tokenchars '_'\")",
+    "CREATE TRIGGER IF NOT EXISTS ChunksTextInsert AFTER INSERT ON Chunks BEGIN "
+    "INSERT INTO ChunksText (rowid, content) VALUES (new.rowid, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS ChunksTextDelete AFTER DELETE ON Chunks BEGIN "
+    "INSERT INTO ChunksText (ChunksText, rowid, content) VALUES ('delete', old.rowid, old.content); END",
+]
+
+
+def connect(path, read_only=False):
+    """
+    Open a chunk database. Read-only connections use SQLite's `immutable` mode: no locks
+    and no journal files, and the file can be unlinked while it is open.
+    """
+    if read_only:
+        connection = sqlite3.connect(f"file:{quote(path)}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+    else:
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS Chunks ("
+            "id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS Positions (position INTEGER PRIMARY KEY, id TEXT NOT NULL)")
+        for statement in TEXT_INDEX_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+    return connection
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """
+    Docstore of the FAISS vector store kept in a SQLite file next to the index.
+
+    Unlike the pickled InMemoryDocstore nothing is loaded up front: chunks are read by id
+    when a search returns them, and the pages of the file are shared between processes
+    through the OS page cache. The FAISS position -> chunk id mapping lives in the same
+    file (see `IndexToDocstoreId`).
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._connection = connect(path, read_only=read_only)
+        self._lock = threading.Lock()
+
+    def search(self, search):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content, metadata FROM Chunks WHERE id = ?", (search,)
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def add(self, texts):
+        with self._lock, self._connection:
+            existing = self._existing_ids(list(texts))
+            if existing:
+                raise ValueError(f"Tried to add ids that already exist: {existing}")
+            self._connection.executemany(
+                "INSERT INTO Chunks (id, content, metadata) VALUES (?, ?, ?)",
+                [(id_, doc.page_content, json.dumps(doc.metadata)) for id_, doc in texts.items()],
+            )
+
+    def delete(self, ids):
+        with self._lock, self._connection:
+            missing = set(ids) - self._existing_ids(list(ids))
+            if missing:
+                raise ValueError(f"Tried to delete ids that does not exist: {missing}")
+            self._connection.executemany("DELETE FROM Chunks WHERE id = ?", [(id_,) for id_ in ids])
+
+    def existing_ids(self, ids):
+        """The ids, out of `ids`, of the chunks stored here."""
+        with self._lock:
+            return self._existing_ids(list(ids))
+
+    def ordered_chunks(self):
+        """The chunks of every position of the FAISS index, in position order."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT Chunks.id, Chunks.content, Chunks.metadata "
+                "FROM Positions JOIN Chunks ON Chunks.id = Positions.id ORDER BY Positions.position"
+            ).fetchall()
+        return [Document(id=id_, page_content=content, metadata=json.loads(metadata)) for id_, content, metadata in rows]
+
+    def search_positions(self, positions):
+        """The chunks at positions of the FAISS index, in the same order, in one query."""
+        positions = [int(position) for position in positions]
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT Positions.position, Chunks.id, Chunks.content, Chunks.metadata "
+                "FROM Positions JOIN Chunks ON Chunks.id = Positions.id "
+                f"WHERE Positions.position IN ({','.join('?' * len(positions))})",
+                positions,
+            ).fetchall()
+        documents = {
+            position: Document(id=id_, page_content=content, metadata=json.loads(metadata))
+            for position, id_, content, metadata in rows
+        }
+        return [documents[position] for position in positions]
+
+    def search_text(self, expression, limit=20):
+        """
+        BM25 search of the chunks matching an FTS5 query expression.
+
+        Returns:
+            list[tuple[Document, float]]: The best `limit` chunks and their score, higher is better.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT Chunks.id, Chunks.content, Chunks.metadata, bm25(ChunksText) AS rank "
+                "FROM ChunksText JOIN Chunks ON Chunks.rowid = ChunksText.rowid "
+                "WHERE ChunksText MATCH ? ORDER BY rank LIMIT ?",
+                (expression, limit),
+            ).fetchall()
+        # bm25() is negative, the more negative the better the match
+        return [
+            (Document(id=id_, page_content=content, metadata=json.loads(metadata)), -rank)
+            for id_, content, metadata, rank in rows
+        ]
+
+    def _existing_ids(self, ids):
+        existing = set()
+        for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            batch = ids[start:start + LOOKUP_BATCH_SIZE]
+            rows = self._connection.execute(
+                f"SELECT id FROM Chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+            )
+            existing.update(row[0] for row in rows)
+        return existing
+
+    def load_positions(self):
+        """The whole FAISS position -> chunk id mapping, as the dict writers modify."""
+        with self._lock:
+            return dict(self._connection.execute("SELECT position, id FROM Positions"))
+
+    def save_positions(self, index_to_docstore_id):
+        """Replace the stored FAISS position -> chunk id mapping."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM Positions")
+            self._connection.executemany(
+                "INSERT INTO Positions (position, id) VALUES (?, ?)", index_to_docstore_id.items()
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class IndexToDocstoreId(Mapping):
+    """
+    Read-only FAISS position -> chunk id mapping of a `SQLiteDocstore`, looked up on demand
+    instead of being loaded in a dict.
+    """
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+
+    def _execute(self, sql, params=()):
+        with self.docstore._lock:
+            return self.docstore._connection.execute(sql, params).fetchall()
+
+    def __getitem__(self, position):
+        rows = self._execute("SELECT id FROM Positions WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM Positions")[0][0]
+
+    def __iter__(self):
+        return (row[0] for row in self._execute("SELECT position FROM Positions ORDER BY position"))
@@ -0,0 +1,166 @@
+# chunking.py
+
+import hashlib
+import logging
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+DEDUP_METHODS = ("none", "simhash")
+
+# Split on paragraphs, then lines, then sentences, then words, so only text that doesn't
+# fit otherwise is cut mid-sentence (PDF extraction often yields very long lines)
+SEPARATORS = ["\n\n", "\n", ". ", " ", ""]
+
+# Words and punctuation, counted as tokens when the tiktoken encoding can't be loaded
+FALLBACK_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Numbered headings ("13.3 Store", "Chapter 4 ...") of at most 80 characters, but not the
+# table of contents lines with their dot leaders and page number
+SECTION_PATTERN = re.compile(
+    r"^[ \t]*((?:\d+(?:\.\d+)*\.?|Chapter \d+|Part [IVX\d]+)[ \t]+[A-Za-z].{0,72}?)[ \t]*$",
+    re.MULTILINE,
+)
+TOC_LEADER = re.compile(r"(?:\. ){3}")
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(encoding_name):
+    """
+    Token count function of a tiktoken encoding.
+
+    tiktoken downloads its encodings on first use; without network access (and no
+    TIKTOKEN_CACHE_DIR) the count falls back to words and punctuation, which is close
+    to the BPE count for English text.
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning("Can't load the tiktoken encoding %s (%s), counting words instead", encoding_name, e)
+        return lambda text: len(FALLBACK_TOKEN_PATTERN.findall(text))
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def simhash(text):
+    """64-bit SimHash of the word 3-shingles of a text: near-identical texts differ in few bits."""
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles)
+    # One row of 64 bits per shingle, each bit of the SimHash is the majority vote of its column
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+
+class NearDuplicateIndex:
+    """
+    SimHashes of the chunks seen so far, to find those within `max_distance` bits of a new one.
+
+    The hashes are split into max_distance + 1 bands: two hashes that close agree on at
+    least one whole band, so only the hashes sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.band_count = max_distance + 1
+        self.band_width = SIMHASH_BITS // self.band_count
+        self._bands = {}  # (band number, band value) -> hashes
+
+    def _band_keys(self, value):
+        mask = (1 << self.band_width) - 1
+        return [(band, value >> (band * self.band_width) & mask) for band in range(self.band_count)]
+
+    def add_if_new(self, text):
+        """Remember a text, unless a near-duplicate of it was seen already. Returns whether it was new."""
+        value = simhash(text)
+        keys = self._band_keys(value)
+        for key in keys:
+            for other in self._bands.get(key, ()):
+                if (value ^ other).bit_count() <= self.max_distance:
+                    return False
+        for key in keys:
+            self._bands.setdefault(key, []).append(value)
+        return True
+
+
+class Chunker:
+    """
+    Split documents page by page, as they are parsed, into chunks of at most `chunk_tokens` tokens.
+
+    Consecutive chunks of a page share up to `overlap_tokens` tokens. Every chunk records
+    its page and the section (last numbered heading) it starts in, carried over from the
+    previous pages of its document. With dedup="simhash", chunks that are near-duplicates
+    of a chunk already produced by this chunker (repeated boilerplate, copied paragraphs)
+    are left out.
+    """
+
+    def __init__(self, chunk_tokens=256, overlap_tokens=32, dedup="simhash", dedup_distance=3,
+                 encoding_name="cl100k_base"):
+        if dedup not in DEDUP_METHODS:
+            raise ValueError(f"Unknown dedup method {dedup!r}, expected one of {DEDUP_METHODS}")
+        self.count_tokens = get_token_counter(encoding_name)
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_tokens,
+            chunk_overlap=overlap_tokens,
+            length_function=self.count_tokens,
+            separators=SEPARATORS,
+            keep_separator="end",
+            add_start_index=True,
+        )
+        self.duplicates = NearDuplicateIndex(dedup_distance) if dedup == "simhash" else None
+        self.duplicate_count = 0
+        self._sections = {}  # source -> current section
+
+    def scan_sections(self, text, source=None):
+        """
+        Headings of a page as (offset, title), and move the current section of `source` past them.
+        Called directly for pages whose chunks are reused, so later pages get the right section.
+        """
+        headings = [
+            (match.start(1), match.group(1))
+            for match in SECTION_PATTERN.finditer(text)
+            if not TOC_LEADER.search(match.group(1))
+        ]
+        if headings:
+            self._sections[source] = headings[-1][1]
+        return headings
+
+    def split_page(self, text, source=None, page=None):
+        """
+        Chunks of one page, in order, without the near-duplicates.
+
+        Returns:
+            list[tuple[str, dict]]: (chunk text, metadata) pairs. The metadata holds the
+                source, page, section and token count of the chunk.
+        """
+        section = self._sections.get(source)
+        headings = self.scan_sections(text, source)
+        chunks = []
+        for document in self.splitter.create_documents([text]):
+            start = document.metadata["start_index"]
+            chunk_section = section
+            for offset, title in headings:
+                if offset > start:
+                    break
+                chunk_section = title
+            if self.duplicates is not None and not self.duplicates.add_if_new(document.page_content):
+                self.duplicate_count += 1
+                continue
+            chunks.append((document.page_content, {
+                "source": source,
+                "page": page,
+                "section": chunk_section,
+                "tokens": self.count_tokens(document.page_content),
+            }))
+        return chunks
@@ -0,0 +1,92 @@
+# context_budget.py
+
+import math
+import re
+
+from retrieval import TERM_PATTERN, query_terms
+
+# Sentence ends, once the line breaks of the PDF text are collapsed
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# Separator between the chunks of a compressed context
+CHUNK_SEPARATOR = "\n\n"
+
+
+def split_sentences(text):
+    """Sentences of a chunk, with the line breaks of the extracted PDF text collapsed."""
+    return [sentence for sentence in SENTENCE_END.split(" ".join(text.split())) if sentence]
+
+
+def score_sentences(sentences, terms):
+    """
+    Relevance of each sentence to the question terms: the sum of the IDF, over the
+    retrieved sentences, of the terms it contains. Rare terms of the question count
+    most, terms found in every sentence hardly count.
+    """
+    words = [set(TERM_PATTERN.findall(sentence.lower())) for sentence in sentences]
+    scores = [0.0] * len(sentences)
+    for term in terms:
+        matches = [i for i, sentence_words in enumerate(words) if term in sentence_words]
+        if not matches:
+            continue
+        idf = math.log(1 + len(sentences) / len(matches))
+        for i in matches:
+            scores[i] += idf
+    return scores
+
+
+def compress_context(question, documents, budget, count_tokens):
+    """
+    Trim retrieved chunks to the sentences most relevant to the question, within `budget` tokens.
+
+    Sentences are taken by decreasing score, ties going to the better ranked chunk, then
+    the sentence following each one is added back while the budget allows, so a hit
+    keeps the sentence that completes it. Sentences stay in their original order. When
+    no sentence contains a question term the leading sentences are kept instead.
+
+    Args:
+        documents (list[Document]): The retrieved chunks, best first.
+        budget (int): Maximum tokens of the result, 0 to keep every sentence.
+        count_tokens (callable): Token count of a text, see `chunking.get_token_counter`.
+
+    Returns:
+        str: The kept sentences, chunk by chunk.
+    """
+    sentences = []  # (chunk rank, sentence position, text)
+    for rank, document in enumerate(documents):
+        sentences.extend((rank, position, text) for position, text in enumerate(split_sentences(document.page_content)))
+    if not budget:
+        return render(sentences)
+
+    scores = score_sentences([text for _, _, text in sentences], query_terms(question))
+    if any(scores):
+        order = sorted(
+            (i for i, score in enumerate(scores) if score > 0),
+            key=lambda i: (-scores[i], sentences[i][0], sentences[i][1]),
+        )
+    else:
+        order = list(range(len(sentences)))
+
+    kept = set()
+    used = 0
+    for i in order:
+        tokens = count_tokens(sentences[i][2])
+        if used + tokens <= budget:
+            kept.add(i)
+            used += tokens
+    for i in sorted(kept):
+        following = i + 1
+        if following < len(sentences) and following not in kept and sentences[following][0] == sentences[i][0]:
+            tokens = count_tokens(sentences[following][2])
+            if used + tokens <= budget:
+                kept.add(following)
+                used += tokens
+    return render([sentences[i] for i in sorted(kept)])
+
+
+def render(sentences):
+    """Join (chunk rank, position, text) sentences, one paragraph per chunk."""
+    chunks = {}
+    for rank, _, text in sentences:
+        chunks.setdefault(rank, []).append(text)
+    return CHUNK_SEPARATOR.join(" ".join(texts) for _, texts in sorted(chunks.items()))
@@ -1,15 +1,156 @@
 # database.py
 
+import json
+import time
+import queue
 import sqlite3
-from flask import g
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from flask import g, has_app_context
+
+# Pragmas applied to every pooled connection
+CONNECTION_PRAGMAS = (
+    # Readers don't block the writer and vice versa
+    'PRAGMA journal_mode=WAL',
+    # Safe with WAL, fsyncs at checkpoints instead of on every commit
+    'PRAGMA synchronous=NORMAL',
+    # 16 MB of page cache per connection
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# How long the group-commit writer waits for more inserts before committing a batch
+GROUP_COMMIT_INTERVAL = 0.005
+GROUP_COMMIT_MAX_BATCH = 256
+
+class GroupCommitWriter:
+    """
+    Batches the inserts of concurrent requests into a single transaction.
+
+    Callers block until their row is committed, so a saved test question can be
+    evaluated straight away, but N concurrent requests pay for one commit instead of N.
+    """
+
+    def __init__(self, database, sql, interval=GROUP_COMMIT_INTERVAL, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.database = database
+        self.sql = sql
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def write(self, params):
+        """Queue one row and wait until the transaction holding it is committed."""
+        future = Future()
+        self._queue.put((params, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            # Wait for a first row, then give concurrent requests a moment to add theirs
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                with self.database.connection() as db:
+                    with db:
+                        db.executemany(self.sql, [params for params, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+def test_item_from_row(row):
+    """The test question and answer of a TestQuestions row, None if there is no row."""
+    if row is None:
+        return None
+    return {"test_question": row["test_question"], "test_answer": row["test_answer"]}
+
+def job_from_row(row):
+    """Convert an IngestionJobs row into a dict with the documents decoded."""
+    if row is None:
+        return None
+    job = dict(row)
+    # Which server process runs the job is of no use to clients
+    job.pop("owner", None)
+    job["index_merged"] = bool(job["index_merged"])
+    job["documents"] = json.loads(job["documents"]) if job["documents"] else []
+    return job
 
 class Database:
-    def __init__(self, database_name='test_questions.db'):
+    def __init__(self, database_name='test_questions.db', pool_size=16, acquire_timeout=30):
         self.database_name = database_name
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        # Idle connections, and a bound on how many can be open at once
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._test_question_writer = None
+        self._writer_lock = threading.Lock()
+        # Connection of the current thread outside of Flask requests, see `scope`
+        self._local = threading.local()
+
+    def _connect(self):
+        """Open a new connection. Compiled statements are cached per connection and reused."""
+        db = sqlite3.connect(
+            self.database_name, timeout=30, check_same_thread=False, cached_statements=256
+        )
+        db.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def acquire(self):
+        """
+        Take a connection from the pool, waiting up to `acquire_timeout` seconds if
+        `pool_size` connections are in use. Raises TimeoutError if none was returned by then.
+        """
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(
+                f"No database connection free after {self.acquire_timeout}s, all {self.pool_size} are in use"
+            )
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, db):
+        """Give a connection back to the pool."""
+        if db.in_transaction:
+            db.rollback()
+        self._idle.put(db)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Use a pooled connection outside of a Flask request."""
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
 
     def init_db(self):
-        """Initialize the database and create the TestQuestions table."""
-        with self.get_db() as db:
+        """Create the TestQuestions, Documents, IngestionJobs and QuestionBank tables. Called once at startup."""
+        with self.connection() as db:
             cursor = db.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS TestQuestions (
@@ -18,62 +159,329 @@ class Database:
                     test_answer TEXT NOT NULL
                 )
             ''')
+            # Manifest of ingested documents, keyed by namespace and the hash of the file content
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS Documents (
+                    namespace TEXT NOT NULL DEFAULT 'default',
+                    content_hash TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    page_count INTEGER NOT NULL,
+                    page_hashes TEXT NOT NULL,
+                    chunk_ids TEXT NOT NULL,
+                    ingested_at TEXT NOT NULL,
+                    PRIMARY KEY (namespace, content_hash)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_namespace_source ON Documents (namespace, source)')
+            # Background ingestion jobs started by /upload/
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS IngestionJobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    pages_parsed INTEGER NOT NULL DEFAULT 0,
+                    chunks_total INTEGER NOT NULL DEFAULT 0,
+                    chunks_embedded INTEGER NOT NULL DEFAULT 0,
+                    index_merged INTEGER NOT NULL DEFAULT 0,
+                    index_version INTEGER,
+                    documents TEXT,
+                    error TEXT,
+                    question_bank TEXT,
+                    questions_generated INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            # Chunks each pre-made test question was generated from, see helper.build_question_bank.
+            # The questions themselves are TestQuestions rows, so /evaluate/ reads them like any other
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS QuestionBank (
+                    chunk_id TEXT NOT NULL,
+                    test_question_id TEXT NOT NULL,
+                    namespace TEXT NOT NULL,
+                    PRIMARY KEY (chunk_id, test_question_id)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_question_bank_namespace ON QuestionBank (namespace)')
             db.commit()
 
+    @contextmanager
+    def scope(self):
+        """
+        Hold one pooled connection for the methods called by this thread in the block, like
+        a Flask request does. Used by the ingestion workers and the ASGI app.
+        """
+        if getattr(self._local, 'db', None) is not None:
+            yield
+            return
+        self._local.db = self.acquire()
+        try:
+            yield
+        finally:
+            db, self._local.db = self._local.db, None
+            self.release(db)
+
     def get_db(self):
-        """Get a database connection, maintaining a persistent connection for the duration of a request."""
+        """Get a pooled database connection, held for the duration of a request or `scope`."""
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            return db
+        if not has_app_context():
+            raise RuntimeError("Database used outside of a Flask request or Database.scope()")
         if 'db' not in g:
-            g.db = sqlite3.connect(self.database_name)
-            g.db.row_factory = sqlite3.Row 
+            g.db = self.acquire()
         return g.db
 
     def close_db(self):
-        """Close the database connection."""
+        """Return the request's database connection to the pool."""
         db = g.pop('db', None)
         if db is not None:
-            db.close()
+            self.release(db)
 
     def save_test_question(self, id, question, answer):
-        """Save a test question and answer in the database."""
-        db = self.get_db()
-        cursor = db.cursor()
+        """Save a test question and answer in the database, committed together with concurrent saves."""
+        if self._test_question_writer is None:
+            with self._writer_lock:
+                if self._test_question_writer is None:
+                    self._test_question_writer = GroupCommitWriter(self, '''
+                        INSERT INTO TestQuestions (id, test_question, test_answer)
+                        VALUES (?, ?, ?)
+                    ''')
 
-        # Insert test question and answer into the table
-        cursor.execute('''
-            INSERT INTO TestQuestions (id, test_question, test_answer)
-            VALUES (?, ?, ?)
-        ''', (id, question, answer))
-        
-        # Commit the transaction
-        db.commit()
+        # Insert test question and answer into the table, returns once committed
+        self._test_question_writer.write((id, question, answer))
 
         # Return the inserted test question ID
         return id
 
-    def get_test_answer(self, test_question_id):
-        """Retrieve the test answer by test_question_id."""
+    def get_test_item(self, test_question_id):
+        """Retrieve the test question and its answer by test_question_id in one query."""
         db = self.get_db()
         cursor = db.cursor()
-        
-        # Execute the query to fetch the test answer
-        cursor.execute('SELECT test_answer FROM TestQuestions WHERE id = ?', (test_question_id,))
-        result = cursor.fetchone()
-        
-        # Return the test_answer, or None if not found
-        if result:
-            return result["test_answer"]  # Fetch as dict if using `row_factory`
+        cursor.execute(
+            'SELECT test_question, test_answer FROM TestQuestions WHERE id = ?', (test_question_id,)
+        )
+
+        # Return both fields, or None if not found
+        return test_item_from_row(cursor.fetchone())
+
+    def get_test_items(self, test_question_ids):
+        """Retrieve many test questions and answers at once, as a dict keyed by test_question_id."""
+        db = self.get_db()
+        items = {}
+        unique_ids = list(dict.fromkeys(test_question_ids))
+        # SQLite limits the number of host parameters in one statement
+        for start in range(0, len(unique_ids), 500):
+            batch = unique_ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = db.execute(
+                f'SELECT id, test_question, test_answer FROM TestQuestions WHERE id IN ({placeholders})', batch
+            ).fetchall()
+            for row in rows:
+                items[row["id"]] = test_item_from_row(row)
+        return items
+
+    def save_bank_questions(self, questions, namespace='default'):
+        """
+        Store pre-made test questions and the chunks they were generated from, in one transaction.
+
+        Args:
+            questions (list[tuple[str, str, str, list[str]]]): (test_question_id, test_question,
+                test_answer, chunk_ids) of each question.
+            namespace (str): Namespace of the chunks.
+        """
+        db = self.get_db()
+        with db:
+            db.executemany(
+                'INSERT INTO TestQuestions (id, test_question, test_answer) VALUES (?, ?, ?)',
+                [(id, question, answer) for id, question, answer, _ in questions]
+            )
+            db.executemany(
+                'INSERT OR IGNORE INTO QuestionBank (chunk_id, test_question_id, namespace) VALUES (?, ?, ?)',
+                [(chunk_id, id, namespace) for id, _, _, chunk_ids in questions for chunk_id in chunk_ids]
+            )
+
+    def find_bank_question(self, chunk_ids):
+        """
+        The pre-made test question of the first of `chunk_ids` that has one, None if none has.
+
+        Runs on its own pooled connection, it's called from the query chains.
+        """
+        if not chunk_ids:
+            return None
+        chunk_ids = chunk_ids[:500]
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self.connection() as db:
+            rows = db.execute(f'''
+                SELECT b.chunk_id, t.id, t.test_question, t.test_answer
+                FROM QuestionBank b JOIN TestQuestions t ON t.id = b.test_question_id
+                WHERE b.chunk_id IN ({placeholders})
+            ''', chunk_ids).fetchall()
+        by_chunk = {row["chunk_id"]: row for row in rows}
+        for chunk_id in chunk_ids:
+            row = by_chunk.get(chunk_id)
+            if row is not None:
+                return {"test_question_id": row["id"], **test_item_from_row(row)}
         return None
 
-    def get_test_question(self, test_question_id):
-        """Retrieve the test question by test_question_id."""
+    def delete_bank_questions(self, namespace='default', chunk_ids=None):
+        """
+        Unlink the pre-made questions of removed chunks, or of every chunk of a namespace.
+        The TestQuestions rows stay, students may still be answering them.
+        """
+        db = self.get_db()
+        if chunk_ids is None:
+            db.execute('DELETE FROM QuestionBank WHERE namespace = ?', (namespace,))
+        else:
+            chunk_ids = list(chunk_ids)
+            for start in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[start:start + 500]
+                db.execute(
+                    f'DELETE FROM QuestionBank WHERE chunk_id IN ({",".join("?" * len(batch))})', batch
+                )
+        db.commit()
+
+    def _document_from_row(self, row):
+        """Convert a Documents row into a dict with the JSON columns decoded."""
+        if row is None:
+            return None
+        document = dict(row)
+        document["page_hashes"] = json.loads(document["page_hashes"])
+        document["chunk_ids"] = json.loads(document["chunk_ids"])
+        return document
+
+    def get_document(self, content_hash, namespace='default'):
+        """Retrieve the manifest entry of a document ingested in a namespace by its content hash."""
         db = self.get_db()
         cursor = db.cursor()
-        
-        # Execute the query to fetch the test answer
-        cursor.execute('SELECT test_question FROM TestQuestions WHERE id = ?', (test_question_id,))
-        result = cursor.fetchone()
-        
-        # Return the test_answer, or None if not found
-        if result:
-            return result["test_question"]  # Fetch as dict if using `row_factory`
-        return None
+        cursor.execute(
+            'SELECT * FROM Documents WHERE namespace = ? AND content_hash = ?',
+            (namespace, content_hash)
+        )
+        return self._document_from_row(cursor.fetchone())
+
+    def get_known_documents(self, content_hashes, namespace='default'):
+        """The hashes, out of `content_hashes`, of the documents already ingested in a namespace."""
+        db = self.get_db()
+        known = []
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        # SQLite limits the number of host parameters in one statement
+        for start in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = db.execute(
+                f'SELECT content_hash FROM Documents WHERE namespace = ? AND content_hash IN ({placeholders})',
+                (namespace, *batch)
+            ).fetchall()
+            known.extend(row["content_hash"] for row in rows)
+        return known
+
+    def get_document_by_source(self, source, namespace='default'):
+        """Retrieve the most recently ingested version of a document by its file name or path."""
+        db = self.get_db()
+        cursor = db.cursor()
+        cursor.execute(
+            'SELECT * FROM Documents WHERE namespace = ? AND source = ? ORDER BY ingested_at DESC LIMIT 1',
+            (namespace, source)
+        )
+        return self._document_from_row(cursor.fetchone())
+
+    def save_document(self, content_hash, source, page_hashes, chunk_ids, replaces=None, namespace='default'):
+        """
+        Record an ingested document in the manifest.
+
+        Args:
+            content_hash (str): SHA-256 of the file content.
+            source (str): File name or path the document was uploaded from.
+            page_hashes (list[str]): SHA-256 of the text of each page.
+            chunk_ids (list[list[str]]): Ids of the index chunks created from each page.
+            replaces (str, optional): Content hash of a previous version of the document to drop.
+            namespace (str): Namespace the document was ingested in.
+        """
+        db = self.get_db()
+        cursor = db.cursor()
+
+        if replaces:
+            cursor.execute('DELETE FROM Documents WHERE namespace = ? AND content_hash = ?', (namespace, replaces))
+        cursor.execute('''
+            INSERT OR REPLACE INTO Documents (namespace, content_hash, source, page_count, page_hashes, chunk_ids, ingested_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            namespace,
+            content_hash,
+            source,
+            len(page_hashes),
+            json.dumps(page_hashes),
+            json.dumps(chunk_ids),
+            datetime.now(timezone.utc).isoformat()
+        ))
+        db.commit()
+        return content_hash
+
+    def clear_documents(self, namespace='default'):
+        """Forget every document ingested in a namespace, used when its index is rebuilt from scratch."""
+        db = self.get_db()
+        db.execute('DELETE FROM Documents WHERE namespace = ?', (namespace,))
+        db.commit()
+
+    def create_job(self, job_id, owner=None):
+        """Record a new ingestion job in the 'queued' state, run by the process `owner`."""
+        db = self.get_db()
+        now = datetime.now(timezone.utc).isoformat()
+        db.execute('''
+            INSERT INTO IngestionJobs (id, status, stage, owner, created_at, updated_at)
+            VALUES (?, 'queued', 'queued', ?, ?, ?)
+        ''', (job_id, owner, now, now))
+        db.commit()
+        return job_id
+
+    def update_job(self, job_id, **fields):
+        """
+        Update the status or progress counters of an ingestion job.
+
+        Args:
+            job_id (str): Id of the job.
+            **fields: Columns of IngestionJobs to set. `documents` is stored as JSON.
+        """
+        if 'documents' in fields:
+            fields['documents'] = json.dumps(fields['documents'])
+        fields['updated_at'] = datetime.now(timezone.utc).isoformat()
+
+        db = self.get_db()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        db.execute(f'UPDATE IngestionJobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+        db.commit()
+
+    def get_job(self, job_id):
+        """Retrieve an ingestion job by id, or None if it doesn't exist."""
+        db = self.get_db()
+        cursor = db.cursor()
+        cursor.execute('SELECT * FROM IngestionJobs WHERE id = ?', (job_id,))
+        return job_from_row(cursor.fetchone())
+
+    def get_unfinished_job_owners(self):
+        """The processes that own queued or running jobs, or question banks."""
+        db = self.get_db()
+        rows = db.execute('''
+            SELECT DISTINCT owner FROM IngestionJobs
+            WHERE owner IS NOT NULL AND (status IN ('queued', 'running') OR question_bank IN ('queued', 'running'))
+        ''').fetchall()
+        return [row["owner"] for row in rows]
+
+    def fail_unfinished_jobs(self, owners):
+        """Mark the jobs, and question banks, the processes `owners` left queued or running as failed."""
+        if not owners:
+            return
+        db = self.get_db()
+        now = datetime.now(timezone.utc).isoformat()
+        placeholders = ",".join("?" * len(owners))
+        db.execute(f'''
+            UPDATE IngestionJobs SET status = 'failed', error = 'Interrupted by a server restart', updated_at = ?
+            WHERE status IN ('queued', 'running') AND owner IN ({placeholders})
+        ''', (now, *owners))
+        db.execute(f'''
+            UPDATE IngestionJobs SET question_bank = 'failed', error = 'Interrupted by a server restart', updated_at = ?
+            WHERE question_bank IN ('queued', 'running') AND owner IN ({placeholders})
+        ''', (now, *owners))
+        db.commit()
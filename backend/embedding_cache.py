@@ -0,0 +1,165 @@
+# embedding_cache.py
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+# SQLite limits the number of host parameters in one statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def embedding_model_id(embeddings):
+    """Build an identifier for an embedding model so vectors of different models never mix."""
+    # Wrappers like provider_client.BatchingEmbeddings don't change the vectors
+    embeddings = getattr(embeddings, "provider", embeddings)
+    model_name = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    return f"{type(embeddings).__name__}:{model_name}"
+
+
+def text_hash(text):
+    """Content address of a chunk of text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with a persistent cache keyed by (model id, SHA-256 of the text).
+
+    Vectors are stored as float32 blobs in SQLite. Only texts that are not in the cache are
+    sent to the underlying model, and the least recently used entries are evicted once
+    the cache holds more than `max_entries` vectors.
+
+    Question embeddings are kept in a separate in-memory LRU of `query_max_entries`
+    entries, so a repeated question doesn't call the model again.
+    """
+
+    def __init__(self, embeddings, cache_path, max_entries=200000, query_max_entries=1024):
+        self.embeddings = embeddings
+        self.model_id = embedding_model_id(embeddings)
+        self.max_entries = max_entries
+        self.query_max_entries = query_max_entries
+        self.hits = 0
+        self.misses = 0
+        self.query_hits = 0
+        self.query_misses = 0
+        self._queries = OrderedDict()  # question -> vector, least recently used first
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS Embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON Embeddings (last_used)')
+        self._conn.commit()
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM Embeddings').fetchone()[0]
+
+    def _lookup(self, hashes):
+        """Fetch cached vectors for the given hashes and mark them as recently used."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT hash, vector FROM Embeddings WHERE model = ? AND hash IN ({placeholders})',
+                    (self.model_id, *batch),
+                ).fetchall()
+                for hash_, blob in rows:
+                    found[hash_] = array("f", blob).tolist()
+
+            if found:
+                self._conn.executemany(
+                    'UPDATE Embeddings SET last_used = ? WHERE model = ? AND hash = ?',
+                    [(now, self.model_id, hash_) for hash_ in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, vectors_by_hash):
+        """Save new vectors and evict the least recently used ones above `max_entries`."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.executemany(
+                'INSERT OR IGNORE INTO Embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)',
+                [
+                    (self.model_id, hash_, array("f", vector).tobytes(), now)
+                    for hash_, vector in vectors_by_hash.items()
+                ],
+            )
+            self._entries += cursor.rowcount
+
+            overflow = self._entries - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    'DELETE FROM Embeddings WHERE rowid IN '
+                    '(SELECT rowid FROM Embeddings ORDER BY last_used LIMIT ?)',
+                    (overflow,),
+                )
+                self._entries -= overflow
+            self._conn.commit()
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = self._lookup(list(set(hashes)))
+
+        # Embed each missing text once, even if it appears several times in `texts`
+        missing = {}
+        for hash_, text in zip(hashes, texts):
+            if hash_ not in cached:
+                missing.setdefault(hash_, text)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_by_hash = dict(zip(missing.keys(), new_vectors))
+            self._store(new_by_hash)
+            cached.update(new_by_hash)
+
+        return [cached[hash_] for hash_ in hashes]
+
+    def embed_query(self, text):
+        with self._lock:
+            vector = self._queries.get(text)
+            if vector is not None:
+                self._queries.move_to_end(text)
+                self.query_hits += 1
+                return vector
+            self.query_misses += 1
+
+        vector = self.embeddings.embed_query(text)
+        with self._lock:
+            self._queries[text] = vector
+            while len(self._queries) > self.query_max_entries:
+                self._queries.popitem(last=False)
+        return vector
+
+    def stats(self):
+        """Hit/miss counters since startup and the current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_id,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._entries,
+                "max_entries": self.max_entries,
+                "query_hits": self.query_hits,
+                "query_misses": self.query_misses,
+                "query_entries": len(self._queries),
+            }
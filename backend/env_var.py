@@ -1,14 +1,75 @@
-from enum import Enum
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
-class EnvVariable(Enum):
-    DB_NAME = os.environ.get("DB_NAME")
-    GCP_API_KEY = os.getenv("GCP_API_KEY")
-    GCP_MODEL = os.environ.get("GCP_MODEL")
-    FAISS_PATH = os.environ.get("FAISS_PATH")
-    BACKEND_URL = os.environ.get("BACKEND_URL")
-    OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-    HUGGINFACEHUB_API_TOKEN = os.environ.get("HUGGINFACEHUB_API_TOKEN")
\ No newline at end of file
+class Setting:
+    """
+    One configuration value read from the environment, used as `EnvVariable.NAME.value`.
+
+    Settings are plain attributes, not Enum members: an Enum makes a member with the same
+    value as an earlier one an alias of it, so e.g. PDF_WORKERS=5 would read back as
+    PROVIDER_MAX_RETRIES, or EMBEDDING_BATCH_WINDOW_MS's 5.0.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"<EnvVariable.{self.name}: {self.value!r}>"
+
+class EnvVariable:
+    DB_NAME = Setting(os.environ.get("DB_NAME"))
+    DB_POOL_SIZE = Setting(int(os.environ.get("DB_POOL_SIZE", 16)))
+    DB_ACQUIRE_TIMEOUT = Setting(float(os.environ.get("DB_ACQUIRE_TIMEOUT", 30)))
+    GCP_API_KEY = Setting(os.getenv("GCP_API_KEY"))
+    GCP_MODEL = Setting(os.environ.get("GCP_MODEL"))
+    FAISS_PATH = Setting(os.environ.get("FAISS_PATH"))
+    FAISS_INDEX_TYPE = Setting(os.environ.get("FAISS_INDEX_TYPE", "flat"))
+    FAISS_QUANTIZER = Setting(os.environ.get("FAISS_QUANTIZER", "none"))
+    FAISS_NPROBE = Setting(int(os.environ.get("FAISS_NPROBE", 8)))
+    FAISS_SEGMENT_MERGE_FACTOR = Setting(int(os.environ.get("FAISS_SEGMENT_MERGE_FACTOR", 4)))
+    INDEX_CACHE_MAX_ENTRIES = Setting(int(os.environ.get("INDEX_CACHE_MAX_ENTRIES", 8)))
+    RETRIEVAL_MODE = Setting(os.environ.get("RETRIEVAL_MODE", "vector"))
+    LEXICAL_CONFIDENCE = Setting(float(os.environ.get("LEXICAL_CONFIDENCE", 0.3)))
+    BACKEND_URL = Setting(os.environ.get("BACKEND_URL"))
+    OPENAI_API_KEY = Setting(os.environ.get("OPENAI_API_KEY"))
+    LLM_PROVIDER = Setting(os.environ.get("LLM_PROVIDER", ""))
+    FAKE_LLM_LATENCY = Setting(float(os.environ.get("FAKE_LLM_LATENCY", 0)))
+    FAKE_EMBEDDING_LATENCY = Setting(float(os.environ.get("FAKE_EMBEDDING_LATENCY", 0)))
+    LLM_RATE_LIMIT = Setting(float(os.environ.get("LLM_RATE_LIMIT", 0)))
+    LLM_MAX_CONCURRENCY = Setting(int(os.environ.get("LLM_MAX_CONCURRENCY", 32)))
+    EMBEDDING_RATE_LIMIT = Setting(float(os.environ.get("EMBEDDING_RATE_LIMIT", 0)))
+    EMBEDDING_MAX_CONCURRENCY = Setting(int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 8)))
+    EMBEDDING_BATCH_WINDOW_MS = Setting(float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", 5)))
+    EMBEDDING_MAX_BATCH = Setting(int(os.environ.get("EMBEDDING_MAX_BATCH", 256)))
+    PROVIDER_MAX_RETRIES = Setting(int(os.environ.get("PROVIDER_MAX_RETRIES", 5)))
+    PROVIDER_BACKOFF_BASE = Setting(float(os.environ.get("PROVIDER_BACKOFF_BASE", 0.5)))
+    PROVIDER_BACKOFF_MAX = Setting(float(os.environ.get("PROVIDER_BACKOFF_MAX", 30)))
+    HUGGINFACEHUB_API_TOKEN = Setting(os.environ.get("HUGGINFACEHUB_API_TOKEN"))
+    EMBEDDING_CACHE_PATH = Setting(os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.db"))
+    EMBEDDING_CACHE_MAX_ENTRIES = Setting(int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200000)))
+    QUERY_EMBEDDING_CACHE_MAX_ENTRIES = Setting(int(os.environ.get("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", 1024)))
+    PDF_WORKERS = Setting(int(os.environ.get("PDF_WORKERS", 0)))
+    INGEST_WORKERS = Setting(int(os.environ.get("INGEST_WORKERS", 2)))
+    UPLOAD_DIR = Setting(os.environ.get("UPLOAD_DIR"))
+    CHUNK_TOKENS = Setting(int(os.environ.get("CHUNK_TOKENS", 256)))
+    CHUNK_OVERLAP_TOKENS = Setting(int(os.environ.get("CHUNK_OVERLAP_TOKENS", 32)))
+    CHUNK_DEDUP = Setting(os.environ.get("CHUNK_DEDUP", "simhash"))
+    CHUNK_DEDUP_DISTANCE = Setting(int(os.environ.get("CHUNK_DEDUP_DISTANCE", 3)))
+    TOKENIZER_ENCODING = Setting(os.environ.get("TOKENIZER_ENCODING", "cl100k_base"))
+    CONTEXT_TOKEN_BUDGET = Setting(int(os.environ.get("CONTEXT_TOKEN_BUDGET", 512)))
+    FOLLOW_UP_CONTEXT_TOKENS = Setting(int(os.environ.get("FOLLOW_UP_CONTEXT_TOKENS", 0)))
+    SEMANTIC_CACHE_THRESHOLD = Setting(float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)))
+    SEMANTIC_CACHE_TTL = Setting(int(os.environ.get("SEMANTIC_CACHE_TTL", 3600)))
+    SEMANTIC_CACHE_MAX_ENTRIES = Setting(int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 1000)))
+    QUESTION_BANK = Setting(os.environ.get("QUESTION_BANK", "true").lower() in ("1", "true", "yes"))
+    QUESTION_BANK_GROUP_TOKENS = Setting(int(os.environ.get("QUESTION_BANK_GROUP_TOKENS", 768)))
+    QUESTION_BANK_CONCURRENCY = Setting(int(os.environ.get("QUESTION_BANK_CONCURRENCY", 4)))
+    EVALUATE_BATCH_CONCURRENCY = Setting(int(os.environ.get("EVALUATE_BATCH_CONCURRENCY", 16)))
+    METRICS_SINKS = Setting(os.environ.get("METRICS_SINKS", "prometheus"))
+    METRICS_LOG_THRESHOLD_MS = Setting(float(os.environ.get("METRICS_LOG_THRESHOLD_MS", 1000)))
+    TIMING_HEADER = Setting(os.environ.get("TIMING_HEADER", "false").lower() in ("1", "true", "yes"))
\ No newline at end of file
@@ -0,0 +1,119 @@
+# fake_models.py
+
+import asyncio
+import hashlib
+import json
+import math
+import re
+import time
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+EVALUATION_OPENING = "You are given a question and two answers (one correct and one user's)."
+
+# Opening sentences of the prompt templates of helper.py, whitespace collapsed. Prompts
+# embed documents and answers, so they are told apart by how they start, not by words
+# that may appear anywhere in them. The answer prompt is the default.
+PROMPT_OPENINGS = (
+    (EVALUATION_OPENING + " Determine if the user understands the topic based on their answer, and rate", "structured_evaluation"),
+    (EVALUATION_OPENING + " Determine if the user understands the topic based on their answer.", "evaluation"),
+    (EVALUATION_OPENING + " Rate the user's confidence", "confidence"),
+    ("You are a multi-purpose bot whose job is to generate exam-standard questions.", "test_question"),
+    ("You are a multi-purpose bot whose one job is to engage the user.", "bullet_points"),
+)
+
+
+def prompt_kind(prompt):
+    """Which prompt template of helper.py `prompt` was formatted from, "answer" if none other."""
+    opening = " ".join(prompt.split()[:40])
+    for start, kind in PROMPT_OPENINGS:
+        if opening.startswith(start):
+            return kind
+    return "answer"
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic local stand-in for the chat model, used by the benchmarks.
+
+    It recognises the prompts of helper.py and answers in the format each chain parses,
+    after waiting `latency` seconds like a remote provider would.
+    """
+
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _respond(self, messages):
+        prompt = messages[-1].content
+        question = re.search(r"Question:\s*(.*)", prompt)
+        topic = question.group(1).strip().rstrip("?") if question else "the document"
+
+        kind = prompt_kind(prompt)
+        if kind == "structured_evaluation":
+            return json.dumps({"knowledge_understood": True, "knowledge_confidence": 80})
+        if kind == "evaluation":
+            return "True"
+        if kind == "confidence":
+            return "80"
+        if kind == "test_question":
+            return f"What are the key points of {topic}? They are explained in the provided context."
+        if kind == "bullet_points":
+            return f"- {topic} is covered in the document-\n- The answer summarises it-\n- Read the context for details"
+        return f"Based on the context, {topic} is explained as follows. " + " ".join(WORD_PATTERN.findall(prompt)[-40:])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._respond(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._respond(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        for word in self._respond(messages).split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for the embedding model, used by the benchmarks.
+
+    Texts are embedded as normalised bags of hashed words, so texts sharing words get
+    similar vectors and retrieval behaves roughly like with a real model.
+    """
+
+    def __init__(self, size=256, latency=0.0):
+        self.size = size
+        self.latency = latency
+        self.model = f"fake-{size}"
+
+    def _embed(self, text):
+        vector = [0.0] * self.size
+        for word in WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
@@ -1,18 +1,34 @@
 import os
+import json
+import re
+import asyncio
 import uuid
-import sqlite3
-from PyPDF2 import PdfReader
+import hashlib
+import time
+import shutil
+import threading
+import faiss
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from env_var import EnvVariable
-from operator import itemgetter
+from chunk_store import IndexToDocstoreId, SQLiteDocstore
+from chunking import Chunker, get_token_counter
+from context_budget import compress_context
+from embedding_cache import CachedEmbeddings
+from instrumentation import SIZE_BUCKETS, TokenUsageCallback, inc, observe, record_stage, request_timings, stage
+from namespaces import DEFAULT_NAMESPACE, IndexRegistry
+from pdf_extract import iter_pdf_pages
+from provider_client import BatchingEmbeddings, ManagedChatModel, ProviderGate
+from retrieval import lexical_search, mmr_select, reciprocal_rank_fusion
+from semantic_cache import SemanticCache
+from vector_index import build_index, is_trained_layout, rebuild_index, set_search_parameters
 from langchain.prompts import PromptTemplate
-from langchain_community.chat_models import ChatOpenAI
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.runnables import RunnableBranch, RunnableLambda, RunnableParallel, RunnablePassthrough
+from pydantic import BaseModel, Field
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import PydanticOutputParser, StrOutputParser
 
 
 # environment variable inititalization
@@ -21,57 +37,827 @@ GCP_MODEL = EnvVariable.GCP_MODEL.value
 GCP_API_KEY = EnvVariable.GCP_API_KEY.value
 OPENAI_API_KEY = EnvVariable.OPENAI_API_KEY.value
 
-# Initialize global variables
-if OPENAI_API_KEY:
-    llm = ChatOpenAI()
-    embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-elif GCP_API_KEY:
-    # Initialize LangChain LLM with GCP Gemini Pro
-    llm = ChatGoogleGenerativeAI(model=GCP_MODEL, google_api_key=GCP_API_KEY)
-    embeddings = HuggingFaceEmbeddings()
+# The models are created on first use, see get_llm() and get_embeddings()
+llm = None
+embeddings = None
+models_lock = threading.Lock()
+
+def init_models():
+    """Create the LLM and the embedding model of the configured provider, if not set already."""
+    global llm, embeddings
+    with models_lock:
+        if llm is not None and embeddings is not None:
+            return
+        # Provider SDKs are slow to import, only load the one in use. LLM_PROVIDER picks
+        # one explicitly, otherwise it's the first one with an API key
+        provider = EnvVariable.LLM_PROVIDER.value or ("openai" if OPENAI_API_KEY else "gcp" if GCP_API_KEY else "")
+        if provider == "fake":
+            # Local deterministic models, for benchmarks and development without keys
+            from fake_models import FakeChatModel, FakeEmbeddings
+            provider_llm = FakeChatModel(latency=EnvVariable.FAKE_LLM_LATENCY.value)
+            provider_embeddings = FakeEmbeddings(latency=EnvVariable.FAKE_EMBEDDING_LATENCY.value)
+        elif provider == "openai":
+            from langchain_community.chat_models import ChatOpenAI
+            from langchain_community.embeddings import OpenAIEmbeddings
+            provider_llm = ChatOpenAI()
+            provider_embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
+        elif provider == "gcp":
+            # Initialize LangChain LLM with GCP Gemini Pro
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            provider_llm = ChatGoogleGenerativeAI(model=GCP_MODEL, google_api_key=GCP_API_KEY)
+            provider_embeddings = HuggingFaceEmbeddings()
+        elif provider:
+            raise RuntimeError(f"Unknown LLM_PROVIDER {provider!r}, expected openai, gcp or fake")
+        else:
+            raise RuntimeError("Set OPENAI_API_KEY or GCP_API_KEY, or LLM_PROVIDER=fake, to choose the model provider")
+
+        retry = dict(
+            max_retries=EnvVariable.PROVIDER_MAX_RETRIES.value,
+            backoff_base=EnvVariable.PROVIDER_BACKOFF_BASE.value,
+            backoff_max=EnvVariable.PROVIDER_BACKOFF_MAX.value,
+        )
+        if llm is None:
+            # Every LLM call is rate limited, bounded, retried and coalesced, see provider_client.py
+            llm = ManagedChatModel(model=provider_llm, gate=ProviderGate(
+                "llm", rate=EnvVariable.LLM_RATE_LIMIT.value,
+                max_concurrency=EnvVariable.LLM_MAX_CONCURRENCY.value, **retry
+            ))
+        if embeddings is None:
+            # Embedding calls of concurrent uploads and questions are merged into batches
+            provider_embeddings = BatchingEmbeddings(
+                provider_embeddings,
+                ProviderGate(
+                    "embeddings", rate=EnvVariable.EMBEDDING_RATE_LIMIT.value,
+                    max_concurrency=EnvVariable.EMBEDDING_MAX_CONCURRENCY.value, **retry
+                ),
+                window=EnvVariable.EMBEDDING_BATCH_WINDOW_MS.value / 1000,
+                max_batch=EnvVariable.EMBEDDING_MAX_BATCH.value,
+            )
+            # Cache document embeddings on disk so identical chunks are only embedded once
+            embeddings = CachedEmbeddings(
+                provider_embeddings,
+                EnvVariable.EMBEDDING_CACHE_PATH.value,
+                max_entries=EnvVariable.EMBEDDING_CACHE_MAX_ENTRIES.value,
+                query_max_entries=EnvVariable.QUERY_EMBEDDING_CACHE_MAX_ENTRIES.value,
+            )
+
+def get_llm():
+    if llm is None:
+        init_models()
+    return llm
+
+def get_embeddings():
+    if embeddings is None:
+        init_models()
+    return embeddings
 
 vectorstore_path = EnvVariable.FAISS_PATH.value
 
-if os.path.exists(vectorstore_path):
-    vector_store = FAISS.load_local(vectorstore_path, embeddings, allow_dangerous_deserialization=True)
-else:
-    vector_store = None
-
-# Function to extract text from PDF
-def get_pdf_text(pdf_docs):
-    text = ""
-    for key, pdf in pdf_docs.items():
-        pdf_reader = PdfReader(pdf)
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-    return text
-
-# Function to extract text from a file path
-def get_pdf_text_from_path(file_paths):
-    text = ""
-    for file_path in file_paths:
-        with open(file_path, 'rb') as f:
-            pdf_reader = PdfReader(f)
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-    return text
+# Responses to past questions, one cache per set of namespaces searched and retrieval
+# settings, each scoped to the versions of their indexes
+MAX_SEMANTIC_CACHES = 64
+semantic_caches = OrderedDict()
+semantic_caches_lock = threading.Lock()
+
+def get_semantic_cache(namespaces=(DEFAULT_NAMESPACE,), retrieval_mode=None, retrieval=None):
+    """
+    Return the semantic cache of the questions searching these namespaces with this
+    retrieval mode and these knobs (k, fetch_k, lambda_mult), see `retrieval_knobs`: a
+    response retrieved differently isn't a valid answer to them.
+    """
+    key = (tuple(namespaces), retrieval_mode or EnvVariable.RETRIEVAL_MODE.value, retrieval_knobs(retrieval))
+    with semantic_caches_lock:
+        cache = semantic_caches.get(key)
+        if cache is None:
+            cache = semantic_caches[key] = SemanticCache(
+                threshold=EnvVariable.SEMANTIC_CACHE_THRESHOLD.value,
+                ttl=EnvVariable.SEMANTIC_CACHE_TTL.value,
+                max_entries=EnvVariable.SEMANTIC_CACHE_MAX_ENTRIES.value,
+            )
+            while len(semantic_caches) > MAX_SEMANTIC_CACHES:
+                semantic_caches.popitem(last=False)
+        semantic_caches.move_to_end(key)
+        return cache
+
+# Number of chunks sent to the embedding model in one call
+EMBEDDING_BATCH_SIZE = 64
+
+# Files of a segment: the FAISS index, its chunks and their vectors
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.db"
+VECTORS_FILE = "vectors.npy"
+
+# The index of a namespace is a list of immutable segments, each in its own folder. Which
+# ones make up the current index, and its version, is in SEGMENTS_FILE, replaced in a
+# single os.replace() so readers, in any process, always find a complete index
+SEGMENTS_FILE = "segments.json"
+SEGMENT_PREFIX = "segment-"
+
+# Vectors copied from the FAISS index to VECTORS_FILE at a time
+VECTORS_BATCH_SIZE = 65536
+
+# Maps the codes of flat, scalar-quantized, HNSW and IVF indexes; faiss before 1.11 has
+# no IO_FLAG_MMAP_IFC, its IO_FLAG_MMAP only maps IVF lists
+INDEX_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+# Pickled docstore of the indexes saved with FAISS.save_local by earlier versions
+LEGACY_DOCSTORE_FILE = "index.pkl"
+
+def read_segments(index_path):
+    """
+    The segment list of a namespace index, None if nothing was indexed yet.
+
+    Returns:
+        dict: "version", "segments" ({"name", "count"} of each, oldest first) and "retired",
+            the segments the previous update dropped, deleted by the next one.
+    """
+    try:
+        with open(os.path.join(index_path, SEGMENTS_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_segments(index_path, segments):
+    """Make `segments` the current segment list of a namespace index, atomically."""
+    tmp_path = os.path.join(index_path, f"{SEGMENTS_FILE}.tmp-{uuid.uuid4().hex}")
+    with open(tmp_path, "w") as f:
+        json.dump(segments, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_path, SEGMENTS_FILE))
+
+def read_index_version(index_path):
+    """Read the version of a namespace index, 0 if there is none."""
+    segments = read_segments(index_path)
+    return segments["version"] if segments else 0
+
+def hash_bytes(data):
+    """SHA-256 of a page text, used by the document manifest."""
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(file_path, block_size=1 << 20):
+    """SHA-256 of a file content, read in blocks so large PDFs aren't loaded in memory."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_chunker():
+    """New Chunker configured by CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS and CHUNK_DEDUP, one per ingestion."""
+    return Chunker(
+        chunk_tokens=EnvVariable.CHUNK_TOKENS.value,
+        overlap_tokens=EnvVariable.CHUNK_OVERLAP_TOKENS.value,
+        dedup=EnvVariable.CHUNK_DEDUP.value,
+        dedup_distance=EnvVariable.CHUNK_DEDUP_DISTANCE.value,
+        encoding_name=EnvVariable.TOKENIZER_ENCODING.value,
+    )
 
 def get_text_chunks(text):
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
+    return [chunk for chunk, _ in get_chunker().split_page(text)]
+
+def embed_chunks(text_chunks, progress=None):
+    """Embed chunks in batches, so long uploads can report how far they are."""
+    vectors = []
+    for start in range(0, len(text_chunks), EMBEDDING_BATCH_SIZE):
+        batch = text_chunks[start:start + EMBEDDING_BATCH_SIZE]
+        observe("embedding_batch_size", len(batch), buckets=SIZE_BUCKETS, help_text="Chunks per embedding call")
+        with stage("embedding_batch"):
+            vectors.extend(get_embeddings().embed_documents(batch))
+        if progress:
+            progress("embedding", chunks_embedded=len(vectors))
+    return vectors
+
+def create_vectorstore(path, index):
+    """Empty vector store around a FAISS index, with its chunks in `path`/chunks.db."""
+    return FAISS(
+        embedding_function=get_embeddings(),
+        index=index,
+        docstore=SQLiteDocstore(os.path.join(path, CHUNKS_FILE)),
+        index_to_docstore_id={},
     )
-    chunks = text_splitter.split_text(text)
-    return chunks
 
-def get_vectorstore(text_chunks):
-    vectorstore = FAISS.from_texts(texts=text_chunks, embedding=embeddings)
+def build_vectorstore(text_chunks, vectors, path, ids=None, metadatas=None):
+    """
+    Create a vector store in the folder `path` from already embedded chunks.
+
+    The FAISS index type (FAISS_INDEX_TYPE) and scalar quantizer (FAISS_QUANTIZER) are
+    configurable; approximate indexes are trained on a sample of `vectors`.
+    """
+    index = build_index(
+        vectors,
+        index_type=EnvVariable.FAISS_INDEX_TYPE.value,
+        quantizer=EnvVariable.FAISS_QUANTIZER.value,
+        nprobe=EnvVariable.FAISS_NPROBE.value,
+    )
+    vectorstore = create_vectorstore(path, index)
+    vectorstore.add_embeddings(list(zip(text_chunks, vectors)), metadatas=metadatas, ids=ids)
     return vectorstore
 
-def generate_answer():
-    answer_prompt_template = """
+def load_vectorstore(index_path):
+    """
+    Open a saved vector store for searching.
+
+    The FAISS index is memory-mapped read-only and chunks are read from SQLite on demand,
+    so opening is cheap whatever the index size, and the processes serving the same
+    index share its pages through the OS page cache.
+    """
+    index = faiss.read_index(os.path.join(index_path, INDEX_FILE), INDEX_MMAP_FLAG | faiss.IO_FLAG_READ_ONLY)
+    set_search_parameters(index, EnvVariable.FAISS_NPROBE.value)
+    docstore = SQLiteDocstore(os.path.join(index_path, CHUNKS_FILE), read_only=True)
+    store = FAISS(
+        embedding_function=get_embeddings(),
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=IndexToDocstoreId(docstore),
+    )
+    # Row i is the vector at position i of the index, read by the MMR search
+    store.vectors = load_vectors(index_path, index)
+    return store
+
+def save_vectors(index, file_path):
+    """Write the vectors of a FAISS index, in position order, as a float32 .npy matrix."""
+    vectors = np.lib.format.open_memmap(file_path, mode="w+", dtype=np.float32, shape=(index.ntotal, index.d))
+    for start in range(0, index.ntotal, VECTORS_BATCH_SIZE):
+        count = min(VECTORS_BATCH_SIZE, index.ntotal - start)
+        vectors[start:start + count] = index.reconstruct_n(start, count)
+    vectors.flush()
+    del vectors
+
+def load_vectors(index_path, index):
+    """
+    The vectors of a saved index as one contiguous matrix aligned with its positions,
+    memory-mapped like the index. Indexes saved without it decode theirs in memory.
+    """
+    file_path = os.path.join(index_path, VECTORS_FILE)
+    if not os.path.exists(file_path):
+        return index.reconstruct_n(0, index.ntotal)
+    if index.ntotal == 0:
+        return np.empty((0, index.d), dtype=np.float32)
+    return np.load(file_path, mmap_mode="r")
+
+def copy_vectorstore(index_path, path):
+    """
+    Writable copy, in the folder `path`, of the vector store saved in `index_path`, so it
+    can be modified while queries keep reading the original.
+    """
+    shutil.copyfile(os.path.join(index_path, CHUNKS_FILE), os.path.join(path, CHUNKS_FILE))
+    store = create_vectorstore(path, faiss.read_index(os.path.join(index_path, INDEX_FILE)))
+    store.index_to_docstore_id = store.docstore.load_positions()
+    set_search_parameters(store.index, EnvVariable.FAISS_NPROBE.value)
+    return store
+
+def delete_from_vectorstore(store, ids):
+    """Remove chunks from a vector store, rebuilding the index if it can't remove in place."""
+    try:
+        store.delete(ids)
+    except RuntimeError:
+        # HNSW graphs and IVF lists with a direct map don't support removal: copy the
+        # remaining vectors into a fresh index
+        ids = set(ids)
+        remaining = [(position, id_) for position, id_ in sorted(store.index_to_docstore_id.items()) if id_ not in ids]
+        store.index = rebuild_index(store.index, [position for position, _ in remaining])
+        store.docstore.delete(list(ids))
+        store.index_to_docstore_id = {i: id_ for i, (_, id_) in enumerate(remaining)}
+
+def save_segment(store, path):
+    """Write the index of a vector store built in the folder `path` next to its chunks and close it."""
+    faiss.write_index(store.index, os.path.join(path, INDEX_FILE))
+    save_vectors(store.index, os.path.join(path, VECTORS_FILE))
+    store.docstore.save_positions(store.index_to_docstore_id)
+    store.docstore.close()
+
+def new_segment_path(index_path):
+    """Folder of a new segment of a namespace index, created empty."""
+    path = os.path.join(index_path, f"{SEGMENT_PREFIX}{uuid.uuid4().hex}")
+    os.makedirs(path)
+    return path
+
+def index_settings(count):
+    """
+    How `build_vectorstore` builds the index of `count` chunks: FAISS_INDEX_TYPE,
+    FAISS_QUANTIZER and whether it's trained, IVF types falling back to a flat index
+    when there are too few chunks to train one.
+    """
+    index_type = EnvVariable.FAISS_INDEX_TYPE.value
+    return {
+        "index_type": index_type,
+        "quantizer": EnvVariable.FAISS_QUANTIZER.value,
+        "trained": is_trained_layout(index_type, count),
+    }
+
+def write_segment(index_path, text_chunks, vectors, ids=None, metadatas=None):
+    """
+    Build and save a segment holding already embedded chunks, see `build_vectorstore`.
+
+    Returns:
+        dict: The entry of the segment in the segment list, with its `index_settings`.
+    """
+    path = new_segment_path(index_path)
+    try:
+        store = build_vectorstore(text_chunks, vectors, path, ids=ids, metadatas=metadatas)
+        save_segment(store, path)
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    return {"name": os.path.basename(path), "count": store.index.ntotal, **index_settings(store.index.ntotal)}
+
+def rewrite_segments(index_path, group):
+    """
+    Build one new segment holding the chunks of the segments `group`, like a new one:
+    its index trained on all of their vectors.
+
+    Returns:
+        dict: The entry of the new segment in the segment list.
+    """
+    documents, vectors = [], []
+    for store in open_segments(index_path, group):
+        documents.extend(store.docstore.ordered_chunks())
+        vectors.append(np.asarray(store.vectors, dtype=np.float32))
+        store.docstore.close()
+    return write_segment(
+        index_path,
+        [document.page_content for document in documents],
+        np.concatenate(vectors),
+        ids=[document.id for document in documents],
+        metadatas=[document.metadata for document in documents],
+    )
+
+def open_segments(index_path, segments):
+    """Open the segments of a namespace index for searching."""
+    return [load_vectorstore(os.path.join(index_path, segment["name"])) for segment in segments]
+
+def delete_from_segments(index_path, segments, ids):
+    """
+    Drop the chunks `ids` from the segments holding them. Only those segments are
+    rewritten, into new ones; segments left without chunks disappear.
+
+    Returns:
+        list[dict]: The segment list without the chunks.
+    """
+    result = []
+    for segment in segments:
+        path = os.path.join(index_path, segment["name"])
+        docstore = SQLiteDocstore(os.path.join(path, CHUNKS_FILE), read_only=True)
+        try:
+            stale_ids = docstore.existing_ids(ids)
+        finally:
+            docstore.close()
+        if not stale_ids:
+            result.append(segment)
+            continue
+        if len(stale_ids) == segment["count"]:
+            continue
+
+        new_path = new_segment_path(index_path)
+        try:
+            store = copy_vectorstore(path, new_path)
+            delete_from_vectorstore(store, list(stale_ids))
+            save_segment(store, new_path)
+        except BaseException:
+            shutil.rmtree(new_path, ignore_errors=True)
+            raise
+        result.append({**segment, "name": os.path.basename(new_path), "count": store.index.ntotal})
+    return result
+
+def segment_tier(count, factor):
+    """Size tier of a segment of `count` chunks: t for factor^t <= count < factor^(t+1)."""
+    tier = 0
+    while count >= factor ** (tier + 1):
+        tier += 1
+    return tier
+
+def plan_merge(segments, factor):
+    """
+    The segments to merge next: those of the smallest size tier holding `factor` of them,
+    [] if no tier does. Each chunk is then rewritten about log_factor(n) times over the
+    life of an index of n chunks, and an index has at most (factor - 1) segments per tier.
+    """
+    tiers = {}
+    for segment in segments:
+        tiers.setdefault(segment_tier(segment["count"], factor), []).append(segment)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= factor:
+            return tiers[tier]
+    return []
+
+def merge_segments(index_path, segments, factor):
+    """
+    Merge segments of the same size tier, see `plan_merge`, until no tier is full. The
+    merged segment is built like a new one, its index trained on all of their vectors.
+
+    Returns:
+        list[dict]: The segment list after the merges.
+    """
+    while True:
+        group = plan_merge(segments, factor)
+        if not group:
+            return segments
+        merged = rewrite_segments(index_path, group)
+        names = {segment["name"] for segment in group}
+        segments = [segment for segment in segments if segment["name"] not in names] + [merged]
+
+def retrain_segments(index_path, segments):
+    """
+    Bring the segments in line with the current `index_settings`: those built with
+    another index type or quantizer are rebuilt, and those left untrained for lack of
+    chunks are merged, and trained, once together they have enough.
+
+    Returns:
+        list[dict]: The segment list after the rebuilds.
+    """
+    settings = index_settings(0)
+    result = []
+    for segment in segments:
+        if (segment.get("index_type"), segment.get("quantizer")) != (settings["index_type"], settings["quantizer"]):
+            segment = rewrite_segments(index_path, [segment])
+        result.append(segment)
+
+    untrained = [segment for segment in result if not segment["trained"]]
+    if len(untrained) > 1 and is_trained_layout(settings["index_type"], sum(segment["count"] for segment in untrained)):
+        names = {segment["name"] for segment in untrained}
+        result = [segment for segment in result if segment["name"] not in names] + [rewrite_segments(index_path, untrained)]
+    return result
+
+def remove_unused_segments(index_path, segments):
+    """
+    Delete the segment folders neither in the segment list `segments` nor retired by its
+    update: those retired by the update before, which readers of the previous list had
+    time to open, those merged away and those of writers that failed before publishing.
+    """
+    keep = set(segments["retired"]) | {segment["name"] for segment in segments["segments"]} if segments else set()
+    for name in os.listdir(index_path):
+        if name.startswith(SEGMENT_PREFIX) and name not in keep:
+            shutil.rmtree(os.path.join(index_path, name), ignore_errors=True)
+        elif name.startswith(f"{SEGMENTS_FILE}.tmp-"):
+            os.remove(os.path.join(index_path, name))
+
+def migrate_vectorstore(index_path):
+    """Convert an index saved by FAISS.save_local (pickled docstore) into a segment."""
+    if not os.path.exists(os.path.join(index_path, LEGACY_DOCSTORE_FILE)):
+        return
+    legacy_store = FAISS.load_local(index_path, get_embeddings(), allow_dangerous_deserialization=True)
+    path = new_segment_path(index_path)
+    store = create_vectorstore(path, legacy_store.index)
+    store.docstore.add(dict(legacy_store.docstore._dict))
+    store.index_to_docstore_id = dict(legacy_store.index_to_docstore_id)
+    save_segment(store, path)
+    write_segments(index_path, {
+        "version": 1,
+        "segments": [{"name": os.path.basename(path), "count": store.index.ntotal}],
+        "retired": [],
+    })
+    os.remove(os.path.join(index_path, LEGACY_DOCSTORE_FILE))
+    os.remove(os.path.join(index_path, INDEX_FILE))
+
+def open_vectorstore(index_path):
+    """
+    Open the segments of a namespace index, converting it first if it has the old format.
+
+    Returns:
+        tuple[list[FAISS], int]: The vector store of each segment and the index version.
+    """
+    migrate_vectorstore(index_path)
+    segments = read_segments(index_path) or {"version": 0, "segments": []}
+    return open_segments(index_path, segments["segments"]), segments["version"]
+
+# The index of each namespace, opened on first use. Every index has its own lock that
+# serialises its writers, in every process, so concurrent uploads don't lose each other's
+# chunks; readers never take it, they work on whatever stores the registry returns.
+indexes = IndexRegistry(
+    vectorstore_path,
+    loader=open_vectorstore,
+    read_version=read_index_version,
+    max_loaded=EnvVariable.INDEX_CACHE_MAX_ENTRIES.value,
+)
+
+def update_vectorstore(
+    text_chunks, mode="append", ids=None, metadatas=None, delete_ids=None, progress=None,
+    namespace=DEFAULT_NAMESPACE,
+):
+    """
+    Add new chunks to the index of a namespace used by `query()`.
+
+    Only `text_chunks` are embedded, and written: in "append" mode they become a new
+    segment of the index, after dropping the chunks listed in `delete_ids` from the
+    segments holding them; in "replace" mode they become its only segment. Segments
+    of the same size are then merged, see `merge_segments`, so the work of an upload
+    depends on its own size and the index keeps few segments. Segments built before a
+    change of FAISS_INDEX_TYPE or FAISS_QUANTIZER, or too small to train, are rebuilt
+    first, see `retrain_segments`. The new segment list is
+    published in one rename and the stores used by `query()` are swapped, so queries
+    never see a half-built index.
+
+    `progress`, if given, is called as progress(stage, **counters) while embedding and merging.
+
+    Returns:
+        int: The new index version.
+    """
+    index = indexes.get(namespace)
+
+    # Embedding is the expensive part and doesn't need the lock
+    vectors = embed_chunks(text_chunks, progress=progress)
+
+    if progress:
+        progress("merging")
+    with index.lock:
+        os.makedirs(index.path, exist_ok=True)
+        migrate_vectorstore(index.path)
+        current = read_segments(index.path)
+        if not text_chunks and not (mode == "append" and current and delete_ids):
+            # Nothing to index
+            return current["version"] if current else 0
+
+        previous_segments = current["segments"] if current else []
+        segments = list(previous_segments) if mode == "append" else []
+        with stage("index_build"):
+            if delete_ids and segments:
+                segments = delete_from_segments(index.path, segments, delete_ids)
+            if text_chunks:
+                segments.append(write_segment(index.path, text_chunks, vectors, ids=ids, metadatas=metadatas))
+            segments = retrain_segments(index.path, segments)
+            segments = merge_segments(index.path, segments, EnvVariable.FAISS_SEGMENT_MERGE_FACTOR.value)
+
+        new_version = (current["version"] if current else 0) + 1
+        names = {segment["name"] for segment in segments}
+        published = {
+            "version": new_version,
+            "segments": segments,
+            "retired": [segment["name"] for segment in previous_segments if segment["name"] not in names],
+        }
+        with stage("index_save"):
+            write_segments(index.path, published)
+        remove_unused_segments(index.path, published)
+
+        # Hot-swap the index used by query()
+        indexes.publish(namespace, open_segments(index.path, segments), new_version)
+
+    if progress:
+        progress("merging", index_merged=True, index_version=new_version)
+    return new_version
+
+def ingest_documents(
+    documents, db, mode="append", progress=None, namespace=DEFAULT_NAMESPACE, on_indexed=None, replace_source=False,
+):
+    """
+    Parse, chunk and index PDF documents, skipping the work the document manifest says is done.
+
+    A document whose content hash is already in the manifest is not parsed at all. The
+    pages of the others are streamed from the PDF process pool and chunked as they
+    arrive. Documents are new documents, even when a document with the same source name
+    was ingested before: file names such as "notes.pdf" don't identify a document. With
+    `replace_source`, the client says they are new versions of the documents of the same
+    source name in the namespace instead: only the pages whose text changed are
+    re-chunked and re-embedded, and the chunks of removed or changed pages are dropped.
+
+    Args:
+        documents (list[tuple[str, str]]): (source name, PDF file path) pairs.
+        db (Database): Database holding the document manifest.
+        mode (str): "append" to add to the index, "replace" to rebuild it from these documents.
+        progress (callable, optional): Called as progress(stage, **counters) as the ingestion
+            goes through the "parsing", "embedding" and "merging" stages.
+        namespace (str): Namespace whose index and manifest the documents go to.
+        on_indexed (callable, optional): Called with the (chunk id, text, metadata) of the
+            new chunks once they are indexed, e.g. to generate their question bank.
+        replace_source (bool): Whether the documents replace those of the same source name.
+
+    Returns:
+        tuple[list[dict], int]: The ingestion status of each document and the index version.
+    """
+    # Jobs of the same namespace run one after the other, in any process, so the manifest
+    # checks and the version lookups of a job see the documents recorded by the previous one
+    with indexes.get(namespace).ingest_lock:
+        if mode == "replace":
+            db.clear_documents(namespace)
+            db.delete_bank_questions(namespace)
+
+        results = []
+        states = {}
+        seen_hashes = set()
+
+        for source, file_path in documents:
+            content_hash = hash_file(file_path)
+            if content_hash in seen_hashes or db.get_document(content_hash, namespace):
+                results.append({"source": source, "status": "unchanged", "pages_ingested": 0})
+                continue
+            seen_hashes.add(content_hash)
+
+            # Chunks of the previous version of this document, by page text hash
+            previous = db.get_document_by_source(source, namespace) if replace_source else None
+            states[file_path] = {
+                "source": source,
+                "content_hash": content_hash,
+                "previous": previous,
+                "previous_chunks": dict(zip(previous["page_hashes"], previous["chunk_ids"])) if previous else {},
+                "page_hashes": [],
+                "chunk_ids": [],
+                "result": {
+                    "source": source,
+                    "status": "updated" if previous else "ingested",
+                    "pages_ingested": 0,
+                    "chunks": 0,
+                    "tokens": 0,
+                    "duplicate_chunks": 0,
+                },
+            }
+            results.append(states[file_path]["result"])
+
+        new_chunks, new_ids, new_metadatas = [], [], []
+        pages_parsed = 0
+        chunker = get_chunker()
+        pages = iter_pdf_pages(list(states))
+        while True:
+            # Time spent waiting for the PDF pool
+            with stage("pdf_parse"):
+                page = next(pages, None)
+            if page is None:
+                break
+            file_path, page_no, page_text = page
+            state = states[file_path]
+            pages_parsed += 1
+            if progress:
+                progress("parsing", pages_parsed=pages_parsed, chunks_total=len(new_chunks))
+            page_hash = hash_bytes(page_text.encode("utf-8"))
+            state["page_hashes"].append(page_hash)
+
+            if page_hash in state["previous_chunks"]:
+                state["chunk_ids"].append(state["previous_chunks"].pop(page_hash))
+                chunker.scan_sections(page_text, state["source"])
+                continue
+
+            duplicates = chunker.duplicate_count
+            with stage("chunking"):
+                chunks = chunker.split_page(page_text, state["source"], page_no)
+            ids = [str(uuid.uuid4()) for _ in chunks]
+            new_chunks.extend(chunk for chunk, _ in chunks)
+            new_ids.extend(ids)
+            new_metadatas.extend(metadata for _, metadata in chunks)
+            state["chunk_ids"].append(ids)
+            state["result"]["pages_ingested"] += 1
+            state["result"]["chunks"] += len(chunks)
+            state["result"]["tokens"] += sum(metadata["tokens"] for _, metadata in chunks)
+            state["result"]["duplicate_chunks"] += chunker.duplicate_count - duplicates
+
+        if progress:
+            progress("parsing", pages_parsed=pages_parsed, chunks_total=len(new_chunks))
+
+        # Whatever was not reused belongs to pages that changed or disappeared
+        stale_ids = [
+            chunk_id
+            for state in states.values()
+            for ids in state["previous_chunks"].values()
+            for chunk_id in ids
+        ]
+
+        if new_chunks or stale_ids:
+            version = update_vectorstore(
+                new_chunks, mode, ids=new_ids, metadatas=new_metadatas, delete_ids=stale_ids, progress=progress,
+                namespace=namespace,
+            )
+        else:
+            version = indexes.get(namespace).version
+
+        # Only record the documents once their chunks are in the saved index
+        for state in states.values():
+            with stage("manifest_write"):
+                db.save_document(
+                    state["content_hash"],
+                    state["source"],
+                    state["page_hashes"],
+                    state["chunk_ids"],
+                    replaces=state["previous"]["content_hash"] if state["previous"] else None,
+                    namespace=namespace,
+                )
+        if stale_ids:
+            db.delete_bank_questions(namespace, stale_ids)
+        if on_indexed and new_chunks:
+            on_indexed(list(zip(new_ids, new_chunks, new_metadatas)))
+
+        return results, version
+
+def get_vector_stores(namespace=DEFAULT_NAMESPACE):
+    """Return the live vector stores, one per segment, of a namespace, opening them on first use."""
+    stores, _ = indexes.open(namespace)
+    return stores
+
+def get_shards(namespaces=(DEFAULT_NAMESPACE,)):
+    """
+    The (namespace, stores, version) of each namespace a question searches.
+
+    Taking them once per request keeps it on the same indexes even if uploads swap them meanwhile.
+    """
+    return tuple((namespace, *indexes.open(namespace)) for namespace in namespaces)
+
+# Default retrieval knobs: chunks given to the LLM, candidates considered for them and
+# the MMR trade-off between relevance (1) and diversity (0)
+RETRIEVAL_K = 4
+RETRIEVAL_FETCH_K = 20
+RETRIEVAL_LAMBDA_MULT = 0.5
+
+def retrieval_knobs(retrieval=None):
+    """(k, fetch_k, lambda_mult) of a search, defaults filled in; fetch_k is at least k."""
+    retrieval = retrieval or {}
+    k = retrieval.get("k", RETRIEVAL_K)
+    fetch_k = retrieval.get("fetch_k", max(RETRIEVAL_FETCH_K, k))
+    return k, fetch_k, retrieval.get("lambda_mult", RETRIEVAL_LAMBDA_MULT)
+
+def nearest_chunks(stores, question_vector, fetch_k=RETRIEVAL_FETCH_K):
+    """
+    The `fetch_k` chunks nearest to a question over the indexes of several namespaces.
+
+    Returns:
+        list[tuple[float, FAISS, int]]: (distance, store, position in its index), nearest first.
+    """
+    query_vector = np.asarray([question_vector], dtype=np.float32)
+    candidates = []
+    with stage("faiss_search"):
+        for store in stores:
+            distances, positions = store.index.search(query_vector, fetch_k)
+            candidates.extend(
+                (distance, store, int(position))
+                for distance, position in zip(distances[0], positions[0])
+                if position != -1
+            )
+    return sorted(candidates, key=lambda candidate: candidate[0])[:fetch_k]
+
+def chunk_documents(candidates):
+    """The chunks of (distance, store, position) candidates, one docstore query per store."""
+    positions_by_store = {}
+    for _, store, position in candidates:
+        positions_by_store.setdefault(id(store), (store, []))[1].append(position)
+    documents = {}
+    with stage("docstore_read"):
+        for store, positions in positions_by_store.values():
+            for position, document in zip(positions, store.docstore.search_positions(positions)):
+                documents[id(store), position] = document
+    return [documents[id(store), position] for _, store, position in candidates]
+
+def mmr_search(
+    stores, question_vector, k=RETRIEVAL_K, fetch_k=RETRIEVAL_FETCH_K, lambda_mult=RETRIEVAL_LAMBDA_MULT
+):
+    """
+    MMR search over the indexes of one or more namespaces, as if their chunks were in one index.
+
+    Each index returns its `fetch_k` nearest chunks and the overall `fetch_k` nearest are
+    kept. Their vectors are gathered from the vector matrix of each store in one go and
+    `k` of them are picked for relevance and diversity by `mmr_select`.
+    """
+    candidates = nearest_chunks(stores, question_vector, fetch_k)
+    if not candidates:
+        return []
+    vectors = np.empty((len(candidates), stores[0].index.d), dtype=np.float32)
+    rows_by_store = {}
+    for row, (_, store, position) in enumerate(candidates):
+        rows_by_store.setdefault(id(store), (store, [], []))
+        rows_by_store[id(store)][1].append(row)
+        rows_by_store[id(store)][2].append(position)
+    for store, rows, positions in rows_by_store.values():
+        vectors[rows] = store.vectors[positions]
+
+    selected = mmr_select(question_vector, vectors, k=k, lambda_mult=lambda_mult)
+    return chunk_documents([candidates[i] for i in selected])
+
+def hybrid_search(stores, question_vector, lexical_hits, k=RETRIEVAL_K, fetch_k=RETRIEVAL_FETCH_K):
+    """Merge the nearest chunks and the best BM25 matches with reciprocal rank fusion."""
+    vector_ranking = chunk_documents(nearest_chunks(stores, question_vector, fetch_k))
+    lexical_ranking = [document for document, _ in lexical_hits]
+    return reciprocal_rank_fusion([vector_ranking, lexical_ranking], limit=k)
+
+def prepare_retrieval(user_input, stores, retrieval_mode, timings, retrieval=None):
+    """
+    Inputs of the query chains up to retrieval: the question, its embedding and how to retrieve.
+
+    "lexical" and "auto" first run the BM25 search. "auto" then answers from it alone
+    when its keyword confidence reaches LEXICAL_CONFIDENCE, otherwise it goes hybrid.
+    The question is only embedded if the retrieval mode needs it. `retrieval` holds the
+    knobs of the search (k, fetch_k, lambda_mult), the defaults otherwise.
+    """
+    inputs = {
+        "question": user_input,
+        "question_vector": None,
+        "timings": timings,
+        "retrieval": retrieval or {},
+        "context_tokens": {},
+    }
+    _, fetch_k, _ = retrieval_knobs(retrieval)
+    if retrieval_mode in ("lexical", "auto"):
+        with stage("lexical_search", timings):
+            inputs["lexical_hits"], confidence = lexical_search(
+                [store.docstore for store in stores], user_input, limit=fetch_k
+            )
+        if retrieval_mode == "auto":
+            retrieval_mode = "lexical" if confidence >= EnvVariable.LEXICAL_CONFIDENCE.value else "hybrid"
+    inputs["retrieval_mode"] = retrieval_mode
+
+    if retrieval_mode != "lexical":
+        # The question is embedded once, for the semantic cache and for retrieval
+        with stage("embedding", timings):
+            inputs["question_vector"] = get_embeddings().embed_query(user_input)
+    return inputs
+
+# Prompt templates are built once, at import
+answer_prompt_template = """
     
         You are a highly knowledgeable and versatile AI assistant designed to provide thorough, detailed, and easy-to-understand explanations. nswer the question based only on the information provided for you in the context
         context:
@@ -88,24 +874,18 @@ def generate_answer():
         
         Question:  {question}
     """
-    answer_template = PromptTemplate(
-        template=answer_prompt_template, input_variables=["question"],
-    )
+answer_template = PromptTemplate(
+    template=answer_prompt_template, input_variables=["question"],
+)
 
-    answer_chain = answer_template | llm | StrOutputParser()
-    return answer_chain
-
-def generate_test_question_and_answer():
-    # Create a structured prompt to generate both the test question and answer in one go
-    question_prompt_template = """
+# Create a structured prompt to generate both the test question and answer in one go
+question_prompt_template = """
         You are a multi-purpose bot whose job is to generate exam-standard questions. Using the information from the 
-        context, Question and the answer provided below, generate a specific test question and answer to evaluate the 
+        Question and the answer provided below, generate a specific test question and answer to evaluate the 
         user's understanding of the topic.
         
         Question: {question}
-
-        Context: {context}
-
+{follow_up_context}
         Answer: {answer}
         Follow these rules:
         - The test question should start with one of the following formats:
@@ -118,21 +898,15 @@ def generate_test_question_and_answer():
         - Ensure the question and answer follow exam-standard formats and provide useful information.
         - No emojis or emoticons should be returned in your response.
     """
-    test_question_template = PromptTemplate(
-        template=question_prompt_template, input_variables=["context","question","answer"],
-    )
-    test_question_chain = test_question_template | llm | StrOutputParser()
+test_question_template = PromptTemplate(
+    template=question_prompt_template, input_variables=["follow_up_context","question","answer"],
+)
 
-    return test_question_chain
-
-
-def generate_bullet_points():
-    
-    # Create a structured prompt for the model
-    bullet_point_prompt_template = """
+# Create a structured prompt for the model
+bullet_point_prompt_template = """
         You are a multi-purpose bot whose one job is to engage the user. 
         Follow these rules:
-        - From the question, answer and context provided, generate a list of bullet points emphasizing key details in the answer to improve
+        - From the question and answer provided, generate a list of bullet points emphasizing key details in the answer to improve
         understanding, seperated by fullstops
         - This should be concise and be a summary of the answer
         - Use an enthusiastic and engaging tone to keep the user engaged.
@@ -140,18 +914,159 @@ def generate_bullet_points():
         - Return just the list 
 
         Question:  {question}
+{follow_up_context}
+        answer: {answer}
+    """
+bullet_template = PromptTemplate(
+    template=bullet_point_prompt_template, input_variables=["follow_up_context","question","answer"],
+)
 
-        context: {context}
+# Test questions of the question bank are generated from the chunks at ingest, not from an answer
+bank_question_prompt_template = """
+        You are a multi-purpose bot whose job is to generate exam-standard questions. Using the information from the
+        passage of the document below, generate a specific test question and answer to evaluate the
+        user's understanding of the topic.
 
-        answer: {answer}
+        Passage: {context}
+        Follow these rules:
+        - The test question should start with one of the following formats:
+            1. "What are..." for lists, definitions, or components.
+            2. "How many..." for numerical or count-based questions.
+            3. "What is the best way..." for advice, processes, or recommendations.
+        - Ensure the generated question can be answered from the passage alone.
+        - After generating the test question, provide a detailed and clear answer to the question.
+        - The response should consist of exactly two sentences seperated ny fullstop: the first is the test question, and the second is the answer
+        - Ensure the question and answer follow exam-standard formats and provide useful information.
+        - No emojis or emoticons should be returned in your response.
+    """
+bank_question_template = PromptTemplate(
+    template=bank_question_prompt_template, input_variables=["context"],
+)
+
+def budget_context(inputs):
+    """
+    Context of the prompts from the retrieved inputs["documents"].
+
+    The answer prompt gets the sentences most relevant to the question within
+    CONTEXT_TOKEN_BUDGET tokens (0 for the whole chunks). The test-question and
+    bullet-point prompts work from the answer, plus up to FOLLOW_UP_CONTEXT_TOKENS of
+    context if set. The token counts, and the tokens saved compared to sending the whole
+    chunks to the three prompts, are recorded in inputs["context_tokens"].
     """
-    bullet_template = PromptTemplate(
-        template=bullet_point_prompt_template, input_variables=["context","question","answer"],
+    count_tokens = get_token_counter(EnvVariable.TOKENIZER_ENCODING.value)
+    documents = inputs["documents"]
+    context = compress_context(inputs["question"], documents, EnvVariable.CONTEXT_TOKEN_BUDGET.value, count_tokens)
+    follow_up_context = ""
+    if EnvVariable.FOLLOW_UP_CONTEXT_TOKENS.value > 0:
+        follow_up_context = compress_context(
+            inputs["question"], documents, EnvVariable.FOLLOW_UP_CONTEXT_TOKENS.value, count_tokens
+        )
+
+    retrieved = sum(count_tokens(document.page_content) for document in documents)
+    answer_tokens = count_tokens(context)
+    follow_up_tokens = count_tokens(follow_up_context)
+    inputs["context_tokens"].update(
+        retrieved=retrieved,
+        answer_prompt=answer_tokens,
+        follow_up_prompts=follow_up_tokens,
+        saved=3 * retrieved - answer_tokens - 2 * follow_up_tokens,
     )
-    bullet_chain = bullet_template | llm | StrOutputParser()
+    return {
+        **inputs,
+        "context": context,
+        "follow_up_context": f"\n        Context: {follow_up_context}\n" if follow_up_context else "",
+    }
+
+def generate_answer(model=None):
+    answer_chain = answer_template | (model or get_llm()) | StrOutputParser()
+    return answer_chain
 
+def generate_test_question_and_answer(model=None):
+    test_question_chain = test_question_template | (model or get_llm()) | StrOutputParser()
+    return test_question_chain
+
+def generate_bullet_points(model=None):
+    bullet_chain = bullet_template | (model or get_llm()) | StrOutputParser()
     return bullet_chain
 
+def generate_bank_question(model=None):
+    bank_question_chain = bank_question_template | (model or get_llm()) | StrOutputParser()
+    return bank_question_chain
+
+def group_bank_chunks(chunks, max_tokens):
+    """
+    Split chunks into the passages of the question bank: consecutive chunks of the same
+    document section, up to `max_tokens` tokens per passage.
+
+    Args:
+        chunks (list[tuple[str, str, dict]]): (chunk id, text, metadata) in document order.
+
+    Returns:
+        list[list[tuple[str, str]]]: The (chunk id, text) of each passage.
+    """
+    passages, passage, tokens, section = [], [], 0, None
+    for chunk_id, text, metadata in chunks:
+        chunk_section = (metadata.get("source"), metadata.get("section"))
+        chunk_tokens = metadata.get("tokens", 0)
+        if passage and (chunk_section != section or tokens + chunk_tokens > max_tokens):
+            passages.append(passage)
+            passage, tokens = [], 0
+        passage.append((chunk_id, text))
+        tokens += chunk_tokens
+        section = chunk_section
+    if passage:
+        passages.append(passage)
+    return passages
+
+# Passages whose questions are generated, then saved, together
+QUESTION_BANK_BATCH_SIZE = 32
+
+def build_question_bank(chunks, db, namespace=DEFAULT_NAMESPACE, progress=None, model=None):
+    """
+    Generate a test question and answer for each passage of newly indexed chunks, see
+    `group_bank_chunks`, and save them with the ids of their chunks. `query()` then
+    attaches the question of a retrieved chunk instead of calling the LLM for one.
+
+    The LLM calls of a batch run concurrently, up to QUESTION_BANK_CONCURRENCY. A passage
+    whose question fails to generate is skipped.
+
+    Args:
+        chunks (list[tuple[str, str, dict]]): (chunk id, text, metadata) of the new chunks.
+        db (Database): Database the questions are saved to.
+        namespace (str): Namespace of the chunks.
+        progress (callable, optional): Called with the number of questions saved so far.
+
+    Returns:
+        int: The number of questions saved.
+    """
+    chain = with_token_usage(generate_bank_question(model), "question_bank")
+    passages = group_bank_chunks(chunks, EnvVariable.QUESTION_BANK_GROUP_TOKENS.value)
+    saved = 0
+    for start in range(0, len(passages), QUESTION_BANK_BATCH_SIZE):
+        batch = passages[start:start + QUESTION_BANK_BATCH_SIZE]
+        with stage("question_bank_batch"):
+            outputs = chain.batch(
+                [{"context": "\n\n".join(text for _, text in passage)} for passage in batch],
+                config={"max_concurrency": EnvVariable.QUESTION_BANK_CONCURRENCY.value},
+                return_exceptions=True,
+            )
+        questions = []
+        for passage, output in zip(batch, outputs):
+            if isinstance(output, Exception):
+                inc("question_bank_failures_total", help_text="Question bank passages whose question failed to generate")
+                continue
+            question, answer = parse_test_question(output)
+            if question and answer:
+                questions.append((generate_test_question_id(), question, answer, [chunk_id for chunk_id, _ in passage]))
+        if questions:
+            # A connection for the write only, not held across the LLM calls
+            with stage("question_bank_write"), db.scope():
+                db.save_bank_questions(questions, namespace)
+            saved += len(questions)
+        if progress:
+            progress(saved)
+    return saved
+
 def generate_test_question_id():
     """
     Generates a unique test_question_id using UUID.
@@ -161,53 +1076,76 @@ def generate_test_question_id():
     """
     return str(uuid.uuid4())
 
-def query(user_input):
-    # Tell Python to use the global vector_store
-    global vector_store
-    if vector_store is None:
-        vector_store = FAISS.load_local(vectorstore_path, embeddings, allow_dangerous_deserialization=True)
+def with_token_usage(chain, name):
+    """Count the LLM calls and tokens of a chain under `name`, see `TokenUsageCallback`."""
+    counter = get_token_counter(EnvVariable.TOKENIZER_ENCODING.value)
+    return chain.with_config(callbacks=[TokenUsageCallback(name, counter)])
 
-    # Generate unique id
-    test_question_id = generate_test_question_id()
+def timed(runnable, stage):
+    """
+    Wrap a runnable so the time it takes, in milliseconds, is recorded under `stage`
+    in the `timings` dict of its input. The same compiled chain can then be shared by
+    concurrent requests, each passing its own dict.
+    """
+    def run(inputs):
+        start = time.perf_counter()
+        result = runnable.invoke(inputs)
+        record_stage(stage, time.perf_counter() - start, inputs["timings"])
+        return result
 
-    # Extract the main answer from the response
-    answer_chain = generate_answer()
+    # Under ainvoke the wrapped runnable is awaited instead of taking a thread
+    async def arun(inputs):
+        start = time.perf_counter()
+        result = await runnable.ainvoke(inputs)
+        record_stage(stage, time.perf_counter() - start, inputs["timings"])
+        return result
+    return RunnableLambda(run, afunc=arun)
 
-    # Generate a test question based on the main answer
-    test_question_chain = generate_test_question_and_answer()
+def parse_bullet_points(bullet_points):
+    """Split the output of the bullet-point chain into a list."""
+    return bullet_points.split("-\n")
 
-    # Generate bullet points
-    bullet_chain = generate_bullet_points()
-    
-    retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={"k": 4})
-    chain = ({
-        "context": itemgetter("question") | retriever,
-        "question":itemgetter("question"),
-        } |  RunnablePassthrough.assign(answer=answer_chain) |
-            RunnablePassthrough.assign(test_question=test_question_chain)|
-            RunnablePassthrough.assign( bullet_points=bullet_chain)
+def parse_test_question(test_question):
+    """Split the output of the test-question chain into the question and its answer."""
+    question, _, answer = test_question.partition("?")
+    return question, answer.strip()
+
+def find_bank_question(inputs):
+    """
+    The pre-made test question of the retrieved inputs["documents"], the one of the best
+    ranked chunk that has one. None without a database in inputs["db"] or QUESTION_BANK.
+    """
+    db = inputs.get("db")
+    if db is None or not EnvVariable.QUESTION_BANK.value:
+        return None
+    bank_question = db.find_bank_question([document.id for document in inputs["documents"] if document.id])
+    inc("question_bank_lookups_total", help_text="Question bank lookups by result",
+        result="miss" if bank_question is None else "hit")
+    return bank_question
+
+class Evaluation(BaseModel):
+    """Structured verdict returned by the single-call evaluation prompt."""
+    knowledge_understood: bool = Field(description="True if the user understands the topic, False if they do not")
+    knowledge_confidence: int = Field(
+        ge=1, le=100, description="How well the user understands the topic, from 1 to 100 where 100 means complete understanding"
     )
 
-    response = chain.invoke({'question':user_input})
-    
-    bullet_points = response['bullet_points'].split("-\n")
-    test_question = response['test_question'].split("?")[0]
-    test_answer = response['test_question'].split("?")[1].strip()
-    
-    # Return the response along with the bullet points, test question, and test question ID
-    return {
-        "answer": response["answer"],
-        "bullet_points": bullet_points,
-        "test_answer": test_answer,
-        "test_question": test_question,
-        "test_question_id": test_question_id
-    }
+evaluation_parser = PydanticOutputParser(pydantic_object=Evaluation)
 
-# Function to evaluate the answer using LLM
-def evaluate_with_llm(question: str, user_answer: str, correct_answer: str) -> dict:
-    """Evaluates whether the user understood the question and gives a confidence score using LLM."""
+structured_evaluation_template = """
+    You are given a question and two answers (one correct and one user's). Determine if the user understands the topic based on their answer,
+    and rate the user's understanding on a scale from 1 to 100, where 100 means complete understanding.
+
+    Question: {question}
+
+    Correct Answer: {correct_answer}
+
+    User's Answer: {user_answer}
+
+    {format_instructions}
+    """
 
-    evaluation_template = """
+evaluation_template = """
     You are given a question and two answers (one correct and one user's). Determine if the user understands the topic based on their answer.
     
     Question: {question}
@@ -219,7 +1157,7 @@ def evaluate_with_llm(question: str, user_answer: str, correct_answer: str) -> d
     Respond with 'True' if the user understands the topic and 'False' if they do not.
     """
 
-    confidence_template = """
+confidence_template = """
     You are given a question and two answers (one correct and one user's). Rate the user's confidence in their answer on a scale from 1 to 100, where 100 means complete understanding.
     Only give a confidence score in integer no explanation needed
     Question: {question}
@@ -229,31 +1167,491 @@ def evaluate_with_llm(question: str, user_answer: str, correct_answer: str) -> d
     User's Answer: {user_answer}
     """
 
-    # Prepare the prompts
-    evaluation_prompt = PromptTemplate(
-        template=evaluation_template,
-        input_variables=["question", "correct_answer", "user_answer"],
-    )
-    confidence_prompt = PromptTemplate(
-        template=confidence_template,
-        input_variables=["question", "correct_answer", "user_answer"],
-    )
+# Prepare the prompts
+structured_evaluation_prompt = PromptTemplate(
+    template=structured_evaluation_template,
+    input_variables=["question", "correct_answer", "user_answer"],
+    partial_variables={"format_instructions": evaluation_parser.get_format_instructions()},
+)
+evaluation_prompt = PromptTemplate(
+    template=evaluation_template,
+    input_variables=["question", "correct_answer", "user_answer"],
+)
+confidence_prompt = PromptTemplate(
+    template=confidence_template,
+    input_variables=["question", "correct_answer", "user_answer"],
+)
 
-    # Call the LLM for understanding evaluation
-    evaluation_chain = evaluation_prompt | llm | StrOutputParser()
-    evaluation_result = evaluation_chain.invoke({"question": question, "correct_answer": correct_answer, "user_answer": user_answer})
-    
-    # Call the LLM for confidence evaluation
-    confidence_chain = confidence_prompt | llm | StrOutputParser()
-    confidence_result = confidence_chain.invoke({"question": question, "correct_answer": correct_answer, "user_answer": user_answer})
-    
-    # Parse results
-    knowledge_understood = evaluation_result.strip() == "True"
-    knowledge_confidence = int(confidence_result.split(":")[-1])  # Convert confidence to integer
+class Pipeline:
+    """
+    The chains used by `query()`, `stream_query()` and `evaluate_with_llm()`, built for one
+    LLM and one version of the vector stores searched. Requests share them and only call
+    invoke/stream.
+    """
+
+    def __init__(self, model, stores):
+        self.stores = stores
+        self.retriever = RunnableLambda(self.retrieve)
+
+        # Extract the main answer from the response
+        self.answer_chain = with_token_usage(generate_answer(model), "answer")
+
+        # Generate a test question based on the main answer
+        self.test_question_chain = with_token_usage(generate_test_question_and_answer(model), "test_question")
+
+        # Generate bullet points
+        self.bullet_chain = with_token_usage(generate_bullet_points(model), "bullet_points")
+
+        answer_stage = (
+            RunnablePassthrough.assign(documents=timed(self.retriever, "retrieval")) |
+            RunnablePassthrough.assign(bank_question=timed(RunnableLambda(find_bank_question), "question_bank_lookup")) |
+            timed(RunnableLambda(budget_context), "context_budget") |
+            RunnablePassthrough.assign(answer=timed(self.answer_chain, "answer"))
+        )
+        # A question of the question bank saves the test-question LLM call
+        test_question_step = RunnableBranch(
+            (lambda inputs: inputs["bank_question"] is not None, RunnableLambda(lambda inputs: None)),
+            timed(self.test_question_chain, "test_question"),
+        )
+        # assign() with several keys runs them as a RunnableParallel
+        self.query_chain = answer_stage | RunnablePassthrough.assign(
+            test_question=test_question_step,
+            bullet_points=timed(self.bullet_chain, "bullet_points"),
+        )
+        self.sequential_query_chain = (
+            answer_stage |
+            RunnablePassthrough.assign(test_question=test_question_step) |
+            RunnablePassthrough.assign(bullet_points=timed(self.bullet_chain, "bullet_points"))
+        )
+
+        self.structured_evaluation_chain = with_token_usage(
+            structured_evaluation_prompt | model | evaluation_parser, "evaluation"
+        )
+        self.evaluation_chain = with_token_usage(RunnableParallel(
+            evaluation=evaluation_prompt | model | StrOutputParser(),
+            confidence=confidence_prompt | model | StrOutputParser(),
+        ), "evaluation")
+
+    def retrieve(self, inputs):
+        """
+        Retrieve the context of a question the way inputs["retrieval_mode"] says, see
+        `prepare_retrieval`, with the knobs of inputs["retrieval"] (k, fetch_k, lambda_mult).
+        """
+        mode = inputs.get("retrieval_mode", "vector")
+        k, fetch_k, lambda_mult = retrieval_knobs(inputs.get("retrieval"))
+
+        if mode in ("lexical", "hybrid"):
+            lexical_hits = inputs.get("lexical_hits")
+            if lexical_hits is None:
+                lexical_hits, _ = lexical_search(
+                    [store.docstore for store in self.stores], inputs["question"], limit=fetch_k
+                )
+            if mode == "lexical":
+                return [document for document, _ in lexical_hits[:k]]
+            return hybrid_search(self.stores, inputs["question_vector"], lexical_hits, k=k, fetch_k=fetch_k)
+
+        # Same search as store.as_retriever(search_type="mmr"), reusing the question embedding
+        return mmr_search(self.stores, inputs["question_vector"], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+
+# Compiled pipelines, keyed by (id of the llm, (namespace, index version) of each index searched)
+MAX_PIPELINES = 64
+pipelines = {}
+pipelines_lock = threading.Lock()
+
+def get_pipeline(shards, model=None):
+    """
+    Return the compiled chains for this LLM and these indexes, building them on first use.
+
+    Args:
+        shards (tuple): (namespace, stores, version) of the indexes searched, see `get_shards`.
+            Evaluation, which doesn't search, passes an empty tuple.
+    """
+    model = model or get_llm()
+    key = (id(model), tuple((namespace, version) for namespace, _, version in shards))
+    pipeline = pipelines.get(key)
+    if pipeline is None:
+        with pipelines_lock:
+            pipeline = pipelines.get(key)
+            if pipeline is None:
+                # Pipelines of older index versions are never used again
+                while len(pipelines) >= MAX_PIPELINES:
+                    pipelines.pop(next(iter(pipelines)))
+                pipeline = pipelines[key] = Pipeline(model, [store for _, stores, _ in shards for store in stores])
+    return pipeline
+
+def clear_pipelines():
+    """Drop every compiled pipeline, they are rebuilt on the next request."""
+    with pipelines_lock:
+        pipelines.clear()
+
+class PendingQuery:
+    """
+    A question whose retrieval inputs are ready, between the semantic cache lookup and
+    the LLM calls. Shared by `query()`, `aquery()` and the streaming versions.
+    """
+
+    def __init__(self, user_input, namespaces, retrieval_mode, retrieval, db=None):
+        # Take a reference to the live indexes, uploads may swap them while we are answering
+        self.shards = get_shards(namespaces)
+        self.version = tuple(version for _, _, version in self.shards)
+
+        # Generate unique id, unless the test question comes from the question bank
+        self.test_question_id = generate_test_question_id()
+        self.bank_question = None
+
+        self.timings = {}
+        self.start = time.perf_counter()
+        self.inputs = prepare_retrieval(
+            user_input, [store for _, stores, _ in self.shards for store in stores], retrieval_mode or EnvVariable.RETRIEVAL_MODE.value,
+            self.timings, retrieval=retrieval,
+        )
+        self.question_vector = self.inputs["question_vector"]
+        # Where the question bank is looked up, see `find_bank_question`
+        self.inputs["db"] = db
+        self.semantic_cache = get_semantic_cache(namespaces, self.inputs["retrieval_mode"], retrieval)
+
+        # Reuse the response to a near-identical question asked against the same documents
+        self.cached_response = None
+        if self.question_vector is not None:
+            self.cached_response = self.semantic_cache.lookup(self.question_vector, self.version)
+            inc("semantic_cache_lookups_total", help_text="Semantic cache lookups by result",
+                result="miss" if self.cached_response is None else "hit")
+
+    def use_bank_question(self, bank_question):
+        """Take the test question from the question bank, it's already saved under its own id."""
+        self.bank_question = bank_question
+        if bank_question is not None:
+            self.test_question_id = bank_question["test_question_id"]
+
+    def finish(self, result, cached):
+        """
+        The response to the client, the result of the chains being cached if it is new.
+        `question_bank` tells whether the test question is already saved.
+        """
+        if not cached and self.question_vector is not None:
+            self.semantic_cache.add(self.question_vector, self.version, result)
+        self.timings["total"] = round((time.perf_counter() - self.start) * 1000, 1)
+        return {
+            **result,
+            "test_question_id": self.test_question_id,
+            "question_bank": self.bank_question is not None,
+            "index_version": list(self.version),
+            "cached": cached,
+            "retrieval_mode": self.inputs["retrieval_mode"],
+            "context_tokens": self.inputs["context_tokens"],
+            "timings": self.timings,
+        }
+
+def parse_query_response(response):
+    """The answer, bullet points, test question and answer out of the query chain outputs."""
+    if response.get("bank_question") is not None:
+        test_question = response["bank_question"]["test_question"]
+        test_answer = response["bank_question"]["test_answer"]
+    else:
+        test_question, test_answer = parse_test_question(response['test_question'])
+    return {
+        "answer": response["answer"],
+        "bullet_points": parse_bullet_points(response['bullet_points']),
+        "test_answer": test_answer,
+        "test_question": test_question,
+    }
+
+def query(
+    user_input, parallel=True, model=None, namespaces=(DEFAULT_NAMESPACE,), retrieval_mode=None, retrieval=None,
+    db=None,
+):
+    """
+    Answer a question from the indexed documents, with bullet points and a test question.
+
+    The test question and the bullet points only depend on the answer, so by default they
+    are generated concurrently once it arrives: two LLM round-trips end to end instead of
+    three. `parallel=False` runs the three chains one after the other. With a database
+    `db`, a retrieved chunk's question from the question bank is used instead of
+    generating one, see `build_question_bank`.
+
+    Only the indexes of `namespaces` are searched, with `retrieval_mode` ("vector",
+    "hybrid", "lexical" or "auto", RETRIEVAL_MODE by default) and the `retrieval` knobs,
+    see `prepare_retrieval`.
+    """
+    pending = PendingQuery(user_input, namespaces, retrieval_mode, retrieval, db=db)
+    if pending.cached_response is not None:
+        return pending.finish(pending.cached_response, cached=True)
+
+    pipeline = get_pipeline(pending.shards, model)
+    chain = pipeline.query_chain if parallel else pipeline.sequential_query_chain
+    with request_timings(pending.timings):
+        response = chain.invoke(pending.inputs)
+    pending.use_bank_question(response["bank_question"])
+
+    # Return the response along with the bullet points, test question, and test question ID
+    return pending.finish(parse_query_response(response), cached=False)
+
+async def aquery(
+    user_input, parallel=True, model=None, namespaces=(DEFAULT_NAMESPACE,), retrieval_mode=None, retrieval=None,
+    db=None,
+):
+    """
+    Async version of `query()`, used by the ASGI app.
+
+    The question embedding and the searches run in a worker thread, the LLM calls are
+    awaited so a waiting request holds no thread.
+    """
+    pending = await asyncio.to_thread(PendingQuery, user_input, namespaces, retrieval_mode, retrieval, db)
+    if pending.cached_response is not None:
+        return pending.finish(pending.cached_response, cached=True)
+
+    pipeline = get_pipeline(pending.shards, model)
+    chain = pipeline.query_chain if parallel else pipeline.sequential_query_chain
+    with request_timings(pending.timings):
+        response = await chain.ainvoke(pending.inputs)
+    pending.use_bank_question(response["bank_question"])
+    return pending.finish(parse_query_response(response), cached=False)
+
+def document_metadata(document):
+    """Summary of a retrieved chunk sent to the client before the answer."""
+    return {
+        "source": document.metadata.get("source"),
+        "page": document.metadata.get("page"),
+        "section": document.metadata.get("section"),
+        "preview": document.page_content[:200],
+    }
+
+def test_question_event(pending, result):
+    """The "test_question" stream event, `question_bank` telling whether it's already saved."""
+    return "test_question", {
+        "test_question": result["test_question"],
+        "test_answer": result["test_answer"],
+        "test_question_id": pending.test_question_id,
+        "question_bank": pending.bank_question is not None,
+    }
+
+def cached_stream_events(pending):
+    """The events of `stream_query()` when the response comes from the semantic cache."""
+    cached_response = pending.cached_response
+    yield "context", {"documents": [], "cached": True}
+    yield "token", {"token": cached_response["answer"]}
+    yield "bullet_points", {"bullet_points": cached_response["bullet_points"]}
+    yield test_question_event(pending, cached_response)
+    pending.timings["total"] = round((time.perf_counter() - pending.start) * 1000, 1)
+    yield "done", {
+        "cached": True,
+        "retrieval_mode": pending.inputs["retrieval_mode"],
+        "index_version": list(pending.version),
+        "timings": pending.timings,
+    }
+
+def follow_up_event(pending, result, name, output):
+    """Add the output of a follow-up chain to `result` and return its stream event."""
+    if name == "bullet_points":
+        result["bullet_points"] = parse_bullet_points(output)
+        return "bullet_points", {"bullet_points": result["bullet_points"]}
+    result["test_question"], result["test_answer"] = parse_test_question(output)
+    return test_question_event(pending, result)
+
+def bank_question_event(pending, result):
+    """Add the question bank's test question to `result` and return its stream event."""
+    result["test_question"] = pending.bank_question["test_question"]
+    result["test_answer"] = pending.bank_question["test_answer"]
+    return test_question_event(pending, result)
+
+def done_event(pending, result):
+    """The last event of a stream, once the response is complete."""
+    response = pending.finish(result, cached=False)
+    return "done", {
+        key: response[key] for key in ("cached", "retrieval_mode", "index_version", "context_tokens", "timings")
+    }
+
+def stream_query(user_input, model=None, namespaces=(DEFAULT_NAMESPACE,), retrieval_mode=None, retrieval=None, db=None):
+    """
+    Streaming version of `query()`.
+
+    Yields (event, data) pairs as soon as each part is ready: "context" with the retrieved
+    chunks, one "token" per piece of the answer as the LLM streams it, then "bullet_points"
+    and "test_question" in whichever order they finish (a question bank question first),
+    and "done" with the timings.
+    """
+    pending = PendingQuery(user_input, namespaces, retrieval_mode, retrieval, db=db)
+    if pending.cached_response is not None:
+        yield from cached_stream_events(pending)
+        return
+
+    pipeline = get_pipeline(pending.shards, model)
+    inputs, timings = pending.inputs, pending.timings
+
+    with request_timings(timings):
+        inputs["documents"] = timed(pipeline.retriever, "retrieval").invoke(inputs)
+        pending.use_bank_question(timed(RunnableLambda(find_bank_question), "question_bank_lookup").invoke(inputs))
+    yield "context", {"documents": [document_metadata(document) for document in inputs["documents"]], "cached": False}
+    inputs = timed(RunnableLambda(budget_context), "context_budget").invoke(inputs)
+
+    answer_start = time.perf_counter()
+    answer_tokens = []
+    for token in pipeline.answer_chain.stream(inputs):
+        if not answer_tokens:
+            record_stage("answer_first_token", time.perf_counter() - answer_start, timings)
+        answer_tokens.append(token)
+        yield "token", {"token": token}
+    record_stage("answer", time.perf_counter() - answer_start, timings)
+    inputs["answer"] = "".join(answer_tokens)
+
+    # The test question and the bullet points only need the answer, generate them together
+    result = {"answer": inputs["answer"]}
+    follow_ups = {"bullet_points": timed(pipeline.bullet_chain, "bullet_points")}
+    if pending.bank_question is not None:
+        yield bank_question_event(pending, result)
+    else:
+        follow_ups["test_question"] = timed(pipeline.test_question_chain, "test_question")
+    with ThreadPoolExecutor(max_workers=len(follow_ups)) as executor:
+        futures = {executor.submit(chain.invoke, inputs): name for name, chain in follow_ups.items()}
+        for future in as_completed(futures):
+            yield follow_up_event(pending, result, futures[future], future.result())
+
+    yield done_event(pending, result)
+
+async def astream_query(
+    user_input, model=None, namespaces=(DEFAULT_NAMESPACE,), retrieval_mode=None, retrieval=None, db=None
+):
+    """Async version of `stream_query()`, used by the ASGI app, see `aquery()`."""
+    pending = await asyncio.to_thread(PendingQuery, user_input, namespaces, retrieval_mode, retrieval, db)
+    if pending.cached_response is not None:
+        for event in cached_stream_events(pending):
+            yield event
+        return
+
+    pipeline = get_pipeline(pending.shards, model)
+    inputs, timings = pending.inputs, pending.timings
+
+    with request_timings(timings):
+        inputs["documents"] = await timed(pipeline.retriever, "retrieval").ainvoke(inputs)
+        pending.use_bank_question(
+            await timed(RunnableLambda(find_bank_question), "question_bank_lookup").ainvoke(inputs)
+        )
+    yield "context", {"documents": [document_metadata(document) for document in inputs["documents"]], "cached": False}
+    inputs = await timed(RunnableLambda(budget_context), "context_budget").ainvoke(inputs)
+
+    answer_start = time.perf_counter()
+    answer_tokens = []
+    async for token in pipeline.answer_chain.astream(inputs):
+        if not answer_tokens:
+            record_stage("answer_first_token", time.perf_counter() - answer_start, timings)
+        answer_tokens.append(token)
+        yield "token", {"token": token}
+    record_stage("answer", time.perf_counter() - answer_start, timings)
+    inputs["answer"] = "".join(answer_tokens)
+
+    result = {"answer": inputs["answer"]}
+    tasks = {
+        asyncio.ensure_future(timed(pipeline.bullet_chain, "bullet_points").ainvoke(inputs)): "bullet_points",
+    }
+    if pending.bank_question is None:
+        tasks[asyncio.ensure_future(timed(pipeline.test_question_chain, "test_question").ainvoke(inputs))] = "test_question"
+    try:
+        if pending.bank_question is not None:
+            yield bank_question_event(pending, result)
+        running = set(tasks)
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield follow_up_event(pending, result, tasks[task], task.result())
+    finally:
+        # The client went away before the end of the stream
+        for task in tasks:
+            task.cancel()
+
+    yield done_event(pending, result)
+
+def parse_confidence(confidence_result):
+    """Read the 1-100 score out of the confidence prompt answer, None if there isn't one."""
+    match = re.search(r"\d+", confidence_result)
+    if match is None:
+        return None
+    return max(1, min(100, int(match.group())))
+
+# Function to evaluate the answer using LLM
+def evaluation_result(evaluation):
+    """Response of /evaluate/ from the output of the structured evaluation chain."""
+    return {
+        "knowledge_understood": evaluation.knowledge_understood,
+        "knowledge_confidence": evaluation.knowledge_confidence
+    }
 
+def fallback_evaluation_result(results):
+    """Response of /evaluate/ from the outputs of the verdict and score prompts."""
     return {
-        "knowledge_understood": knowledge_understood,
-        # "question": question,
-        # "correct_answer": correct_answer,
-        "knowledge_confidence": knowledge_confidence
-    }
\ No newline at end of file
+        "knowledge_understood": results["evaluation"].strip().lower().startswith("true"),
+        "knowledge_confidence": parse_confidence(results["confidence"])
+    }
+
+def evaluate_with_llm(question: str, user_answer: str, correct_answer: str, structured: bool = True, model=None) -> dict:
+    """
+    Evaluates whether the user understood the question and gives a confidence score using LLM.
+
+    By default the verdict and the score come from one call whose output is parsed as JSON.
+    If that output can't be parsed, or with `structured=False`, the verdict and score
+    prompts are sent concurrently instead.
+    """
+    inputs = {"question": question, "correct_answer": correct_answer, "user_answer": user_answer}
+    pipeline = get_pipeline((), model)
+
+    if structured:
+        try:
+            return evaluation_result(pipeline.structured_evaluation_chain.invoke(inputs))
+        except OutputParserException:
+            # The model didn't follow the format, fall back to the two simpler prompts
+            pass
+
+    # Call the LLM for understanding and confidence evaluation concurrently
+    return fallback_evaluation_result(pipeline.evaluation_chain.invoke(inputs))
+
+async def aevaluate_with_llm(question: str, user_answer: str, correct_answer: str, structured: bool = True, model=None) -> dict:
+    """Async version of `evaluate_with_llm()`, used by the ASGI app."""
+    inputs = {"question": question, "correct_answer": correct_answer, "user_answer": user_answer}
+    pipeline = get_pipeline((), model)
+
+    if structured:
+        try:
+            return evaluation_result(await pipeline.structured_evaluation_chain.ainvoke(inputs))
+        except OutputParserException:
+            pass
+    return fallback_evaluation_result(await pipeline.evaluation_chain.ainvoke(inputs))
+
+def evaluate_batch(items, structured=True, max_concurrency=16, model=None):
+    """
+    Evaluate many answers at once, with up to `max_concurrency` LLM calls in flight.
+
+    Args:
+        items (list[dict]): Each with "question", "user_answer" and "correct_answer".
+
+    Returns:
+        list[dict]: The result of `evaluate_with_llm` for each item, in the same order, or
+            {"error": message} for the items whose LLM calls failed.
+    """
+    inputs = [
+        {"question": item["question"], "correct_answer": item["correct_answer"], "user_answer": item["user_answer"]}
+        for item in items
+    ]
+    pipeline = get_pipeline((), model)
+    config = {"max_concurrency": max_concurrency}
+    results = [None] * len(inputs)
+
+    if structured:
+        evaluations = pipeline.structured_evaluation_chain.batch(inputs, config=config, return_exceptions=True)
+        for i, evaluation in enumerate(evaluations):
+            if isinstance(evaluation, OutputParserException):
+                continue
+            if isinstance(evaluation, Exception):
+                # One failed item doesn't fail the others
+                results[i] = {"error": str(evaluation)}
+                continue
+            results[i] = evaluation_result(evaluation)
+
+    # Items the structured call couldn't parse go through the two simpler prompts
+    fallback = [i for i, result in enumerate(results) if result is None]
+    if fallback:
+        fallback_results = pipeline.evaluation_chain.batch(
+            [inputs[i] for i in fallback], config=config, return_exceptions=True
+        )
+        for i, result in zip(fallback, fallback_results):
+            results[i] = {"error": str(result)} if isinstance(result, Exception) else fallback_evaluation_result(result)
+
+    return results
@@ -0,0 +1,232 @@
+# instrumentation.py
+
+import importlib
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the metric names
+NAMESPACE = "elearning"
+
+# Upper bounds of the histogram buckets: seconds for durations, items for sizes
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# Timings dict of the request being served (stage -> milliseconds), None outside requests
+current_timings = ContextVar("current_timings", default=None)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of the observed values, as Prometheus exposes them."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PrometheusRegistry:
+    """In-process metrics sink rendered in the Prometheus text format by /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}
+
+    def inc(self, name, value, labels, help_text):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help_text))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels, help_text, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help_text))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        def format_labels(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{escape(str(value))}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (metric, labels), value in sorted(self._counters.items()):
+                        if metric == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for (metric, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class LogSink:
+    """Sink logging the stages slower than `threshold_ms`, to spot regressions without a scraper."""
+
+    def __init__(self, threshold_ms=1000):
+        self.threshold_ms = threshold_ms
+
+    def inc(self, name, value, labels, help_text):
+        pass
+
+    def observe(self, name, value, labels, help_text, buckets):
+        if buckets is DURATION_BUCKETS and value * 1000 >= self.threshold_ms:
+            logger.warning("Slow %s %s: %.0f ms", name, labels, value * 1000)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = PrometheusRegistry()
+
+# Where the measurements go: objects with inc() and observe() like PrometheusRegistry
+sinks = [registry]
+
+
+def add_sink(sink):
+    """Send the measurements to another sink as well, e.g. a StatsD or OpenTelemetry bridge."""
+    sinks.append(sink)
+
+
+def configure_sinks(names, log_threshold_ms=1000):
+    """
+    Set the sinks from a comma-separated list: "prometheus" (served by /metrics), "log"
+    (slow stages logged) or the "module:attribute" path of a sink object or factory.
+    """
+    sinks.clear()
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        if name == "prometheus":
+            sinks.append(registry)
+        elif name == "log":
+            sinks.append(LogSink(log_threshold_ms))
+        else:
+            module_name, _, attribute = name.partition(":")
+            sink = getattr(importlib.import_module(module_name), attribute)
+            sinks.append(sink() if isinstance(sink, type) else sink)
+
+
+def inc(name, value=1, help_text="", **labels):
+    """Add to a counter."""
+    for sink in sinks:
+        sink.inc(f"{NAMESPACE}_{name}", value, labels, help_text)
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, help_text="", **labels):
+    """Record a value in a histogram."""
+    for sink in sinks:
+        sink.observe(f"{NAMESPACE}_{name}", value, labels, help_text, buckets)
+
+
+def record_stage(stage, seconds, timings=None, **labels):
+    """
+    Record the duration of a stage, and add it (in milliseconds) to `timings`, by default
+    the timings of the current request, see `request_timings`.
+    """
+    observe("stage_seconds", seconds, help_text="Duration of each backend stage", stage=stage, **labels)
+    if timings is None:
+        timings = current_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0) + seconds * 1000, 1)
+
+
+@contextmanager
+def stage(name, timings=None, **labels):
+    """Time the block as stage `name`, see `record_stage`. Repeated stages of a request add up."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, timings, **labels)
+
+
+@contextmanager
+def request_timings(timings):
+    """Collect the stages timed while the block runs into `timings`."""
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """
+    LangChain callback counting the LLM calls and tokens of one chain.
+
+    Token counts come from the usage metadata of the response when the provider sends
+    it, otherwise they are counted with `count_tokens` on the prompt and the output.
+    """
+
+    # Cheap and thread-safe, so async runs call it directly instead of in an executor
+    run_inline = True
+
+    def __init__(self, chain, count_tokens):
+        self.chain = chain
+        self.count_tokens = count_tokens
+        self._prompt_tokens = {}  # run id -> estimated prompt tokens
+        self._lock = threading.Lock()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        with self._lock:
+            self._prompt_tokens[run_id] = sum(self.count_tokens(prompt) for prompt in prompts)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        tokens = sum(
+            self.count_tokens(message.content if isinstance(message.content, str) else str(message.content))
+            for batch in messages
+            for message in batch
+        )
+        with self._lock:
+            self._prompt_tokens[run_id] = tokens
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            prompt_tokens = self._prompt_tokens.pop(run_id, 0)
+        generations = [generation for batch in response.generations for generation in batch]
+        usage = getattr(getattr(generations[0], "message", None), "usage_metadata", None) if generations else None
+        if usage:
+            prompt_tokens, completion_tokens = usage["input_tokens"], usage["output_tokens"]
+        else:
+            completion_tokens = sum(self.count_tokens(generation.text) for generation in generations)
+
+        inc("llm_calls_total", help_text="LLM calls by chain", chain=self.chain)
+        inc("llm_tokens_total", prompt_tokens, help_text="LLM tokens by chain", chain=self.chain, kind="prompt")
+        inc("llm_tokens_total", completion_tokens, help_text="LLM tokens by chain", chain=self.chain, kind="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._prompt_tokens.pop(run_id, None)
+        inc("llm_errors_total", help_text="Failed LLM calls by chain", chain=self.chain)
@@ -0,0 +1,145 @@
+# jobs.py
+
+import os
+import shutil
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from env_var import EnvVariable
+from helper import build_question_bank, ingest_documents
+from namespaces import DEFAULT_NAMESPACE
+
+# Minimum delay between two progress writes of the same job
+PROGRESS_INTERVAL = 0.5
+
+
+def process_owner():
+    """Owner of the jobs this process runs: its host name and PID."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_exited(owner):
+    """Whether the process owning jobs is gone. Processes of other hosts are assumed alive."""
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        return False
+    return False
+
+
+class JobProgress:
+    """Progress callback for `ingest_documents` that persists the counters of a job, throttled."""
+
+    def __init__(self, db, job_id):
+        self.db = db
+        self.job_id = job_id
+        self.stage = None
+        self.counters = {}
+        self.last_write = 0.0
+
+    def __call__(self, stage, **counters):
+        self.counters.update(counters)
+        now = time.monotonic()
+
+        # Always write stage changes, otherwise at most every PROGRESS_INTERVAL
+        if stage != self.stage or now - self.last_write >= PROGRESS_INTERVAL:
+            self.stage = stage
+            self.last_write = now
+            self.db.update_job(self.job_id, stage=stage, **self.counters)
+
+
+class IngestionQueue:
+    """
+    Runs document ingestion in background threads so /upload/ can return straight away.
+
+    Jobs and their progress are stored in the IngestionJobs table, the CPU-heavy
+    PDF parsing itself happens in the process pool of pdf_extract. Once a job's chunks
+    are indexed the job is completed, and the question bank of its new chunks is
+    generated in another thread, its progress in the `question_bank` and
+    `questions_generated` columns.
+    """
+
+    def __init__(self, db, max_workers=2):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        # One upload's questions at a time, their LLM calls run concurrently already
+        self.question_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="question-bank")
+
+        # Jobs of processes that exited will never finish. The other processes serving the
+        # same database, e.g. the other workers of the server, are still running theirs
+        with db.scope():
+            db.fail_unfinished_jobs([owner for owner in db.get_unfinished_job_owners() if owner_exited(owner)])
+
+    def submit(self, documents, mode="append", upload_dir=None, namespace=DEFAULT_NAMESPACE, replace_source=False):
+        """
+        Queue the ingestion of documents.
+
+        Args:
+            documents (list[tuple[str, str]]): (source name, PDF file path) pairs.
+            mode (str): "append" or "replace", see `ingest_documents`.
+            upload_dir (str, optional): Folder holding uploaded files, deleted when the job ends.
+            namespace (str): Namespace whose index the documents are added to.
+            replace_source (bool): Whether the documents are new versions of those with the
+                same source name, see `ingest_documents`.
+
+        Returns:
+            str: The job id.
+        """
+        job_id = str(uuid.uuid4())
+        with self.db.scope():
+            self.db.create_job(job_id, owner=process_owner())
+        self.executor.submit(self._run, job_id, documents, mode, upload_dir, namespace, replace_source)
+        return job_id
+
+    def _run(self, job_id, documents, mode, upload_dir, namespace, replace_source):
+        # The worker thread holds its own database connection
+        with self.db.scope():
+            try:
+                self.db.update_job(job_id, status="running", stage="parsing")
+                progress = JobProgress(self.db, job_id)
+                new_chunks = []
+                results, index_version = ingest_documents(
+                    documents, self.db, mode=mode, progress=progress, namespace=namespace,
+                    on_indexed=new_chunks.extend, replace_source=replace_source,
+                )
+                question_bank = "queued" if new_chunks and EnvVariable.QUESTION_BANK.value else None
+
+                # Include the counters the throttling may not have written yet
+                self.db.update_job(
+                    job_id,
+                    status="completed",
+                    stage="completed",
+                    documents=results,
+                    question_bank=question_bank,
+                    **{**progress.counters, "index_version": index_version},
+                )
+                if question_bank:
+                    self.question_executor.submit(self._build_question_bank, job_id, new_chunks, namespace)
+            except Exception as e:
+                self.db.update_job(job_id, status="failed", error=str(e))
+            finally:
+                if upload_dir:
+                    shutil.rmtree(upload_dir, ignore_errors=True)
+
+    def _build_question_bank(self, job_id, chunks, namespace):
+        # Takes a pooled connection per write only, not across the LLM calls of the batches
+        try:
+            self._update_job(job_id, question_bank="running")
+            generated = build_question_bank(
+                chunks, self.db, namespace=namespace,
+                progress=lambda generated: self._update_job(job_id, questions_generated=generated),
+            )
+            self._update_job(job_id, question_bank="completed", questions_generated=generated)
+        except Exception as e:
+            self._update_job(job_id, question_bank="failed", error=str(e))
+
+    def _update_job(self, job_id, **fields):
+        with self.db.scope():
+            self.db.update_job(job_id, **fields)
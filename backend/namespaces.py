@@ -0,0 +1,181 @@
+# namespaces.py
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: the lock only covers the threads of this process
+    fcntl = None
+
+# Namespace of the requests that don't name one, stored at FAISS_PATH itself
+DEFAULT_NAMESPACE = "default"
+
+# Namespaces become folder names, keep them to a safe alphabet
+NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def validate_namespace(namespace):
+    """Return the namespace to use for a request value, raising ValueError if it is invalid."""
+    if namespace is None or namespace == "":
+        return DEFAULT_NAMESPACE
+    if not isinstance(namespace, str) or not NAMESPACE_PATTERN.match(namespace):
+        raise ValueError(f"Invalid namespace {namespace!r}: use 1 to 64 letters, digits, '-' or '_'")
+    return namespace
+
+
+def validate_namespaces(namespaces):
+    """Validate a list of namespaces, defaulting to the default one, without duplicates."""
+    if namespaces is None or isinstance(namespaces, str):
+        namespaces = [namespaces]
+    if not isinstance(namespaces, list):
+        raise ValueError("namespaces must be a list of namespace names")
+    return sorted({validate_namespace(namespace) for namespace in namespaces})
+
+
+def namespace_path(base_path, namespace):
+    """Folder of the index of a namespace: FAISS_PATH for the default one, a sibling folder otherwise."""
+    base_path = base_path.rstrip(os.sep)
+    if namespace == DEFAULT_NAMESPACE:
+        return base_path
+    return f"{base_path}-{namespace}"
+
+
+class ProcessLock:
+    """
+    Lock held by one thread at a time, across all the processes serving the same indexes
+    (e.g. the workers of the server): each acquisition takes flock() on the file `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # flock() doesn't exclude the threads of a process from each other
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            if fcntl is not None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            self._release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        file, self._file = self._file, None
+        try:
+            if file is not None:
+                # Closing the file releases the flock
+                file.close()
+        finally:
+            self._thread_lock.release()
+
+
+class NamespaceIndex:
+    """
+    The vector stores of one namespace, its version, the lock serialising the writers of
+    its index and the one serialising its ingestion jobs, both shared with the other
+    processes, see `ProcessLock`.
+    """
+
+    def __init__(self, namespace, path, version):
+        self.namespace = namespace
+        self.path = path
+        self.version = version
+        # (stores, version) once opened, replaced as a whole so readers see a consistent pair
+        self.snapshot = None
+        self.lock = ProcessLock(f"{path}.lock")
+        # Held by a whole ingestion, from the manifest checks to the manifest writes
+        self.ingest_lock = ProcessLock(f"{path}.ingest.lock")
+        # Opening the stores of a version happens once per process, not once per request
+        self.load_lock = threading.Lock()
+
+
+class IndexRegistry:
+    """
+    The indexes of all namespaces, at most `max_loaded` of them open at a time.
+
+    Indexes are saved on every update, so evicting the least recently used one only
+    closes it; it is opened again from disk on its next use. Requests holding a
+    reference to evicted stores can keep searching them. The saved version is checked
+    on every use, so updates published by other processes are picked up as well.
+    """
+
+    def __init__(self, base_path, loader, read_version, max_loaded=8):
+        # loader(path) returns the (stores, version) of the index saved in `path`
+        self.base_path = base_path
+        self.max_loaded = max_loaded
+        self._loader = loader
+        self._read_version = read_version
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._loaded = OrderedDict()  # namespace -> None, least recently used first
+
+    def get(self, namespace):
+        """Return the NamespaceIndex of a namespace, without opening its stores."""
+        with self._lock:
+            index = self._indexes.get(namespace)
+            if index is None:
+                path = namespace_path(self.base_path, namespace)
+                index = self._indexes[namespace] = NamespaceIndex(namespace, path, self._read_version(path))
+            return index
+
+    def exists(self, namespace):
+        """Whether documents were uploaded to a namespace."""
+        return os.path.exists(namespace_path(self.base_path, namespace))
+
+    def open(self, namespace):
+        """
+        Return the (stores, version) of a namespace, opening its stores on first use and
+        again whenever another process has published a newer version.
+
+        Raises:
+            LookupError: Nothing was uploaded to the namespace.
+        """
+        index = self.get(namespace)
+        version = self._read_version(index.path)
+        snapshot = index.snapshot
+        if snapshot is None or snapshot[1] < version:
+            with index.load_lock:
+                snapshot = index.snapshot
+                if snapshot is None or snapshot[1] < version:
+                    if not os.path.exists(index.path):
+                        raise LookupError(f"No documents were uploaded to namespace {namespace!r}")
+                    stores, index.version = self._loader(index.path)
+                    snapshot = index.snapshot = (stores, index.version)
+        self._touch(namespace)
+        return snapshot
+
+    def publish(self, namespace, stores, version):
+        """Swap in the new stores of a namespace after an update. Called with the index lock held."""
+        index = self.get(namespace)
+        with index.load_lock:
+            index.version = version
+            index.snapshot = (stores, version)
+        self._touch(namespace)
+
+    def _touch(self, namespace):
+        with self._lock:
+            self._loaded[namespace] = None
+            self._loaded.move_to_end(namespace)
+            while len(self._loaded) > self.max_loaded:
+                evicted, _ = self._loaded.popitem(last=False)
+                self._indexes[evicted].snapshot = None
+
+    def stats(self):
+        """The namespaces known to this process and those with an open index."""
+        with self._lock:
+            return {
+                "loaded": list(self._loaded),
+                "max_loaded": self.max_loaded,
+                "versions": {namespace: index.version for namespace, index in self._indexes.items()},
+            }
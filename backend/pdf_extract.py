@@ -0,0 +1,110 @@
+# pdf_extract.py
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from PyPDF2 import PdfReader
+
+from env_var import EnvVariable
+
+# Number of pages parsed by a worker in one task
+PAGES_PER_TASK = 8
+
+# Documents shorter than this are parsed in-process, a pool round-trip costs more than it saves
+MIN_PAGES_FOR_POOL = 16
+
+_executor = None
+
+
+def get_worker_count():
+    """Number of processes used to parse PDFs, all cores unless PDF_WORKERS is set."""
+    return EnvVariable.PDF_WORKERS.value or os.cpu_count() or 1
+
+
+def start_executor():
+    """
+    Create the process pool shared by all uploads and start its workers. Called by the
+    apps at startup, before the ingestion threads exist: forked then, the workers inherit
+    no lock and no file descriptor of an upload in progress.
+    """
+    global _executor
+    if _executor is None:
+        # A forking pool starts all its workers on the first task
+        context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        _executor = ProcessPoolExecutor(max_workers=get_worker_count(), mp_context=context)
+        _executor.submit(os.getpid).result()
+    return _executor
+
+
+def get_executor():
+    """
+    Return the process pool shared by all uploads. Without `start_executor`, e.g. in
+    scripts, it's created on first use, from an ingestion thread that may hold locks: its
+    workers then come from a forkserver, a fresh process holding none of them.
+    """
+    global _executor
+    if _executor is None:
+        context = None
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        _executor = ProcessPoolExecutor(max_workers=get_worker_count(), mp_context=context)
+    return _executor
+
+
+def count_pages(path):
+    """Number of pages of a PDF file."""
+    with open(path, 'rb') as f:
+        return len(PdfReader(f).pages)
+
+
+def extract_page_range(path, start, end):
+    """Extract the text of pages [start, end) of a PDF file. Runs in the worker processes."""
+    with open(path, 'rb') as f:
+        pdf_reader = PdfReader(f)
+        return [pdf_reader.pages[page_no].extract_text() or "" for page_no in range(start, end)]
+
+
+def iter_pdf_pages(paths, pages_per_task=PAGES_PER_TASK):
+    """
+    Stream the pages of PDF files as (path, page_no, text) records, in document and page order.
+
+    Large documents are split into ranges of `pages_per_task` pages that are parsed in
+    parallel by the process pool. At most two tasks per worker are in flight, so only
+    a bounded window of page texts is held in memory however long the documents are.
+    """
+    executor = None
+    max_pending = 2 * get_worker_count()
+    pending = deque()
+
+    def collect(task):
+        path, start, future = task
+        for offset, text in enumerate(future.result()):
+            yield path, start + offset, text
+
+    try:
+        for path in paths:
+            page_count = count_pages(path)
+
+            if page_count < MIN_PAGES_FOR_POOL:
+                # Keep the output ordered: emit what the pool is still working on first
+                while pending:
+                    yield from collect(pending.popleft())
+                for page_no, text in enumerate(extract_page_range(path, 0, page_count)):
+                    yield path, page_no, text
+                continue
+
+            executor = executor or get_executor()
+            for start in range(0, page_count, pages_per_task):
+                end = min(start + pages_per_task, page_count)
+                pending.append((path, start, executor.submit(extract_page_range, path, start, end)))
+                if len(pending) >= max_pending:
+                    yield from collect(pending.popleft())
+
+        while pending:
+            yield from collect(pending.popleft())
+    finally:
+        # The consumer may stop early, don't leave work queued in the pool
+        for _, _, future in pending:
+            future.cancel()
@@ -0,0 +1,429 @@
+# provider_client.py
+
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from instrumentation import SIZE_BUCKETS, inc, observe
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Exceptions of the OpenAI, Google and HTTP client libraries that are worth retrying,
+# by class name so that none of them has to be imported
+RETRYABLE_ERRORS = {
+    "RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",
+    "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError",
+}
+
+
+def is_retryable(error):
+    """Whether a failed provider call may succeed if sent again."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status in RETRYABLE_STATUSES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` calls per second on average and bursts of `burst` calls.
+
+    Callers reserve a token and are told how long to wait for it, so the same bucket
+    paces threads (`acquire`) and asyncio tasks (`aacquire`). A rate of 0 disables it.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, possibly ahead of time, and return the seconds to wait before using it."""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class ConcurrencyLimiter:
+    """
+    Semaphore of `limit` slots shared by threads and asyncio tasks, first come first served.
+    A released slot is handed over to the oldest waiter.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._waiters = deque()  # (loop, future) of tasks, (None, threading.Event) of threads
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return
+            event = threading.Event()
+            self._waiters.append((None, event))
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                handed_over = waiter not in self._waiters
+                if not handed_over:
+                    self._waiters.remove(waiter)
+            # The slot was given to us before the cancellation, pass it on
+            if handed_over:
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._active -= 1
+                return
+            loop, waiter = self._waiters.popleft()
+        if loop is None:
+            waiter.set()
+        else:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ProviderGate:
+    """
+    What every call to one provider model goes through: the token bucket, at most
+    `max_concurrency` calls in flight, and up to `max_retries` retries of the calls
+    failing with a retryable error, after an exponential backoff with full jitter
+    (a random delay between 0 and min(backoff_max, backoff_base * 2^attempt)).
+    """
+
+    def __init__(self, name, rate=0.0, max_concurrency=32, max_retries=5, backoff_base=0.5, backoff_max=30.0):
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.slots = ConcurrencyLimiter(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _enter(self):
+        start = time.perf_counter()
+        self.bucket.acquire()
+        self.slots.acquire()
+        self._record_wait(start)
+
+    async def _aenter(self):
+        start = time.perf_counter()
+        await self.bucket.aacquire()
+        await self.slots.aacquire()
+        self._record_wait(start)
+
+    def _record_wait(self, start):
+        observe("provider_wait_seconds", time.perf_counter() - start,
+                help_text="Time provider calls waited for the rate limiter and a concurrency slot", model=self.name)
+        inc("provider_calls_total", help_text="Calls sent to the model providers", model=self.name)
+
+    def _retry_delay(self, error, attempt):
+        """Backoff before the next attempt, None if the error must be raised."""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = self.backoff(attempt)
+        inc("provider_retries_total", help_text="Provider calls retried after a retryable error", model=self.name)
+        logger.warning("%s call failed (%s), retrying in %.2f s", self.name, error, delay)
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` through the gate, in this thread."""
+        attempt = 0
+        while True:
+            self._enter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.slots.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, function, *args, **kwargs):
+        """Await `function(*args, **kwargs)` through the gate."""
+        attempt = 0
+        while True:
+            await self._aenter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.slots.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stream(self, open_stream):
+        """
+        Iterate over the stream `open_stream()` returns, holding a slot until it ends.
+        A stream failing before its first item is opened again, later errors are raised.
+        """
+        attempt = 0
+        while True:
+            self._enter()
+            try:
+                iterator = iter(open_stream())
+                try:
+                    first = next(iterator)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                else:
+                    yield first
+                    yield from iterator
+                    return
+            finally:
+                self.slots.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def astream(self, open_stream):
+        """Async version of `stream`."""
+        attempt = 0
+        while True:
+            await self._aenter()
+            try:
+                iterator = aiter(open_stream())
+                try:
+                    first = await anext(iterator)
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                else:
+                    yield first
+                    async for item in iterator:
+                        yield item
+                    return
+            finally:
+                self.slots.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def prompt_key(messages, stop, kwargs):
+    """What makes two LLM calls identical: the messages, the stop words and the call options."""
+    return (
+        tuple((message.type, str(message.content)) for message in messages),
+        tuple(stop or ()),
+        repr(sorted(kwargs.items())),
+    )
+
+
+class ManagedChatModel(BaseChatModel):
+    """
+    Chat model sending the calls of `model` through a `ProviderGate`, and coalescing
+    identical prompts: while a prompt is in flight, the same prompt sent again waits for
+    its answer instead of calling the provider. Streams are gated but not coalesced.
+    """
+
+    model: BaseChatModel
+    gate: Any
+
+    def model_post_init(self, context):
+        self._lock = threading.Lock()
+        self._in_flight = {}  # prompt key -> Future of the answer
+        self._in_flight_async = {}  # (event loop id, prompt key) -> asyncio Future
+
+    @property
+    def _llm_type(self):
+        return self.model._llm_type
+
+    def _coalesced(self, in_flight, key, future):
+        """Register `future` for `key`, or return the future already answering the same prompt."""
+        with self._lock:
+            leader = in_flight.get(key)
+            if leader is None:
+                in_flight[key] = future
+                return None
+        inc("llm_coalesced_total", help_text="LLM calls answered by an identical call in flight")
+        return leader
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = prompt_key(messages, stop, kwargs)
+        future = Future()
+        leader = self._coalesced(self._in_flight, key, future)
+        if leader is not None:
+            message = leader.result()
+        else:
+            try:
+                message = self.gate.call(self.model.invoke, messages, stop=stop, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(message)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+        # Every caller gets its own copy, langchain sets the run id on it
+        return ChatResult(generations=[ChatGeneration(message=message.model_copy())])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        key = (id(loop), prompt_key(messages, stop, kwargs))
+        future = loop.create_future()
+        leader = self._coalesced(self._in_flight_async, key, future)
+        if leader is not None:
+            # The leader being cancelled must not cancel the followers, they get an error instead
+            message = await asyncio.shield(leader)
+        else:
+            try:
+                message = await self.gate.acall(self.model.ainvoke, messages, stop=stop, **kwargs)
+            except BaseException as e:
+                future.set_exception(e if isinstance(e, Exception) else RuntimeError("Coalesced LLM call cancelled"))
+                # Retrieve the exception so asyncio doesn't log it when no follower did
+                future.exception()
+                raise
+            else:
+                future.set_result(message)
+            finally:
+                with self._lock:
+                    del self._in_flight_async[key]
+        return ChatResult(generations=[ChatGeneration(message=message.model_copy())])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self.gate.stream(lambda: self.model.stream(messages, stop=stop, **kwargs)):
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in self.gate.astream(lambda: self.model.astream(messages, stop=stop, **kwargs)):
+            yield ChatGenerationChunk(message=chunk)
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embedding model merging the calls of concurrent threads (uploads, question lookups)
+    into fewer provider calls, sent through a `ProviderGate`.
+
+    Requests arriving within `window` seconds of each other are sent together, up to
+    `max_batch` texts per call, and each caller gets its own vectors back. Questions are
+    batched with `embed_documents` as well: the providers used here embed a question
+    and a document the same way.
+    """
+
+    def __init__(self, provider, gate, window=0.005, max_batch=256):
+        self.provider = provider
+        self.gate = gate
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        # Batches are sent from these threads, so the next one can be collected meanwhile
+        self._senders = ThreadPoolExecutor(max_workers=gate.slots.limit, thread_name_prefix="embed-batch")
+        self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _run(self):
+        pending = None
+        while True:
+            # Wait for a first request, then give concurrent callers a moment to add theirs
+            batch = [pending or self._queue.get()]
+            pending = None
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if size + len(request[0]) > self.max_batch:
+                    # Starts the next batch
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        observe("embedding_microbatch_requests", len(batch), buckets=SIZE_BUCKETS,
+                help_text="Embedding requests merged into one provider call")
+        try:
+            vectors = self.gate.call(self.provider.embed_documents, [text for texts, _ in batch for text in texts])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        start = 0
+        for texts, future in batch:
+            future.set_result(vectors[start:start + len(texts)])
+            start += len(texts)
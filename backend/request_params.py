@@ -0,0 +1,67 @@
+# request_params.py
+
+from helper import indexes
+from namespaces import validate_namespaces
+from retrieval import MAX_FETCH_K, MAX_K, RETRIEVAL_MODES
+
+
+class NamespaceNotFound(LookupError):
+    """A /query/ request names a namespace nothing was uploaded to (404)."""
+
+
+def query_namespaces(body):
+    """
+    Namespaces a /query/ request searches: "namespaces" (a list) or "namespace", else the default one.
+
+    Raises:
+        ValueError: A namespace name is invalid.
+        NamespaceNotFound: A namespace has no index.
+    """
+    namespaces = validate_namespaces(body.get("namespaces", body.get("namespace")))
+    missing = [namespace for namespace in namespaces if not indexes.exists(namespace)]
+    if missing:
+        raise NamespaceNotFound(f"No documents were uploaded to namespace(s) {', '.join(missing)}")
+    return namespaces
+
+
+def replace_source(value):
+    """
+    Whether an /upload/ request says its documents are new versions of the documents of
+    the same source name ("replace_source": true, or "true" as a form field).
+    """
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return value is True
+
+
+def retrieval_mode(body):
+    """Retrieval mode a /query/ request asks for, None for the RETRIEVAL_MODE default."""
+    mode = body.get("retrieval_mode")
+    if mode is not None and mode not in RETRIEVAL_MODES:
+        raise ValueError(f"retrieval_mode must be one of {', '.join(RETRIEVAL_MODES)}")
+    return mode
+
+
+def retrieval_knobs(body):
+    """
+    Search knobs of a /query/ request: "k" chunks (1 to MAX_K) picked by MMR among the
+    "fetch_k" nearest (k to MAX_FETCH_K), with relevance weight "lambda_mult" (0 to 1).
+    Only the knobs present are returned, the others keep their defaults.
+    """
+    knobs = {}
+    for name, low, high in (("k", 1, MAX_K), ("fetch_k", 1, MAX_FETCH_K)):
+        value = body.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+            raise ValueError(f"{name} must be an integer from {low} to {high}")
+        knobs[name] = value
+    if knobs.get("fetch_k", MAX_FETCH_K) < knobs.get("k", 1):
+        raise ValueError("fetch_k must be at least k")
+
+    lambda_mult = body.get("lambda_mult")
+    if lambda_mult is not None:
+        if not isinstance(lambda_mult, (int, float)) or isinstance(lambda_mult, bool) or not 0 <= lambda_mult <= 1:
+            raise ValueError("lambda_mult must be a number from 0 to 1")
+        knobs["lambda_mult"] = float(lambda_mult)
+    return knobs
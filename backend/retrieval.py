@@ -0,0 +1,136 @@
+# retrieval.py
+
+import re
+
+import numpy as np
+
+RETRIEVAL_MODES = ("vector", "hybrid", "lexical", "auto")
+
+# Upper bounds of the k and fetch_k knobs of a query
+MAX_K = 50
+MAX_FETCH_K = 200
+
+# Constant of reciprocal rank fusion, 60 as in the original paper
+RRF_K = 60
+
+# Words \w+ splits out, identifiers such as fact_sales stay whole like in the full-text index
+TERM_PATTERN = re.compile(r"\w+")
+
+# Question words that would match most chunks without telling them apart
+STOPWORDS = frozenset("""
+    a an and are as at be by can do does for from how i in is it its of on or should that the
+    their there these this to was what when where which who why will with you your
+""".split())
+
+
+def query_terms(question):
+    """Distinct lowercase search terms of a question, in order, without stopwords."""
+    terms = []
+    for term in TERM_PATTERN.findall(question.lower()):
+        if term not in STOPWORDS and term not in terms:
+            terms.append(term)
+    return terms
+
+
+def match_expression(terms):
+    """FTS5 query matching chunks that contain any of the terms, each quoted as a literal."""
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def keyword_confidence(hits, terms):
+    """
+    How sure the lexical results are to answer the question on their own, from 0 to 1.
+
+    It is the share of the query terms the best chunk contains, times how clearly it
+    outscores the runner-up: a chunk matching every rare term of the question (a table
+    name, an acronym) scores high, a vague question matching many chunks alike scores low.
+    """
+    if not hits or not terms:
+        return 0.0
+    best_document, best_score = hits[0]
+    best_terms = set(TERM_PATTERN.findall(best_document.page_content.lower()))
+    coverage = sum(term in best_terms for term in terms) / len(terms)
+    margin = 1.0 if len(hits) == 1 else max(0.0, 1.0 - hits[1][1] / best_score)
+    return coverage * margin
+
+
+def lexical_search(docstores, question, limit=20):
+    """
+    BM25 search of a question in the full-text index of one or more docstores.
+
+    Scores of different docstores come from different term statistics, they are merged
+    as if they were comparable.
+
+    Returns:
+        tuple[list[tuple[Document, float]], float]: The best `limit` chunks with their
+            BM25 score (higher is better) and the `keyword_confidence` of the results.
+    """
+    terms = query_terms(question)
+    if not terms:
+        return [], 0.0
+    expression = match_expression(terms)
+
+    hits = []
+    for docstore in docstores:
+        hits.extend(docstore.search_text(expression, limit))
+    hits = sorted(hits, key=lambda hit: hit[1], reverse=True)[:limit]
+    return hits, keyword_confidence(hits, terms)
+
+
+def reciprocal_rank_fusion(rankings, limit, k=RRF_K):
+    """
+    Merge ranked lists of documents: each document scores the sum of 1 / (k + rank) over
+    the lists it appears in. Documents are identified by their id.
+    """
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            scores[document.id] = scores.get(document.id, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(document.id, document)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [documents[document_id] for document_id in best]
+
+
+def mmr_select(query_vector, candidate_vectors, k=4, lambda_mult=0.5):
+    """
+    Maximal marginal relevance over candidate vectors, vectorized.
+
+    The cosine similarities between the question and the candidates, and between all
+    candidates, are computed in one matrix product; each of the `k` picks then only
+    updates a running maximum. Same result as langchain's maximal_marginal_relevance.
+
+    Args:
+        query_vector (array-like): The question embedding, shape (dim,).
+        candidate_vectors (np.ndarray): The candidate embeddings, shape (n, dim), nearest first.
+        lambda_mult (float): 1 for relevance only, 0 for diversity only.
+
+    Returns:
+        list[int]: Indexes of the picked candidates, in the order they were picked.
+    """
+    n = len(candidate_vectors)
+    if n == 0 or k <= 0:
+        return []
+
+    vectors = np.empty((n + 1, candidate_vectors.shape[1]), dtype=np.float32)
+    vectors[0] = query_vector
+    vectors[1:] = candidate_vectors
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1.0
+    # column 0: to the question, then to each candidate
+    similarities = (vectors[1:] @ vectors.T) / np.outer(norms[1:], norms)
+    relevance = similarities[:, 0]
+    between = similarities[:, 1:]
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = between[:, selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, between[:, best], out=redundancy)
+    return selected
@@ -0,0 +1,99 @@
+# semantic_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Responses of past questions, looked up by cosine similarity of the question embeddings.
+
+    Question vectors live in a small dedicated FAISS inner-product index. Entries expire
+    after `ttl` seconds, the least recently used ones are evicted above `max_entries`,
+    and the whole cache is dropped as soon as it is used with a different document
+    index version, since its answers came from the old documents.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._index = None
+        self._entries = OrderedDict()  # id -> (created_at, response), least recently used first
+        self._next_id = 0
+        self._index_version = None
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _reset(self, index_version):
+        self._index = None
+        self._entries.clear()
+        self._index_version = index_version
+
+    def _remove(self, entry_ids):
+        self._index.remove_ids(np.asarray(entry_ids, dtype=np.int64))
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+
+    def lookup(self, question_vector, index_version):
+        """Return the stored response of a similar enough question, or None."""
+        vector = self._normalize(question_vector)
+        with self._lock:
+            if index_version != self._index_version:
+                self._reset(index_version)
+
+            if self._entries:
+                scores, ids = self._index.search(vector, 1)
+                entry_id = int(ids[0][0])
+                if entry_id != -1 and scores[0][0] >= self.threshold:
+                    created_at, response = self._entries[entry_id]
+                    if time.time() - created_at <= self.ttl:
+                        self._entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return response
+                    self._remove([entry_id])
+
+            self.misses += 1
+            return None
+
+    def add(self, question_vector, index_version, response):
+        """Store the response to a question answered from the given index version."""
+        vector = self._normalize(question_vector)
+        with self._lock:
+            if index_version != self._index_version:
+                self._reset(index_version)
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+            self._entries[entry_id] = (time.time(), response)
+
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                self._remove(list(self._entries)[:overflow])
+
+    def stats(self):
+        """Hit/miss counters since startup and the current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "index_version": self._index_version,
+            }
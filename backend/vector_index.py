@@ -0,0 +1,126 @@
+# vector_index.py
+
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# faiss index factory encodings of the optional scalar quantizer
+QUANTIZERS = {"none": "Flat", "fp16": "SQfp16", "int8": "SQ8"}
+
+# faiss wants about 39 training points per centroid, PQ codebooks have 256 centroids
+TRAINING_POINTS_PER_CENTROID = 39
+PQ_CENTROIDS = 256
+MAX_TRAINING_SAMPLE = 100000
+
+HNSW_NEIGHBORS = 32
+HNSW_EF_SEARCH = 64
+
+
+def ivf_list_count(n):
+    """Number of IVF lists for n vectors: about 4*sqrt(n), with enough points to train each."""
+    return min(int(4 * math.sqrt(n)), n // TRAINING_POINTS_PER_CENTROID)
+
+
+def pq_subquantizer_count(dim):
+    """Largest number of PQ sub-vectors, up to 64 and of at least 4 dimensions each, that divides the dimension."""
+    for m in range(max(1, min(64, dim // 4)), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def is_trained_layout(index_type, n):
+    """Whether an index of `index_type` holding n vectors is a trained IVF one, not the flat fallback."""
+    nlist = ivf_list_count(n)
+    if index_type == "ivf_pq":
+        return nlist >= 2 and n >= PQ_CENTROIDS * TRAINING_POINTS_PER_CENTROID
+    if index_type == "ivf_flat":
+        return nlist >= 2
+    return False
+
+
+def index_factory_string(index_type, quantizer, n, dim):
+    """
+    Describe the faiss index to build for n vectors of `dim` dimensions.
+
+    IVF indexes fall back to a flat index (with the same scalar quantizer) when there
+    are too few vectors to train them. The quantizer doesn't apply to IVF-PQ, whose
+    codes are already compressed.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if quantizer not in QUANTIZERS:
+        raise ValueError(f"Unknown quantizer {quantizer!r}, expected one of {tuple(QUANTIZERS)}")
+    encoding = QUANTIZERS[quantizer]
+
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_NEIGHBORS},{encoding}"
+    if not is_trained_layout(index_type, n):
+        return encoding
+
+    nlist = ivf_list_count(n)
+    if index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{pq_subquantizer_count(dim)}"
+    return f"IVF{nlist},{encoding}"
+
+
+def build_index(vectors, index_type="flat", quantizer="none", nprobe=8, seed=0):
+    """
+    Create an empty faiss index suited to `vectors`, trained on a sample of them.
+
+    Args:
+        vectors (array-like): The vectors that will be added, shape (n, dim).
+        index_type (str): "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw".
+        quantizer (str): "none", "fp16" or "int8" scalar quantization of the stored vectors.
+        nprobe (int): Number of IVF lists visited per search.
+
+    Returns:
+        faiss.Index: A trained index, still empty.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_string(index_type, quantizer, n, dim), faiss.METRIC_L2)
+
+    if not index.is_trained:
+        sample = vectors
+        if n > MAX_TRAINING_SAMPLE:
+            rng = np.random.default_rng(seed)
+            sample = vectors[rng.choice(n, MAX_TRAINING_SAMPLE, replace=False)]
+        index.train(sample)
+
+    # MMR search reconstructs the vectors it retrieves, IVF lists need a map from id to list for that
+    try:
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Array)
+    except RuntimeError:
+        pass
+
+    set_search_parameters(index, nprobe)
+    return index
+
+
+def set_search_parameters(index, nprobe=8):
+    """Apply the query-time knobs of IVF and HNSW indexes, a no-op for flat ones."""
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+
+def rebuild_index(index, keep_positions):
+    """
+    Copy of `index` holding only the vectors at `keep_positions`, in that order.
+
+    Used for indexes that can't remove vectors in place, such as HNSW and IVF with a direct map. The copy keeps
+    the training of the original, so no retraining is needed.
+    """
+    vectors = index.reconstruct_n(0, index.ntotal)[np.asarray(keep_positions, dtype=np.int64)]
+    new_index = faiss.clone_index(index)
+    new_index.reset()
+    if len(vectors):
+        new_index.add(vectors)
+    return new_index
@@ -0,0 +1,107 @@
+"""
+Chunks, tokens embedded and retrieval quality of each chunking setting on a PDF (the
+data engineering cookbook by default).
+
+The previous splitter (1000 characters, 200 overlap) is compared with the token-aware
+Chunker at several chunk sizes, overlaps and with or without SimHash near-duplicate
+suppression. With --editions 2 the document is ingested a second time with every page
+slightly edited (its footer changes), like a new edition uploaded under another name:
+most of its chunks are then near-duplicates.
+
+Each question is made of a few words of one line of the PDF, and counts as a hit when
+a chunk containing the whole line is among the 4 retrieved by the MMR search, with the
+fake embedder (bag of hashed words).
+
+    python benchmarks/bench_chunking.py --questions 300 --editions 2
+"""
+import argparse
+import os
+import random
+import time
+
+from common import use_fake_backend
+
+DEFAULT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "doc", "Data_engineering_cookbook.pdf")
+
+# (name, chunk tokens, overlap tokens, dedup), None for the previous character splitter
+SETTINGS = [
+    ("chars 1000/200", None, None, None),
+    ("tokens 256/0", 256, 0, "none"),
+    ("tokens 256/32", 256, 32, "none"),
+    ("tokens 256/32 simhash", 256, 32, "simhash"),
+    ("tokens 256/64 simhash", 256, 64, "simhash"),
+    ("tokens 128/16 simhash", 128, 16, "simhash"),
+    ("tokens 512/32 simhash", 512, 32, "simhash"),
+]
+
+
+def make_questions(pages, count, seed):
+    from retrieval import query_terms
+
+    lines = [line.strip() for page in pages for line in page.split("\n") if len(query_terms(line)) >= 6]
+    rng = random.Random(seed)
+    questions = []
+    for line in rng.sample(lines, min(count, len(lines))):
+        terms = query_terms(line)
+        start = rng.randrange(len(terms) - 4)
+        questions.append((f"What about {' '.join(terms[start:start + 5])}?", line))
+    return questions
+
+
+def split_documents(editions, chunk_tokens, overlap_tokens, dedup, count_tokens):
+    """Chunks of every page of every edition and the number of near-duplicates left out."""
+    from chunking import Chunker
+    from langchain_text_splitters import CharacterTextSplitter
+
+    if chunk_tokens is None:
+        splitter = CharacterTextSplitter(separator="\n", chunk_size=1000, chunk_overlap=200, length_function=len)
+        return [chunk for pages in editions for page in pages for chunk in splitter.split_text(page)], 0
+
+    chunker = Chunker(chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens, dedup=dedup)
+    chunks = []
+    for edition, pages in enumerate(editions):
+        for page_no, page in enumerate(pages):
+            chunks.extend(chunk for chunk, _ in chunker.split_page(page, f"edition-{edition}", page_no))
+    return chunks, chunker.duplicate_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=DEFAULT_PDF)
+    parser.add_argument("--questions", type=int, default=300)
+    parser.add_argument("--editions", type=int, default=1)
+    args = parser.parse_args()
+
+    helper = use_fake_backend()
+    from chunking import get_token_counter
+    from pdf_extract import iter_pdf_pages
+
+    pages = [text for _, _, text in iter_pdf_pages([args.pdf])]
+    editions = [pages] + [
+        [f"{page}\nEdition {edition + 1}, page {page_no + 1}" for page_no, page in enumerate(pages)]
+        for edition in range(1, args.editions)
+    ]
+    questions = make_questions(pages, args.questions, seed=0)
+    count_tokens = get_token_counter("cl100k_base")
+
+    print(f"{len(pages)} pages x {args.editions} edition(s), {len(questions)} questions\n")
+    print(f"{'setting':<24}{'chunks':>8}{'tokens':>9}{'duplicates':>12}{'split ms':>10}{'hit@4':>8}")
+    for name, chunk_tokens, overlap_tokens, dedup in SETTINGS:
+        start = time.perf_counter()
+        chunks, duplicates = split_documents(editions, chunk_tokens, overlap_tokens, dedup, count_tokens)
+        split_ms = (time.perf_counter() - start) * 1000
+        tokens = sum(count_tokens(chunk) for chunk in chunks)
+
+        helper.update_vectorstore(chunks, mode="replace")
+        stores = helper.get_vector_stores()
+        embeddings = helper.get_embeddings()
+        hits = 0
+        for question, line in questions:
+            documents = helper.mmr_search(stores, embeddings.embed_query(question))
+            hits += any(line in document.page_content for document in documents)
+
+        print(f"{name:<24}{len(chunks):>8}{tokens:>9}{duplicates:>12}{split_ms:>10.0f}{hits / len(questions):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
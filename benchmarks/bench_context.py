@@ -0,0 +1,94 @@
+"""
+Context tokens sent to the LLM per /query/ request, and how much of the relevant text
+survives, for several context budgets.
+
+Before the context budget stage the 4 retrieved chunks went whole into the answer,
+test-question and bullet-point prompts. Now the answer prompt gets the sentences most
+relevant to the question within the budget, and the two follow-up prompts only the
+answer (FOLLOW_UP_CONTEXT_TOKENS=0).
+
+Each question is made of a few words of one line of the PDF (the data engineering
+cookbook by default). "kept" is the share of the questions whose line was retrieved
+for which the compressed context still contains all the question words.
+
+    python benchmarks/bench_context.py --questions 300
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+from common import use_fake_backend
+
+DEFAULT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "doc", "Data_engineering_cookbook.pdf")
+
+BUDGETS = [0, 1024, 512, 256, 128]
+
+
+def make_questions(pages, count, seed):
+    from retrieval import query_terms
+
+    lines = [line.strip() for page in pages for line in page.split("\n") if len(query_terms(line)) >= 6]
+    rng = random.Random(seed)
+    questions = []
+    for line in rng.sample(lines, min(count, len(lines))):
+        terms = query_terms(line)
+        start = rng.randrange(len(terms) - 4)
+        questions.append((f"What about {' '.join(terms[start:start + 5])}?", line, terms[start:start + 5]))
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=DEFAULT_PDF)
+    parser.add_argument("--questions", type=int, default=300)
+    args = parser.parse_args()
+
+    helper = use_fake_backend()
+    from chunking import get_token_counter
+    from context_budget import compress_context
+    from pdf_extract import iter_pdf_pages
+    from retrieval import query_terms
+
+    pages = [text for _, _, text in iter_pdf_pages([args.pdf])]
+    helper.update_vectorstore([chunk for page in pages for chunk in helper.get_text_chunks(page)], mode="replace")
+    pipeline = helper.get_pipeline(helper.get_shards())
+    count_tokens = get_token_counter("cl100k_base")
+
+    retrieved = []
+    for question, line, terms in make_questions(pages, args.questions, seed=0):
+        inputs = helper.prepare_retrieval(question, pipeline.stores, "vector", {})
+        documents = pipeline.retrieve(inputs)
+        found = any(line in " ".join(document.page_content.split()) or line in document.page_content
+                    for document in documents)
+        retrieved.append((question, documents, terms, found))
+    answerable = [item for item in retrieved if item[3]]
+
+    print(f"{len(retrieved)} questions, relevant line retrieved for {len(answerable)}\n")
+    print(f"{'budget':>8}{'answer ctx':>12}{'3 prompts before':>18}{'after':>8}{'saved':>8}{'ms':>7}{'kept':>7}")
+    for budget in BUDGETS:
+        context_tokens, before, after, durations, kept = [], [], [], [], 0
+        for question, documents, terms, found in retrieved:
+            start = time.perf_counter()
+            context = compress_context(question, documents, budget, count_tokens)
+            durations.append(time.perf_counter() - start)
+
+            tokens = count_tokens(context)
+            full = sum(count_tokens(document.page_content) for document in documents)
+            context_tokens.append(tokens)
+            before.append(3 * full)
+            after.append(tokens)
+            if found:
+                kept += set(terms) <= set(query_terms(context))
+
+        mean_before, mean_after = statistics.mean(before), statistics.mean(after)
+        print(
+            f"{budget or 'none':>8}{statistics.mean(context_tokens):>12.0f}{mean_before:>18.0f}{mean_after:>8.0f}"
+            f"{1 - mean_after / mean_before:>8.0%}{statistics.mean(durations) * 1000:>7.2f}"
+            f"{kept / max(1, len(answerable)):>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
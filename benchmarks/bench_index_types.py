@@ -0,0 +1,82 @@
+"""
+Build time, size, query latency and recall@10 of the FAISS index types and scalar
+quantizers selectable with FAISS_INDEX_TYPE / FAISS_QUANTIZER.
+
+Vectors are synthetic (random, normalised, grouped around cluster centres so they look
+more like embeddings than uniform noise). Recall is measured against the exact flat index.
+
+    python benchmarks/bench_index_types.py --n 1000000 --dim 384
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+import common  # noqa: F401, puts backend/ on the path
+from vector_index import build_index, index_factory_string
+
+CONFIGURATIONS = [
+    ("flat", "none"),
+    ("flat", "fp16"),
+    ("flat", "int8"),
+    ("ivf_flat", "none"),
+    ("ivf_flat", "int8"),
+    ("ivf_pq", "none"),
+    ("hnsw", "none"),
+    ("hnsw", "int8"),
+]
+
+
+def synthetic_vectors(n, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centres[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def recall_at_k(found, expected):
+    k = expected.shape[1]
+    return sum(len(set(f) & set(e)) for f, e in zip(found, expected)) / (len(expected) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.n + args.queries, args.dim, clusters=max(10, args.n // 1000), seed=0)
+    vectors, queries = vectors[:args.n], vectors[args.n:]
+    print(f"{args.n} vectors of {args.dim} dimensions, {args.queries} queries, recall@{args.k} vs flat\n")
+    print(f"{'index':<16}{'quantizer':<11}{'factory':<18}{'build s':>9}{'size MB':>10}{'ms/query':>10}{'recall':>8}")
+
+    expected = None
+    for index_type, quantizer in CONFIGURATIONS:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type=index_type, quantizer=quantizer, nprobe=args.nprobe)
+        index.add(vectors)
+        build_time = time.perf_counter() - start
+
+        size = len(faiss.serialize_index(index)) / 1e6
+
+        start = time.perf_counter()
+        _, found = index.search(queries, args.k)
+        query_time = (time.perf_counter() - start) * 1000 / args.queries
+
+        if expected is None:
+            expected = found  # the first configuration is the exact flat index
+        factory = index_factory_string(index_type, quantizer, args.n, args.dim)
+        print(
+            f"{index_type:<16}{quantizer:<11}{factory:<18}{build_time:9.1f}{size:10.1f}"
+            f"{query_time:10.3f}{recall_at_k(found, expected):8.3f}"
+        )
+        del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+MMR retrieval latency: langchain's max_marginal_relevance_search_by_vector against the
+vectorized `mmr_search` of helper.py, for growing k.
+
+langchain reconstructs each of the fetch_k candidate vectors from the FAISS index one
+by one and looks their chunks up one by one; `mmr_search` slices them out of the
+vector matrix saved next to the index and reads the picked chunks in one query. The
+"same" column is the share of queries for which both return the same chunks, ties
+between equally similar chunks aside. No embedding call is timed.
+
+    python benchmarks/bench_mmr.py --chunks 20000 --queries 200
+"""
+import argparse
+import random
+import statistics
+import time
+
+from common import percentile, use_fake_backend
+
+VOCABULARY_SIZE = 5000
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return statistics.mean(durations) * 1000, percentile(durations, 0.5) * 1000, percentile(durations, 0.99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, nargs="+", default=[4, 8, 16, 32, 50])
+    args = parser.parse_args()
+
+    helper = use_fake_backend()
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(VOCABULARY_SIZE)]
+    chunks = [" ".join(rng.choices(words, k=40)) for _ in range(args.chunks)]
+    helper.update_vectorstore(chunks, mode="replace")
+    # A replaced index has a single segment
+    store, = helper.get_vector_stores()
+    embeddings = helper.get_embeddings()
+    query_vectors = [embeddings.embed_query(" ".join(rng.choices(words, k=6))) for _ in range(args.queries)]
+
+    print(f"{store.index.ntotal} chunks, {args.queries} queries\n")
+    print(f"{'k':>4}{'fetch_k':>9}{'langchain ms':>14}{'p99':>8}{'vectorized ms':>15}{'p99':>8}{'speedup':>9}{'same':>7}")
+    for k in args.k:
+        fetch_k = max(helper.RETRIEVAL_FETCH_K, 4 * k)
+        langchain_durations, vectorized_durations, same = [], [], 0
+        for query_vector in query_vectors:
+            start = time.perf_counter()
+            expected = store.max_marginal_relevance_search_by_vector(query_vector, k=k, fetch_k=fetch_k)
+            langchain_durations.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            documents = helper.mmr_search([store], query_vector, k=k, fetch_k=fetch_k)
+            vectorized_durations.append(time.perf_counter() - start)
+
+            same += [document.id for document in documents] == [document.id for document in expected]
+
+        langchain_mean, _, langchain_p99 = summarize(langchain_durations)
+        vectorized_mean, _, vectorized_p99 = summarize(vectorized_durations)
+        print(
+            f"{k:>4}{fetch_k:>9}{langchain_mean:>14.2f}{langchain_p99:>8.2f}"
+            f"{vectorized_mean:>15.2f}{vectorized_p99:>8.2f}{langchain_mean / vectorized_mean:>8.1f}x"
+            f"{same / len(query_vectors):>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
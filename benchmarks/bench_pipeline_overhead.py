@@ -0,0 +1,65 @@
+"""
+Per-request Python overhead of query(), with the prompt templates and chains rebuilt on
+every request as they used to be ("before") and taken from the pipeline registry ("after").
+
+The LLM and the embedder are local fakes with no latency, so the numbers only measure
+the work done by this code and LangChain around the model calls.
+
+    python benchmarks/bench_pipeline_overhead.py --requests 500
+"""
+import argparse
+import statistics
+import time
+
+from langchain.prompts import PromptTemplate
+
+from common import percentile, use_fake_backend
+
+
+def rebuild_templates(helper):
+    """Build the prompt templates of query() again, as each request used to."""
+    helper.answer_template = PromptTemplate(
+        template=helper.answer_prompt_template, input_variables=["question"],
+    )
+    helper.test_question_template = PromptTemplate(
+        template=helper.question_prompt_template, input_variables=["follow_up_context", "question", "answer"],
+    )
+    helper.bullet_template = PromptTemplate(
+        template=helper.bullet_point_prompt_template, input_variables=["follow_up_context", "question", "answer"],
+    )
+    helper.clear_pipelines()
+
+
+def run(helper, label, requests, model, rebuild):
+    durations = []
+    for i in range(requests):
+        start = time.perf_counter()
+        if rebuild:
+            rebuild_templates(helper)
+        helper.query(f"What does chapter {i} say about data pipelines?", model=model)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    print(
+        f"{label:<8} mean {statistics.mean(durations):7.3f} ms   "
+        f"p50 {percentile(durations, 0.5):7.3f} ms   "
+        f"p95 {percentile(durations, 0.95):7.3f} ms"
+    )
+    return statistics.mean(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    helper = use_fake_backend()
+    model = helper.llm
+    run(helper, "warmup", 20, model, rebuild=False)
+    before = run(helper, "before", args.requests, model, rebuild=True)
+    after = run(helper, "after", args.requests, model, rebuild=False)
+    print(f"overhead saved per request: {before - after:.3f} ms ({before / after:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
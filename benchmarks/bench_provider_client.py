@@ -0,0 +1,157 @@
+"""
+Provider calls saved by the client layer of provider_client.py, with the local fake
+models of fake_models.py standing in for the provider.
+
+- coalescing: --clients threads, then as many asyncio tasks, sending the same prompt at
+  once, with and without `ManagedChatModel`: LLM calls sent and wall time.
+- micro-batching: --clients threads each embedding one question, straight to the
+  embedding model and through `BatchingEmbeddings`, under a --rate requests/s limit:
+  provider calls sent and wall time.
+- retries: LLM calls failing with a rate limit error --failure-rate of the time,
+  with 0 and --retries retries: share of the calls that succeed and wall time.
+
+    python benchmarks/bench_provider_client.py --clients 64 --rate 20
+"""
+import argparse
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common  # noqa: F401, puts the backend on the path
+from fake_models import FakeChatModel, FakeEmbeddings
+from langchain_core.messages import HumanMessage
+from provider_client import BatchingEmbeddings, ManagedChatModel, ProviderGate
+
+
+class RateLimitError(Exception):
+    """Named like the error of the OpenAI SDK, so `is_retryable` retries it."""
+
+
+class CountingChatModel(FakeChatModel):
+    """Fake chat model counting its calls, failing `failure_rate` of them with a rate limit error."""
+
+    failure_rate: float = 0.0
+    calls: list = []
+
+    def _check(self):
+        self.calls.append(1)
+        if random.random() < self.failure_rate:
+            raise RateLimitError("429 Too Many Requests")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self._check()
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self._check()
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    """Fake embedding model counting its calls and holding at most `rate` calls per second."""
+
+    def __init__(self, rate, latency):
+        super().__init__(latency=latency)
+        self.calls = 0
+        self.gate = ProviderGate("bench", rate=rate, max_concurrency=1000)
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        self.gate.bucket.acquire()
+        with self._lock:
+            self.calls += 1
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def run_threads(clients, function):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(function, range(clients)))
+    return results, time.perf_counter() - start
+
+
+def coalescing(args):
+    print(f"coalescing: {args.clients} identical prompts at once, {args.llm_latency} s per LLM call")
+    print(f"{'client':>10}{'mode':>10}{'LLM calls':>11}{'seconds':>9}")
+    prompt = [HumanMessage(content="Question: How does Kafka store its offsets?")]
+    for managed in (False, True):
+        provider = CountingChatModel(latency=args.llm_latency, calls=[])
+        model = ManagedChatModel(model=provider, gate=ProviderGate("bench")) if managed else provider
+        mode = "managed" if managed else "direct"
+
+        _, seconds = run_threads(args.clients, lambda _: model.invoke(prompt))
+        print(f"{'threads':>10}{mode:>10}{len(provider.calls):>11}{seconds:>9.2f}")
+
+        provider.calls.clear()
+
+        async def run():
+            start = time.perf_counter()
+            await asyncio.gather(*(model.ainvoke(prompt) for _ in range(args.clients)))
+            return time.perf_counter() - start
+
+        seconds = asyncio.run(run())
+        print(f"{'asyncio':>10}{mode:>10}{len(provider.calls):>11}{seconds:>9.2f}")
+
+
+def micro_batching(args):
+    print(f"\nmicro-batching: {args.clients} questions at once, {args.rate} embedding calls/s allowed, "
+          f"{args.embedding_latency} s per call")
+    print(f"{'mode':>10}{'calls':>7}{'seconds':>9}")
+    for batching in (False, True):
+        provider = CountingEmbeddings(args.rate, args.embedding_latency)
+        if batching:
+            model = BatchingEmbeddings(provider, ProviderGate("bench", max_concurrency=8), window=args.window / 1000)
+        else:
+            model = provider
+        _, seconds = run_threads(args.clients, lambda i: model.embed_query(f"What is chapter {i} about?"))
+        print(f"{'batched' if batching else 'direct':>10}{provider.calls:>7}{seconds:>9.2f}")
+
+
+def retries(args):
+    print(f"\nretries: {args.clients} LLM calls, {args.failure_rate:.0%} of them failing with a rate limit error")
+    print(f"{'retries':>10}{'succeeded':>11}{'LLM calls':>11}{'seconds':>9}")
+    random.seed(0)
+    for max_retries in (0, args.retries):
+        provider = CountingChatModel(latency=args.llm_latency, failure_rate=args.failure_rate, calls=[])
+        gate = ProviderGate("bench", max_retries=max_retries, backoff_base=args.backoff_base)
+        model = ManagedChatModel(model=provider, gate=gate)
+
+        def call(i):
+            try:
+                # Different prompts, nothing is coalesced
+                model.invoke([HumanMessage(content=f"Question: What is chapter {i} about?")])
+                return True
+            except RateLimitError:
+                return False
+
+        results, seconds = run_threads(args.clients, call)
+        print(f"{max_retries:>10}{sum(results) / len(results):>11.0%}{len(provider.calls):>11}{seconds:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per call of the fake LLM")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds per call of the fake embedder")
+    parser.add_argument("--rate", type=float, default=20, help="Embedding calls per second the provider allows")
+    parser.add_argument("--window", type=float, default=5, help="Micro-batching window, in ms")
+    parser.add_argument("--failure-rate", type=float, default=0.3)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff-base", type=float, default=0.05)
+    args = parser.parse_args()
+
+    # One warning per retry otherwise
+    logging.getLogger("provider_client").setLevel(logging.ERROR)
+    coalescing(args)
+    micro_batching(args)
+    retries(args)
+
+
+if __name__ == "__main__":
+    main()
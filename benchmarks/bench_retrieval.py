@@ -0,0 +1,74 @@
+"""
+Retrieval latency and hit rate of each retrieval mode (vector, hybrid, lexical, auto).
+
+The chunks of a PDF (the data engineering cookbook by default) are indexed with the fake
+embedder, which waits --embedding-latency seconds per call like a remote model would.
+Each question is made of a few words of one chunk, and counts as a hit when that chunk
+is among the 4 retrieved. Only retrieval is timed, no LLM is called.
+
+    python benchmarks/bench_retrieval.py --questions 200 --embedding-latency 0.05
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+from common import percentile, use_fake_backend
+
+DEFAULT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "doc", "Data_engineering_cookbook.pdf")
+
+
+def make_questions(chunks, count, seed):
+    from retrieval import query_terms
+
+    rng = random.Random(seed)
+    questions = []
+    while len(questions) < count:
+        chunk = rng.choice(chunks)
+        terms = query_terms(chunk)
+        if len(terms) >= 4:
+            start = rng.randrange(len(terms) - 3)
+            questions.append((f"What about {' '.join(terms[start:start + 4])}?", chunk))
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=DEFAULT_PDF)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    helper = use_fake_backend()
+    from fake_models import FakeEmbeddings
+    from pdf_extract import iter_pdf_pages
+
+    chunks = [chunk for _, _, text in iter_pdf_pages([args.pdf]) for chunk in helper.get_text_chunks(text)]
+    helper.update_vectorstore(chunks, mode="replace")
+    helper.embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    shards = helper.get_shards()
+    pipeline = helper.get_pipeline(shards)
+    questions = make_questions(chunks, args.questions, seed=0)
+
+    print(f"{len(chunks)} chunks, {len(questions)} questions, embedding latency {args.embedding_latency * 1000:.0f} ms\n")
+    print(f"{'mode':<9}{'mean ms':>9}{'p50 ms':>9}{'p99 ms':>9}{'hit@4':>8}{'lexical':>9}")
+    for mode in ("vector", "hybrid", "lexical", "auto"):
+        durations, hits, lexical = [], 0, 0
+        for question, chunk in questions:
+            start = time.perf_counter()
+            inputs = helper.prepare_retrieval(question, pipeline.stores, mode, {})
+            documents = pipeline.retrieve(inputs)
+            durations.append((time.perf_counter() - start) * 1000)
+            hits += any(document.page_content == chunk for document in documents)
+            lexical += inputs["retrieval_mode"] == "lexical"
+
+        durations.sort()
+        print(
+            f"{mode:<9}{statistics.mean(durations):9.2f}{percentile(durations, 0.5):9.2f}"
+            f"{percentile(durations, 0.99):9.2f}{hits / len(questions):8.2f}{lexical / len(questions):9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Startup cost of the backend with a large index: time to import helper.py, to open the
+vector store, to answer the first search, and the resident memory of the process.
+
+The same synthetic chunks are saved twice, in the pickled FAISS.save_local format the
+backend used to load at import ("pickle") and in the memory-mapped index + SQLite chunk
+format it opens now ("mmap"). Each measurement runs in a fresh process that only loads
+the index and searches it. Linux only, memory is read from /proc.
+
+    python benchmarks/bench_startup.py --chunks 200000 --dim 384
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from common import BACKEND_DIR
+
+# Peak RSS is read from VmHWM, which starts afresh with the process image: ru_maxrss
+# carries over exec() and would report the peak of the process that built the indexes
+MEASURE = """
+import json, sys, time
+sys.path.insert(0, {backend_dir!r})
+start = time.perf_counter()
+import helper
+from fake_models import FakeEmbeddings
+imported = time.perf_counter()
+helper.embeddings = FakeEmbeddings(size={dim})
+if {legacy!r}:
+    from langchain_community.vectorstores import FAISS
+    store = FAISS.load_local({path!r}, helper.embeddings, allow_dangerous_deserialization=True)
+else:
+    store = helper.load_vectorstore({path!r})
+loaded = time.perf_counter()
+store.max_marginal_relevance_search_by_vector([0.1] * {dim}, k=4)
+searched = time.perf_counter()
+with open("/proc/self/status") as f:
+    status = dict(line.split(":", 1) for line in f)
+print(json.dumps({{
+    "import_s": imported - start,
+    "load_s": loaded - imported,
+    "first_search_ms": (searched - loaded) * 1000,
+    "max_rss_mb": int(status["VmHWM"].split()[0]) / 1024,
+}}))
+"""
+
+
+def build_indexes(work_dir, chunks, dim):
+    os.environ["FAISS_PATH"] = os.path.join(work_dir, "unused")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(work_dir, "embedding_cache.db")
+    import helper
+    from fake_models import FakeEmbeddings
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    import faiss
+
+    helper.embeddings = FakeEmbeddings(size=dim)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((chunks, dim), dtype=np.float32)
+    texts = [f"Chunk {i} of the synthetic corpus. " * 25 for i in range(chunks)]
+    ids = [str(i) for i in range(chunks)]
+    metadatas = [{"source": "synthetic.pdf", "page": i // 4} for i in range(chunks)]
+
+    legacy_path = os.path.join(work_dir, "pickle")
+    legacy = FAISS(helper.embeddings, faiss.IndexFlatL2(dim), InMemoryDocstore(), {})
+    legacy.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+    legacy.save_local(legacy_path)
+
+    mmap_path = os.path.join(work_dir, "mmap")
+    os.makedirs(mmap_path)
+    store = helper.build_vectorstore(texts, vectors, mmap_path, ids=ids, metadatas=metadatas)
+    helper.save_segment(store, mmap_path)
+    return legacy_path, mmap_path
+
+
+def measure(path, dim, legacy):
+    code = MEASURE.format(backend_dir=BACKEND_DIR, dim=dim, path=path, legacy=legacy)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=384)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    legacy_path, mmap_path = build_indexes(work_dir, args.chunks, args.dim)
+
+    print(f"{args.chunks} chunks of {args.dim} dimensions\n")
+    print(f"{'format':<8}{'import s':>10}{'load s':>10}{'1st search ms':>15}{'max RSS MB':>12}")
+    for label, path, legacy in [("pickle", legacy_path, True), ("mmap", mmap_path, False)]:
+        result = measure(path, args.dim, legacy)
+        print(
+            f"{label:<8}{result['import_s']:10.2f}{result['load_s']:10.2f}"
+            f"{result['first_search_ms']:15.1f}{result['max_rss_mb']:12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
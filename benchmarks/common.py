@@ -0,0 +1,71 @@
+"""Shared setup of the benchmarks: run the backend in-process with local fake models."""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "backend"))
+sys.path.insert(0, BACKEND_DIR)
+
+CORPUS = [
+    f"Chapter {i} explains how data pipelines move records between systems, "
+    f"covering {topic}, batching and failure handling."
+    for i, topic in enumerate(["Kafka", "Spark", "Airflow", "HDFS", "Cassandra", "MongoDB", "Flink", "Redshift"] * 25)
+]
+
+
+def use_work_dir():
+    """
+    Point the backend configuration at a throwaway folder. Must run before helper.py is imported.
+
+    Returns:
+        str: The folder.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["FAISS_PATH"] = os.path.join(work_dir, "vector")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(work_dir, "embedding_cache.db")
+    os.environ["DB_NAME"] = os.path.join(work_dir, "bench.db")
+    os.environ["UPLOAD_DIR"] = work_dir
+    # Every question must go through the chains, not the semantic cache
+    os.environ["SEMANTIC_CACHE_THRESHOLD"] = "2.0"
+    return work_dir
+
+
+def use_fake_provider(llm_latency=0.0, embedding_latency=0.0):
+    """
+    Configure the backend like a deployment with LLM_PROVIDER=fake: the models of
+    fake_models.py, behind the embedding cache, without API keys. Must run before
+    helper.py is imported.
+
+    Returns:
+        str: The throwaway folder of the indexes and databases.
+    """
+    os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(llm_latency)
+    os.environ["FAKE_EMBEDDING_LATENCY"] = str(embedding_latency)
+    return use_work_dir()
+
+
+def use_fake_backend(llm_latency=0.0, embedding_latency=0.0):
+    """
+    Point the backend configuration at a throwaway folder, import helper.py and replace
+    its models with the fakes of fake_models.py. Must run before `app` is imported.
+
+    Returns:
+        module: The imported helper module, with a small index already built.
+    """
+    use_work_dir()
+
+    import helper
+    from fake_models import FakeChatModel, FakeEmbeddings
+
+    helper.llm = FakeChatModel(latency=llm_latency)
+    helper.embeddings = FakeEmbeddings(latency=embedding_latency)
+    helper.update_vectorstore(CORPUS)
+    return helper
+
+
+def percentile(sorted_values, fraction):
+    """Value at `fraction` (0-1) of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
@@ -0,0 +1,191 @@
+"""
+Throughput of /query/ and /evaluate/ at increasing numbers of concurrent clients.
+
+By default the Flask app runs in-process with the fake models of fake_models.py, so the
+numbers reflect the request handling and the SQLite layer under contention. With --url
+the same load is sent over HTTP to a running backend instead.
+
+With --asgi the clients are asyncio tasks sending the requests with httpx, to the ASGI
+app of asgi.py in-process, or to --url (e.g. uvicorn). With an LLM latency of a few
+seconds, the Flask app is capped by its threads while the ASGI one keeps every client
+in flight:
+
+    python benchmarks/load_test.py --clients 8 16 32 64 --requests 20 --llm-latency 0.05
+    python benchmarks/load_test.py --url http://127.0.0.1:5000
+    python benchmarks/load_test.py --asgi --clients 64 256 512 --requests 4 --llm-latency 2
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import percentile, use_fake_backend
+
+
+class HttpClient:
+    """Sends the requests to a running backend."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def post(self, path, payload):
+        response = self.session.post(f"{self.url}{path}", json=payload, timeout=300)
+        return response.status_code, response.json()
+
+
+class InProcessClient:
+    """Sends the requests to the Flask app through its test client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def post(self, path, payload):
+        response = self.app.test_client().post(path, json=payload)
+        return response.status_code, response.get_json()
+
+    def get(self, path):
+        response = self.app.test_client().get(path)
+        return response.status_code, response.get_json()
+
+
+class AsyncClient:
+    """Sends the requests from asyncio tasks, to the in-process ASGI app or a running backend."""
+
+    def __init__(self, app=None, url=None):
+        import httpx
+        transport = httpx.ASGITransport(app=app) if app is not None else None
+        self.client = httpx.AsyncClient(
+            transport=transport, base_url=url or "http://asgi", timeout=300,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+        )
+
+    async def post(self, path, payload):
+        response = await self.client.post(path, json=payload)
+        return response.status_code, response.json()
+
+    async def get(self, path):
+        response = await self.client.get(path)
+        return response.status_code, response.json()
+
+
+def make_payload(endpoint, request_no, test_question_id, questions=None):
+    if endpoint == "/query/":
+        if questions:
+            return {"question": questions[request_no % len(questions)]}
+        return {"question": f"What does chapter {request_no} say about batching?"}
+    return {"answer": "Records are batched before being written", "test_question_id": test_question_id}
+
+
+def report(endpoint, clients, results, elapsed):
+    """
+    Print the throughput and latency of a level from the (durations, errors) of each
+    client, and return them as a dict.
+    """
+    durations = sorted(duration for client_durations, _ in results for duration in client_durations)
+    stats = {
+        "endpoint": endpoint,
+        "clients": clients,
+        "requests": len(durations),
+        "errors": sum(client_errors for _, client_errors in results),
+        "qps": round(len(durations) / elapsed, 2),
+        "p50_ms": round(percentile(durations, 0.5), 1),
+        "p99_ms": round(percentile(durations, 0.99), 1),
+    }
+    print(
+        f"{endpoint:<11} clients {clients:>3}   requests {stats['requests']:>5}   errors {stats['errors']:>4}   "
+        f"{stats['qps']:8.1f} req/s   p50 {stats['p50_ms']:8.1f} ms   p99 {stats['p99_ms']:8.1f} ms"
+    )
+    return stats
+
+
+def run_level(client, endpoint, clients, requests_per_client, test_question_id, questions=None):
+    """Run `clients` concurrent loops of `requests_per_client` requests against one endpoint."""
+
+    def client_loop(client_no):
+        durations, errors = [], 0
+        for i in range(requests_per_client):
+            payload = make_payload(endpoint, client_no * requests_per_client + i, test_question_id, questions)
+            start = time.perf_counter()
+            status, _ = client.post(endpoint, payload)
+            durations.append((time.perf_counter() - start) * 1000)
+            errors += status >= 400
+        return durations, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(client_loop, range(clients)))
+    return report(endpoint, clients, results, time.perf_counter() - start)
+
+
+async def run_level_async(client, endpoint, clients, requests_per_client, test_question_id, questions=None):
+    """`run_level` with the clients as asyncio tasks, for `AsyncClient`."""
+
+    async def client_loop(client_no):
+        durations, errors = [], 0
+        for i in range(requests_per_client):
+            payload = make_payload(endpoint, client_no * requests_per_client + i, test_question_id, questions)
+            start = time.perf_counter()
+            status, _ = await client.post(endpoint, payload)
+            durations.append((time.perf_counter() - start) * 1000)
+            errors += status >= 400
+        return durations, errors
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client_loop(client_no) for client_no in range(clients)))
+    return report(endpoint, clients, results, time.perf_counter() - start)
+
+
+async def run_async(client, args):
+    # /evaluate/ needs a saved test question
+    _, response = await client.post("/query/", {"question": "How are records batched?"})
+    test_question_id = response["test_question_id"]
+
+    for endpoint in ("/query/", "/evaluate/"):
+        for clients in args.clients:
+            await run_level_async(client, endpoint, clients, args.requests, test_question_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Backend to load, instead of the in-process app with fake models")
+    parser.add_argument("--clients", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--requests", type=int, default=20, help="Requests sent by each client")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per call of the fake LLM")
+    parser.add_argument("--asgi", action="store_true", help="Load the ASGI app (asgi.py) with asyncio clients")
+    args = parser.parse_args()
+
+    if args.asgi:
+        if args.url:
+            asyncio.run(run_async(AsyncClient(url=args.url), args))
+            return
+        use_fake_backend(llm_latency=args.llm_latency)
+        import asgi
+
+        async def run_in_process():
+            await run_async(AsyncClient(app=asgi.app), args)
+            # No lifespan without a server: close the aiosqlite connections, their threads keep the process alive
+            await asgi.db.close()
+
+        asyncio.run(run_in_process())
+        return
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        use_fake_backend(llm_latency=args.llm_latency)
+        import app
+        client = InProcessClient(app.app)
+
+    # /evaluate/ needs a saved test question
+    _, response = client.post("/query/", {"question": "How are records batched?"})
+    test_question_id = response["test_question_id"]
+
+    for endpoint in ("/query/", "/evaluate/"):
+        for clients in args.clients:
+            run_level(client, endpoint, clients, args.requests, test_question_id)
+
+
+if __name__ == "__main__":
+    main()
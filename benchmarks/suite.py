@@ -0,0 +1,192 @@
+"""
+Benchmark suite of the ingestion and query hot paths, with the results written as JSON
+so they can be compared commit to commit.
+
+The backend runs in-process as it would be deployed with LLM_PROVIDER=fake: the models
+of fake_models.py, with --llm-latency and --embedding-latency seconds per call, so no
+API key is needed. The documents are synthetic PDFs of synthetic.py.
+
+- upload: a --pages PDF through /upload/ until its job completes: pages/s, chunks/s
+  and the peak RSS of the backend and of the PDF parsing workers, then the time its
+  question bank takes to generate.
+- query: /query/ at each --clients level, with questions about the uploaded pages:
+  QPS, p50 and p99 latency.
+- evaluate: /evaluate/ at each --clients level.
+
+    python benchmarks/suite.py --pages 200 --clients 8 32 --output results.json
+    python benchmarks/suite.py --server asgi --clients 64 256 --llm-latency 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from common import use_fake_provider
+from load_test import AsyncClient, InProcessClient, run_level_async
+from synthetic import make_pages, make_questions, write_pdf
+
+SCENARIOS = ("upload", "query", "evaluate")
+
+# How often the upload scenario polls its job
+POLL_INTERVAL = 0.05
+
+
+class FlaskClient:
+    """The Flask test client awaited from asyncio, in one thread per concurrent client."""
+
+    def __init__(self, app, max_clients):
+        self.client = InProcessClient(app)
+        self.executor = ThreadPoolExecutor(max_workers=max_clients)
+
+    async def post(self, path, payload):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.client.post, path, payload)
+
+    async def get(self, path):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.client.get, path)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of the live PDF parsing workers, in MB."""
+    from pdf_extract import _executor
+
+    workers = 0
+    for pid in (_executor._processes if _executor else {}):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                workers += next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+        except (OSError, StopIteration):
+            pass
+    # ru_maxrss is in KB on Linux
+    return {
+        "backend": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "pdf_workers": round(workers / 1024, 1),
+    }
+
+
+async def upload_scenario(client, pdf_path):
+    start = time.perf_counter()
+    _, response = await client.post("/upload/", {"file_paths": [pdf_path], "mode": "replace"})
+    elapsed = None
+    while True:
+        _, job = await client.get(response["status_url"])
+        if job["status"] in ("completed", "failed") and elapsed is None:
+            elapsed = time.perf_counter() - start
+        # Queries should find the question bank complete
+        if job["status"] == "failed" or elapsed is not None and job["question_bank"] not in ("queued", "running"):
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    question_bank_elapsed = time.perf_counter() - start - elapsed if elapsed is not None else None
+    if job["status"] == "failed" or job["question_bank"] == "failed":
+        raise RuntimeError(f"Upload failed: {job['error']}")
+
+    stats = {
+        "pages": job["pages_parsed"],
+        "chunks": job["chunks_total"],
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(job["pages_parsed"] / elapsed, 1),
+        "chunks_per_s": round(job["chunks_total"] / elapsed, 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "bank_questions": job["questions_generated"],
+        "question_bank_seconds": round(question_bank_elapsed, 3),
+    }
+    print(
+        f"/upload/    pages {stats['pages']:>5}   chunks {stats['chunks']:>5}   {stats['seconds']:8.2f} s   "
+        f"{stats['pages_per_s']:8.1f} pages/s   {stats['chunks_per_s']:8.1f} chunks/s   "
+        f"peak RSS {stats['peak_rss_mb']['backend']} MB (+{stats['peak_rss_mb']['pdf_workers']} MB workers)   "
+        f"{stats['bank_questions']} bank questions in {stats['question_bank_seconds']:.2f} s more"
+    )
+    return stats
+
+
+async def run_suite(client, args, pdf_path, questions):
+    results = {}
+    if "upload" in args.scenarios:
+        results["upload"] = await upload_scenario(client, pdf_path)
+    else:
+        # The other scenarios need the document indexed, its upload isn't reported
+        await upload_scenario(client, pdf_path)
+
+    # /evaluate/ needs a saved test question
+    _, response = await client.post("/query/", {"question": questions[0]})
+    test_question_id = response["test_question_id"]
+
+    for endpoint, scenario in (("/query/", "query"), ("/evaluate/", "evaluate")):
+        if scenario in args.scenarios:
+            results[scenario] = [
+                await run_level_async(client, endpoint, clients, args.requests, test_question_id, questions)
+                for clients in args.clients
+            ]
+    return results
+
+
+def git_commit():
+    """Commit of the working tree, None outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--pages", type=int, default=100, help="Pages of the synthetic PDF")
+    parser.add_argument("--clients", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--requests", type=int, default=10, help="Requests sent by each client")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds per call of the fake LLM")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds per call of the fake embedder")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to, printed otherwise")
+    args = parser.parse_args()
+
+    work_dir = use_fake_provider(llm_latency=args.llm_latency, embedding_latency=args.embedding_latency)
+    pages = make_pages(args.pages, seed=args.seed)
+    pdf_path = os.path.join(work_dir, "synthetic.pdf")
+    write_pdf(pdf_path, pages)
+    questions = make_questions(pages, 1000, seed=args.seed)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    if args.server == "asgi":
+        import asgi
+
+        async def run():
+            try:
+                return await run_suite(AsyncClient(app=asgi.app), args, pdf_path, questions)
+            finally:
+                # No lifespan without a server: close the aiosqlite connections, their threads keep the process alive
+                await asgi.db.close()
+    else:
+        import app
+
+        async def run():
+            return await run_suite(FlaskClient(app.app, max(args.clients)), args, pdf_path, questions)
+
+    report = {
+        "commit": git_commit(),
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        **asyncio.run(run()),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
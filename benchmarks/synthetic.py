@@ -0,0 +1,147 @@
+"""
+Synthetic documents for the benchmarks: deterministic pages of text with numbered
+section headings, written as PDFs the backend parses like real uploads.
+
+The text mixes data engineering terms with generated words, so chunks differ from each
+other and retrieval has something to discriminate. Each page ends with a footer line.
+
+    python benchmarks/synthetic.py /tmp/synthetic.pdf --pages 200
+"""
+import argparse
+import random
+
+TOPICS = [
+    "Kafka", "Spark", "Airflow", "HDFS", "Cassandra", "MongoDB", "Flink", "Redshift", "Parquet", "Avro",
+    "Hive", "Presto", "Kubernetes", "Docker", "Snowflake", "BigQuery", "Druid", "Elasticsearch", "Redis", "Postgres",
+]
+TERMS = [
+    "pipeline", "batch", "stream", "partition", "replica", "schema", "offset", "shuffle", "join", "window",
+    "watermark", "checkpoint", "compaction", "index", "query", "cluster", "broker", "consumer", "producer",
+    "latency", "throughput", "storage", "warehouse", "lake", "ingestion", "transformation", "orchestration",
+    "retention", "serialization", "deduplication", "backfill", "lineage", "governance", "monitoring",
+]
+FILLER = ["the", "a", "of", "to", "and", "in", "is", "with", "for", "each", "when", "by", "on", "every"]
+
+# Generated words, so that the vocabulary is closer to the size of a real document's
+VOCABULARY_SIZE = 3000
+
+# Lines of a page and characters of a line of the generated PDFs
+LINES_PER_PAGE = 56
+LINE_LENGTH = 90
+
+
+def make_sentence(rng, topic, vocabulary):
+    words = [rng.choice(FILLER if i % 3 == 0 else TERMS if i % 3 == 1 else vocabulary)
+             for i in range(rng.randint(8, 18))]
+    words.insert(rng.randrange(len(words)), topic)
+    sentence = " ".join(words)
+    return sentence[0].upper() + sentence[1:] + "."
+
+
+def make_pages(page_count, seed=0, sentences_per_page=24):
+    """
+    Text of `page_count` pages. A new numbered section starts every few pages, about one
+    of the TOPICS, and its sentences keep mentioning it.
+    """
+    rng = random.Random(seed)
+    vocabulary = [f"{rng.choice(TERMS)[:4]}{i}" for i in range(VOCABULARY_SIZE)]
+    pages = []
+    section = 0
+    topic = TOPICS[0]
+    for page_no in range(page_count):
+        lines = []
+        if page_no % 3 == 0:
+            section += 1
+            topic = rng.choice(TOPICS)
+            lines.append(f"{section}. {topic} {rng.choice(TERMS)} and {rng.choice(TERMS)}")
+        paragraph = []
+        for i in range(sentences_per_page):
+            paragraph.append(make_sentence(rng, topic, vocabulary))
+            if i % 6 == 5:
+                lines.append(" ".join(paragraph))
+                paragraph = []
+        if paragraph:
+            lines.append(" ".join(paragraph))
+        lines.append(f"Synthetic handbook, page {page_no + 1}")
+        pages.append("\n".join(lines))
+    return pages
+
+
+def wrap(text, width=LINE_LENGTH):
+    """Lines of at most `width` characters, breaking between words."""
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split():
+            if line and len(line) + 1 + len(word) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+    return lines
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """
+    Write pages of text to a PDF, with a standard Type 1 font so no font is embedded.
+    Lines past LINES_PER_PAGE are cut.
+    """
+    # Objects 1 and 2 are the catalog and the page tree, 3 the font, then a page and its content per page
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for text in pages:
+        lines = wrap(text)[:LINES_PER_PAGE]
+        stream = "BT /F1 10 Tf 13 TL 50 760 Td " + " ".join(f"({escape(line)}) Tj T*" for line in lines) + " ET"
+        stream = stream.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        " ".join(f"{page_id} 0 R" for page_id in page_ids).encode(), len(page_ids)
+    )
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        f.writelines(b"%010d 00000 n \n" % offset for offset in offsets)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+def make_questions(pages, count, seed=0):
+    """Questions made of a few words of a sentence of the pages, like a student asking about it."""
+    rng = random.Random(seed)
+    sentences = [sentence for page in pages for sentence in page.replace("\n", " ").split(". ") if len(sentence.split()) >= 8]
+    questions = []
+    for sentence in rng.sample(sentences, min(count, len(sentences))):
+        words = sentence.split()
+        start = rng.randrange(len(words) - 4)
+        questions.append(f"What does the handbook say about {' '.join(words[start:start + 5]).lower()}?")
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_pdf(args.path, make_pages(args.pages, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
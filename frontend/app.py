@@ -3,7 +3,7 @@ import os
 import streamlit as st
 from htmlTemplates import css
 from streamlit_chat import message
-from helper import handle_userinput, get_uploaded_document, handle_useranswer
+from helper import handle_userinput, get_uploaded_document, handle_useranswer, init_session_state, wait_for_upload
 
 
 def main():
@@ -11,9 +11,8 @@ def main():
                        page_icon=":books:")
     st.write(css, unsafe_allow_html=True)
     
-    # Store test_question_id
-    if "test_question_id" not in st.session_state:
-        st.session_state.test_question_id = None
+    # Store test_question_id, the cached answers and the uploaded files across reruns
+    init_session_state()
 
     st.header("Q-A-T Chatbot :books:")
     message("Hello, what would you like to learn today?", is_user=False)
@@ -24,23 +23,30 @@ def main():
             "Upload your PDFs here and click on 'Process'", accept_multiple_files=True)
 
         if st.button("Process"):
-            with st.spinner("Processing documents..."):
-                # upload document
-                if pdf_docs:
-                    _ = get_uploaded_document(pdf_docs)
-                else:
-                    st.error("Upload PDF first!!!")
+            # upload the new documents, then follow the ingestion job the backend started
+            if pdf_docs:
+                upload, skipped = get_uploaded_document(pdf_docs)
+                if skipped:
+                    st.info(f"{skipped} document(s) already processed, not uploaded again")
+                if upload is not None:
+                    job = wait_for_upload(upload["job_id"])
+                    if job.get("status") == "completed":
+                        st.session_state.ingested_hashes.update(upload["content_hashes"])
+                        st.success("Documents processed")
+                    else:
+                        st.error(f"Processing failed: {job.get('error')}")
+            else:
+                st.error("Upload PDF first!!!")
 
         user_question = st.text_input("Ask a question about your research documents:")
         user_answer = st.text_input("Answer the test question:")
 
 
+    # Both are shown on every rerun, the backend is only called for new ones
     if user_question:
-        with st.spinner("Loading..."):
-            handle_userinput(user_question, key="user_input")
-    elif user_answer:
-        with st.spinner("Loading..."):
-            handle_useranswer(user_answer, key="user_answer")
+        handle_userinput(user_question, key="user_input")
+    if user_answer and st.session_state.test_question_id:
+        handle_useranswer(user_answer, key="user_answer")
 
 
 if __name__ == '__main__':
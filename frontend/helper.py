@@ -1,7 +1,12 @@
 import os
+import json
+import time
+import uuid
+import hashlib
 import requests
 import faiss 
 import streamlit as st
+from requests.adapters import HTTPAdapter
 from env_var import EnvVariable
 from streamlit_chat import message
 from htmlTemplates import bot_template, user_template
@@ -9,6 +14,49 @@ from htmlTemplates import bot_template, user_template
 
 backend_url = os.getenv("BACKEND_URL")
 
+# Responses kept per browser session, the oldest are dropped first
+MAX_CACHED_RESPONSES = 64
+
+# Block size of the streamed uploads
+UPLOAD_BLOCK_SIZE = 1 << 20
+
+@st.cache_resource
+def get_session():
+    """
+    HTTP session shared by every rerun and user of this Streamlit server, so calls to the
+    backend reuse its keep-alive connections instead of opening one each.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def init_session_state():
+    """Defaults of the values the app keeps across reruns."""
+    defaults = {
+        # Test question being answered
+        "test_question_id": None,
+        # Versions of the indexes searched, from the last answer or upload
+        "index_version": None,
+        # (question, index version) -> answer, bullet points and test question
+        "responses": {},
+        # (test question id, answer) -> evaluation
+        "evaluations": {},
+        # file id -> SHA-256 of the uploaded files, and the hashes known to be ingested
+        "file_hashes": {},
+        "ingested_hashes": set(),
+    }
+    for key, value in defaults.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
+def remember(cache, key, value):
+    """Add a response to a session cache, dropping the oldest beyond MAX_CACHED_RESPONSES."""
+    cache[key] = value
+    while len(cache) > MAX_CACHED_RESPONSES:
+        cache.pop(next(iter(cache)))
+
 def generate_answer_and_test_question(user_question, session_state):
     """
         Main function that returns answer to the user question
@@ -16,55 +64,199 @@ def generate_answer_and_test_question(user_question, session_state):
     payload = {"user_message": user_question, "session_state": session_state}
 
     # Make POST request to FastAPI backend
-    response, status_code = requests.post(f"{backend_url}/chat/", json=payload, timeout=20)
+    response = get_session().post(f"{backend_url}/chat/", json=payload, timeout=20)
     return response.json()
 
+def file_hash(pdf):
+    """SHA-256 of an uploaded file, the content hash the backend keys its document manifest by."""
+    content_hash = st.session_state.file_hashes.get(pdf.file_id)
+    if content_hash is None:
+        content_hash = st.session_state.file_hashes[pdf.file_id] = hashlib.sha256(pdf.getbuffer()).hexdigest()
+    return content_hash
+
+def iter_multipart(files, boundary, block_size=UPLOAD_BLOCK_SIZE):
+    """
+    Body of a multipart/form-data upload, yielded block by block so requests sends it
+    chunked instead of building it in memory.
+
+    Args:
+        files (dict): Field name -> (file name, file object, content type).
+    """
+    for name, (filename, fileobj, content_type) in files.items():
+        filename = filename.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode()
+        fileobj.seek(0)
+        for block in iter(lambda: fileobj.read(block_size), b""):
+            yield block
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
 
 def get_uploaded_document(pdf_docs):
-    files = {}
-    if pdf_docs:
-        for i, pdf in enumerate(pdf_docs):
-            # Add each PDF file to the files dictionary
-            files[f'pdf_doc_{i}'] = (pdf.name, pdf.getvalue(), 'application/pdf')
-        # Send the POST request with files
-        response = requests.post(f"{backend_url}/upload/", files=files, timeout=60)
-
-        # Get the response in JSON format
+    """
+    Upload the PDFs the backend hasn't ingested yet, streamed.
+
+    Files already ingested, in this session or before according to the backend's document
+    manifest, aren't sent again.
+
+    Returns:
+        tuple[dict | None, int]: The backend response with the ingestion job id, None if
+            there was nothing to upload, and the number of files skipped.
+    """
+    hashes = {file_hash(pdf): pdf for pdf in pdf_docs}
+    unknown = [content_hash for content_hash in hashes if content_hash not in st.session_state.ingested_hashes]
+    if unknown:
+        response = get_session().post(
+            f"{backend_url}/documents/lookup", json={"content_hashes": unknown}, timeout=10
+        )
+        st.session_state.ingested_hashes.update(response.json().get("known", []))
+    new_pdfs = [pdf for content_hash, pdf in hashes.items() if content_hash not in st.session_state.ingested_hashes]
+    skipped = len(pdf_docs) - len(new_pdfs)
+    if not new_pdfs:
+        return None, skipped
+
+    files = {f'pdf_doc_{i}': (pdf.name, pdf, 'application/pdf') for i, pdf in enumerate(new_pdfs)}
+    boundary = uuid.uuid4().hex
+    # Send the files, the backend answers with an ingestion job id
+    response = get_session().post(
+        f"{backend_url}/upload/",
+        data=iter_multipart(files, boundary),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        timeout=60,
+    )
+    upload = response.json()
+    upload["content_hashes"] = [file_hash(pdf) for pdf in new_pdfs]
+    return upload, skipped
+
+def get_upload_status(job_id):
+    """Fetch the progress of an ingestion job started by get_uploaded_document."""
+    response = get_session().get(f"{backend_url}/upload/{job_id}", timeout=10)
     return response.json()
 
-def handle_userinput(user_question, key="user_input"):
+def wait_for_upload(job_id, poll_interval=1.0):
+    """
+    Poll an ingestion job and show its progress in the sidebar until it finishes, then
+    move the session to the index version the job published.
+    """
+    status_text = st.empty()
+    progress_bar = st.progress(0)
+
+    while True:
+        job = get_upload_status(job_id)
+        # Unknown jobs come back as {"error": ...} without a status
+        if job.get("status", "failed") in ("completed", "failed"):
+            break
+
+        chunks_total = job.get("chunks_total") or 0
+        if job.get("stage") == "parsing":
+            status_text.text(f"Parsing documents... {job.get('pages_parsed', 0)} pages")
+        elif job.get("stage") == "embedding":
+            status_text.text(f"Embedding chunks... {job.get('chunks_embedded', 0)}/{chunks_total}")
+            if chunks_total:
+                progress_bar.progress(min(job.get("chunks_embedded", 0) / chunks_total, 1.0))
+        elif job.get("stage") == "merging":
+            status_text.text("Updating the index...")
+        else:
+            status_text.text("Waiting for a worker...")
+        time.sleep(poll_interval)
 
+    progress_bar.empty()
+    status_text.empty()
+
+    # Answers cached for the previous index are asked again
+    if job.get("status") == "completed" and job.get("index_version") is not None:
+        st.session_state.index_version = (job["index_version"],)
+    return job
+
+def iter_sse_events(response):
+    """Parse a Server-Sent Events response into (event, data) pairs."""
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
+        elif not line and data_lines:
+            yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+
+def fetch_answer(user_question, answer_placeholder):
+    """
+    Stream the answer to a question from the backend, rendering its tokens as they arrive.
+
+    Returns:
+        dict: The answer, bullet points, test question and its id, and the index versions.
+    """
     payload = {"question": user_question}
-    response = requests.post(f"{backend_url}/query/", json=payload)
-    answer = response.json().get("answer")
+    response = {"answer": "", "bullet_points": [], "test_question": None, "test_question_id": None}
+
+    # Render the answer as its tokens arrive, the rest comes once it is complete
+    with get_session().post(f"{backend_url}/query/stream", json=payload, stream=True, timeout=(5, 120)) as stream:
+        for event, data in iter_sse_events(stream):
+            if event == "token":
+                response["answer"] += data["token"]
+                answer_placeholder.markdown(response["answer"] + "▌")
+            elif event == "bullet_points":
+                response["bullet_points"] = data["bullet_points"]
+            elif event == "test_question":
+                response["test_question"] = data["test_question"]
+                response["test_question_id"] = data["test_question_id"]
+            elif event == "done":
+                response["index_version"] = tuple(data.get("index_version") or ())
+
+    answer_placeholder.empty()
+    return response
 
+def handle_userinput(user_question, key="user_input"):
+    """
+    Show the answer to a question. Streamlit reruns the script on every widget change, so
+    answers are kept per (question, index version) and the backend is only asked once.
+    """
     message(user_question, is_user=True, key=f"{key}_user_message")
 
     st.markdown("Answer: ")
-    message(answer, is_user=False, key=f"{key}_response_message")
+    cache_key = (user_question, st.session_state.index_version)
+    response = st.session_state.responses.get(cache_key)
+    if response is None:
+        with st.spinner("Loading..."):
+            response = fetch_answer(user_question, st.empty())
+        # The first answer tells which index versions it was read from
+        st.session_state.index_version = response.get("index_version") or st.session_state.index_version
+        # Incomplete answers, e.g. the backend failed, are asked again on the next rerun
+        if response["test_question_id"]:
+            remember(st.session_state.responses, (user_question, st.session_state.index_version), response)
+    # The answer shown is the one whose test question gets evaluated, cached or not
+    st.session_state.test_question_id = response["test_question_id"]
+
+    message(response["answer"], is_user=False, key=f"{key}_response_message")
 
     # Display bullet points
     st.markdown("Bullet Points: ")
-    bullet_points = response.json().get("bullet_points")
-    bullet_point_str = "\n".join([f"• {point}" for point in bullet_points])
+    bullet_point_str = "\n".join([f"• {point}" for point in response["bullet_points"]])
     message(f"{bullet_point_str}", is_user=False, key=f"{key}_bullet_points")
 
     # Display the generated test question
     st.markdown("Test Question: ")
-    test_question = response.json().get("test_question")
-    message(f"{test_question}", is_user=False, key=f"{key}_test_question")
-    
-    st.session_state.test_question_id = response.json().get("test_question_id")
+    message(f"{response['test_question']}", is_user=False, key=f"{key}_test_question")
 
 def handle_useranswer(user_answer, key="user_answer"):
-    payload = {"answer": user_answer, "test_question_id": st.session_state.test_question_id}
-    response = requests.post(f"{backend_url}/evaluate/", json=payload)
+    """Show the evaluation of an answer to the test question, asking the backend once per answer."""
+    cache_key = (st.session_state.test_question_id, user_answer)
+    evaluation = st.session_state.evaluations.get(cache_key)
+    if evaluation is None:
+        payload = {"answer": user_answer, "test_question_id": st.session_state.test_question_id}
+        with st.spinner("Loading..."):
+            evaluation = get_session().post(f"{backend_url}/evaluate/", json=payload, timeout=60).json()
+        if "error" not in evaluation:
+            remember(st.session_state.evaluations, cache_key, evaluation)
     message(user_answer, is_user=True, key=f"{key}_user_answer")
 
     st.markdown("Knowledge Understood: ")
-    knowledge_understood = response.json().get("knowledge_understood")
+    knowledge_understood = evaluation.get("knowledge_understood")
     message(str(knowledge_understood), is_user=False, key=f"{key}_knowledge_understood")
 
     st.markdown("Knowledge Confidence: ")
-    knowledge_confidence = response.json().get("knowledge_confidence")
+    knowledge_confidence = evaluation.get("knowledge_confidence")
     message(str(knowledge_confidence), is_user=False, key=f"{key}_knowledge_confidence")
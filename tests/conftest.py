@@ -0,0 +1,44 @@
+"""Shared setup of the tests: the backend in-process with the local fake models, in a throwaway folder."""
+import os
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# Puts backend/ on sys.path, and must run before helper.py is imported
+from common import use_fake_provider  # noqa: E402
+
+WORK_DIR = use_fake_provider()
+
+
+@pytest.fixture
+def db():
+    """A fresh database, with a connection held by the test like a request holds one."""
+    from database import Database
+
+    database = Database(os.path.join(WORK_DIR, f"{uuid.uuid4().hex}.db"), pool_size=4)
+    database.init_db()
+    with database.scope():
+        yield database
+
+
+@pytest.fixture
+def namespace():
+    """A namespace of its own, so each test starts from an empty index."""
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    """Write a synthetic PDF of `pages` pages to tmp_path/`name` and return its path."""
+    from synthetic import make_pages, write_pdf
+
+    def make(name, pages=2, seed=0):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_pdf(str(path), make_pages(pages, seed=seed))
+        return str(path)
+    return make
@@ -0,0 +1,31 @@
+import os
+import uuid
+
+import pytest
+
+import helper
+from conftest import WORK_DIR
+from database import Database
+
+
+def test_acquire_times_out_when_the_pool_is_exhausted():
+    database = Database(os.path.join(WORK_DIR, f"{uuid.uuid4().hex}.db"), pool_size=1, acquire_timeout=0.05)
+    held = database.acquire()
+    with pytest.raises(TimeoutError):
+        database.acquire()
+
+    database.release(held)
+    database.release(database.acquire())
+
+
+def test_question_bank_writes_through_the_held_connection(namespace):
+    database = Database(os.path.join(WORK_DIR, f"{uuid.uuid4().hex}.db"), pool_size=1, acquire_timeout=0.5)
+    database.init_db()
+    chunks = [(str(uuid.uuid4()), f"Passage {i} about storage engines and their write paths.", {"page": i}) for i in range(3)]
+
+    # The ingestion worker holds the only connection of the pool
+    with database.scope():
+        saved = helper.build_question_bank(chunks, database, namespace=namespace)
+
+    assert saved > 0
+    assert database.find_bank_question([chunk_id for chunk_id, _, _ in chunks]) is not None
@@ -0,0 +1,44 @@
+import importlib.util
+import os
+
+from conftest import ROOT
+
+# Knobs set to the same value, which an Enum would have merged into one member
+SAME_VALUES = {
+    "PDF_WORKERS": "5",
+    "PROVIDER_MAX_RETRIES": "5",
+    "EMBEDDING_BATCH_WINDOW_MS": "5",
+    "DB_ACQUIRE_TIMEOUT": "30",
+    "PROVIDER_BACKOFF_MAX": "30",
+    "DB_POOL_SIZE": "16",
+    "EVALUATE_BATCH_CONCURRENCY": "16",
+    "LLM_RATE_LIMIT": "0",
+    "FAKE_LLM_LATENCY": "0",
+    "FOLLOW_UP_CONTEXT_TOKENS": "0",
+}
+
+
+def load_env_var():
+    """A fresh copy of env_var.py, reading the current environment."""
+    spec = importlib.util.spec_from_file_location("env_var_under_test", os.path.join(ROOT, "backend", "env_var.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.EnvVariable
+
+
+def test_every_setting_keeps_its_own_name_value_and_type(monkeypatch):
+    for name, value in SAME_VALUES.items():
+        monkeypatch.setenv(name, value)
+    env = load_env_var()
+
+    settings = {name: setting for name, setting in vars(env).items() if name.isupper()}
+    assert all(setting.name == name for name, setting in settings.items())
+    assert len({id(setting) for setting in settings.values()}) == len(settings)
+
+    assert (env.PDF_WORKERS.value, type(env.PDF_WORKERS.value)) == (5, int)
+    assert (env.PROVIDER_MAX_RETRIES.value, type(env.PROVIDER_MAX_RETRIES.value)) == (5, int)
+    assert (env.EMBEDDING_BATCH_WINDOW_MS.value, type(env.EMBEDDING_BATCH_WINDOW_MS.value)) == (5.0, float)
+    assert (env.PROVIDER_BACKOFF_MAX.value, type(env.PROVIDER_BACKOFF_MAX.value)) == (30.0, float)
+    assert (env.EVALUATE_BATCH_CONCURRENCY.value, type(env.EVALUATE_BATCH_CONCURRENCY.value)) == (16, int)
+    assert (env.FOLLOW_UP_CONTEXT_TOKENS.value, type(env.FOLLOW_UP_CONTEXT_TOKENS.value)) == (0, int)
+    assert env.TIMING_HEADER.value is False
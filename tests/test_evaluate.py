@@ -0,0 +1,24 @@
+import helper
+from fake_models import FakeChatModel
+
+
+class FailingChatModel(FakeChatModel):
+    """Fake LLM whose calls fail for the answers containing "unreachable"."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if "unreachable" in messages[-1].content:
+            raise TimeoutError("provider timed out")
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def test_a_failed_item_does_not_fail_the_batch():
+    items = [
+        {"question": "What is Kafka?", "correct_answer": "A log.", "user_answer": answer}
+        for answer in ("A distributed log.", "unreachable", "A message broker.")
+    ]
+
+    results = helper.evaluate_batch(items, model=FailingChatModel())
+
+    assert results[1] == {"error": "provider timed out"}
+    assert results[0]["knowledge_understood"] is True
+    assert results[2]["knowledge_confidence"] == 80
@@ -0,0 +1,56 @@
+import faiss
+
+import helper
+from env_var import EnvVariable
+
+
+def chunks(count, topic):
+    return [f"Chunk {i} about {topic}: pipelines, schedulers and storage layer {i * 7}." for i in range(count)]
+
+
+def segments(namespace):
+    return helper.read_segments(helper.indexes.get(namespace).path)["segments"]
+
+
+def is_ivf(store):
+    try:
+        faiss.extract_index_ivf(store.index)
+    except RuntimeError:
+        return False
+    return True
+
+
+def test_segments_of_another_index_type_are_rebuilt(namespace, monkeypatch):
+    helper.update_vectorstore(chunks(50, "flat"), namespace=namespace)
+    assert [segment["index_type"] for segment in segments(namespace)] == ["flat"]
+
+    monkeypatch.setattr(EnvVariable.FAISS_INDEX_TYPE, "value", "ivf_flat")
+    helper.update_vectorstore(chunks(100, "ivf"), namespace=namespace)
+
+    assert {segment["index_type"] for segment in segments(namespace)} == {"ivf_flat"}
+    assert sum(store.index.ntotal for store in helper.get_vector_stores(namespace)) == 150
+
+
+def test_untrained_segments_are_trained_once_they_have_enough_chunks(namespace, monkeypatch):
+    monkeypatch.setattr(EnvVariable.FAISS_INDEX_TYPE, "value", "ivf_flat")
+
+    # Too few chunks to train IVF lists, the segment falls back to a flat index
+    helper.update_vectorstore(chunks(50, "first"), namespace=namespace)
+    assert [segment["trained"] for segment in segments(namespace)] == [False]
+
+    helper.update_vectorstore(chunks(50, "second"), namespace=namespace)
+
+    assert [(segment["count"], segment["trained"]) for segment in segments(namespace)] == [(100, True)]
+    store, = helper.get_vector_stores(namespace)
+    assert is_ivf(store)
+
+
+def test_loaded_indexes_map_their_codes_instead_of_copying_them(namespace, monkeypatch):
+    helper.update_vectorstore(chunks(50, "flat"), namespace=namespace)
+    monkeypatch.setattr(EnvVariable.FAISS_INDEX_TYPE, "value", "ivf_flat")
+    helper.update_vectorstore(chunks(100, "ivf"), namespace=namespace)
+
+    flat, ivf = helper.get_vector_stores(namespace)
+    assert not faiss.downcast_index(flat.index).codes.is_owned
+    lists = faiss.downcast_InvertedLists(faiss.extract_index_ivf(ivf.index).invlists)
+    assert not lists.codes.at(0).is_owned
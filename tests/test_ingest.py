@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import helper
+
+
+def index_size(namespace):
+    return sum(store.index.ntotal for store in helper.get_vector_stores(namespace))
+
+
+def test_files_sharing_a_name_are_different_documents(db, namespace, make_pdf):
+    first = make_pdf("browser-a/notes.pdf", seed=1)
+    second = make_pdf("browser-b/notes.pdf", seed=2)
+
+    (first_result,), _ = helper.ingest_documents([("notes.pdf", first)], db, namespace=namespace)
+    (second_result,), _ = helper.ingest_documents([("notes.pdf", second)], db, namespace=namespace)
+
+    assert second_result["status"] == "ingested"
+    assert index_size(namespace) == first_result["chunks"] + second_result["chunks"]
+
+
+def test_replace_source_makes_a_new_version(db, namespace, make_pdf):
+    first = make_pdf("v1/notes.pdf", seed=1)
+    second = make_pdf("v2/notes.pdf", seed=2)
+
+    helper.ingest_documents([("notes.pdf", first)], db, namespace=namespace)
+    (result,), _ = helper.ingest_documents([("notes.pdf", second)], db, namespace=namespace, replace_source=True)
+
+    assert result["status"] == "updated"
+    assert index_size(namespace) == result["chunks"]
+
+
+def test_concurrent_uploads_of_a_document_index_it_once(db, namespace, make_pdf):
+    path = make_pdf("notes.pdf", pages=4)
+
+    def ingest():
+        with db.scope():
+            return helper.ingest_documents([("notes.pdf", path)], db, namespace=namespace)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = [future.result() for future in [executor.submit(ingest) for _ in range(2)]]
+
+    statuses = sorted(result["status"] for (result,), _ in results)
+    assert statuses == ["ingested", "unchanged"]
+    document = db.get_document(helper.hash_file(path), namespace)
+    assert index_size(namespace) == sum(len(ids) for ids in document["chunk_ids"])
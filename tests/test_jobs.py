@@ -0,0 +1,37 @@
+import time
+import uuid
+
+from jobs import IngestionQueue, process_owner
+from pdf_extract import MIN_PAGES_FOR_POOL
+
+
+def wait_for_job(db, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = db.get_job(job_id)
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.05)
+    return db.get_job(job_id)
+
+
+def test_only_the_jobs_of_exited_processes_are_failed(db):
+    # PIDs above the kernel's maximum never belong to a running process
+    exited_owner = f"{process_owner().rpartition(':')[0]}:99999999"
+    running_job, orphaned_job = str(uuid.uuid4()), str(uuid.uuid4())
+    db.create_job(running_job, owner=process_owner())
+    db.create_job(orphaned_job, owner=exited_owner)
+
+    IngestionQueue(db, max_workers=1)
+
+    assert db.get_job(running_job)["status"] == "queued"
+    assert db.get_job(orphaned_job)["status"] == "failed"
+
+
+def test_uploads_parsed_by_the_pdf_pool_do_not_leave_the_namespace_locked(db, namespace, make_pdf):
+    # Large enough to be parsed by the process pool, whose workers must not keep the ingest lock
+    queue = IngestionQueue(db, max_workers=1)
+    for seed in (1, 2):
+        path = make_pdf(f"upload-{seed}.pdf", pages=MIN_PAGES_FOR_POOL + 4, seed=seed)
+        job = wait_for_job(db, queue.submit([(f"upload-{seed}.pdf", path)], namespace=namespace))
+        assert (job["status"], job["error"]) == ("completed", None)
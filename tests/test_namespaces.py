@@ -0,0 +1,39 @@
+import threading
+
+import helper
+from namespaces import IndexRegistry, ProcessLock
+
+
+def chunks(count, topic):
+    return [f"Chunk {i} about {topic}: pipelines, schedulers and storage layer {i * 7}." for i in range(count)]
+
+
+def test_updates_published_by_another_process_are_picked_up(namespace):
+    # A registry of its own caches its snapshots like the one of another worker process would
+    other_process = IndexRegistry(
+        helper.vectorstore_path, loader=helper.open_vectorstore, read_version=helper.read_index_version
+    )
+    helper.update_vectorstore(chunks(20, "first"), namespace=namespace)
+    stores, version = other_process.open(namespace)
+    assert (sum(store.index.ntotal for store in stores), version) == (20, 1)
+
+    helper.update_vectorstore(chunks(30, "second"), namespace=namespace)
+    stores, version = other_process.open(namespace)
+    assert (sum(store.index.ntotal for store in stores), version) == (50, 2)
+
+
+def test_process_lock_excludes_holders_of_other_file_descriptors(tmp_path):
+    # Two instances on one file stand for the locks of two processes
+    first, second = ProcessLock(str(tmp_path / "index.lock")), ProcessLock(str(tmp_path / "index.lock"))
+    acquired = threading.Event()
+
+    def take_second():
+        with second:
+            acquired.set()
+
+    with first:
+        thread = threading.Thread(target=take_second)
+        thread.start()
+        assert not acquired.wait(0.2)
+    assert acquired.wait(5)
+    thread.join()
@@ -0,0 +1,10 @@
+import helper
+
+
+def test_questions_retrieved_differently_use_different_caches(namespace):
+    default = helper.get_semantic_cache([namespace])
+
+    assert helper.get_semantic_cache([namespace], "vector", {"k": helper.RETRIEVAL_K}) is default
+    assert helper.get_semantic_cache([namespace], "hybrid") is not default
+    assert helper.get_semantic_cache([namespace], retrieval={"k": 8}) is not default
+    assert helper.get_semantic_cache([namespace], retrieval={"lambda_mult": 0.9}) is not default